@@ -1,5 +1,13 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import socket
+from flask import (Flask, Response, flash, jsonify, redirect, render_template, request, session,
+                   stream_with_context, url_for)
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+import dns_client  # noqa: E402
+import sharding  # noqa: E402
+import zone_io  # noqa: E402
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key"
@@ -10,21 +18,30 @@ PASSWORD = "admin"
 
 PRIMARY_SERVER = ("127.0.0.1", 8053)
 SECONDARY_SERVER = ("127.0.0.1", 8054)
+# A shard map file spreads domains over several primary/secondary pairs; without one,
+# every record lives on the single pair above
+SHARD_MAP_FILE = os.environ.get("DNS_SHARD_MAP")
+
+BACKEND_TIMEOUT = 3.0  # Seconds a page waits for any server before showing an error
+PROBE_INTERVAL = 2.0
+BROWSE_PAGE_SIZE = 50  # Records per page of the record browser
+
+# One shared client for every web worker: requests routed to their shard, pooled
+# persistent connections to its servers, a circuit breaker per server, and
+# background health probes
+if SHARD_MAP_FILE:
+    shard_map = sharding.load_shard_map(SHARD_MAP_FILE)
+else:
+    shard_map = sharding.single_shard_map(PRIMARY_SERVER, [SECONDARY_SERVER])
+backend = dns_client.ShardedClient(shard_map, timeout=BACKEND_TIMEOUT)
+backend.start_probes(PROBE_INTERVAL)
 
-def send_query_to_server(query, fallback=False, operation="query"):
-    """Send query to the appropriate server based on operation."""
-    server = SECONDARY_SERVER if fallback else PRIMARY_SERVER
+def send_query_to_server(query, operation="query"):
+    """Send a query to the lowest-latency healthy server (writes prefer the primary)."""
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect(server)
-            sock.sendall(query.encode())
-            response = sock.recv(1024).decode()
-            return response
-    except Exception as e:
-        if not fallback:
-            # Fallback to secondary server for ALL operations
-            return send_query_to_server(query, fallback=True, operation=operation)
-        return f"[ERROR] Could not connect to the {('secondary' if fallback else 'primary')} server: {e}"
+        return backend.query(query)
+    except ConnectionError as e:
+        return f"[ERROR] Could not complete the {operation}: {e}"
 
 @app.route("/", methods=["GET", "POST"])
 def login():
@@ -42,7 +59,7 @@ def login():
 def dashboard():
     if not session.get("logged_in"):
         return redirect(url_for("login"))
-    return render_template("dashboard.html")
+    return render_template("dashboard.html", servers=backend.stats())
 
 @app.route("/query", methods=["GET", "POST"])
 def query():
@@ -65,7 +82,8 @@ def add():
         domain = request.form.get("domain")
         record_type = request.form.get("record_type")
         value = request.form.get("value")
-        query = f"ADD:{domain}:{record_type}:{value}"
+        ttl = request.form.get("ttl", "").strip()
+        query = f"ADD:{domain}:{record_type}:{value}:{ttl}"  # Always send the TTL field, so a value's own colons stay in it
         response = send_query_to_server(query, operation="add")
     return render_template("add.html", response=response)
 
@@ -78,7 +96,8 @@ def update():
         domain = request.form.get("domain")
         record_type = request.form.get("record_type")
         value = request.form.get("value")
-        query = f"UPDATE:{domain}:{record_type}:{value}"
+        ttl = request.form.get("ttl", "").strip()
+        query = f"UPDATE:{domain}:{record_type}:{value}:{ttl}"
         response = send_query_to_server(query, operation="update")
     return render_template("update.html", response=response)
 
@@ -94,6 +113,83 @@ def delete():
         response = send_query_to_server(query, operation="delete")
     return render_template("delete.html", response=response)
 
+@app.route("/zones", methods=["GET", "POST"])
+def zones():
+    if not session.get("logged_in"):
+        return redirect(url_for("login"))
+    zone = request.values.get("zone")
+    records = error = None
+    if zone:
+        response = send_query_to_server(f"LIST:{zone}", operation="query")
+        try:
+            records = zone_io.parse_listing(response)
+        except ValueError:
+            error = response
+    return render_template("zones.html", zone=zone, records=records, error=error)
+
+def scan_page(cursor, record_type, prefix, limit):
+    """Fetch one SCAN page as ``(records, next_cursor)``; raises ValueError with the server's error."""
+    response = send_query_to_server(f"SCAN:{cursor}:{limit}:{record_type}:{prefix}", operation="scan")
+    return zone_io.parse_scan(response)
+
+@app.route("/records")
+def records():
+    if not session.get("logged_in"):
+        return redirect(url_for("login"))
+    record_type = request.args.get("type", "").strip().upper()
+    prefix = request.args.get("prefix", "").strip()
+    cursor = request.args.get("cursor", "")
+    page = next_cursor = error = None
+    try:
+        page, next_cursor = scan_page(cursor, record_type, prefix, BROWSE_PAGE_SIZE)
+    except ValueError as e:
+        error = str(e)
+    return render_template("records.html", records=page, next_cursor=next_cursor, record_type=record_type,
+                           prefix=prefix, cursor=cursor, error=error)
+
+@app.route("/api/records")
+def api_records():
+    """Return one page of records as JSON, or with ``stream=1`` every matching record as JSON lines.
+
+    Filters are ``type`` and ``prefix``; a page also takes ``cursor`` (the
+    previous page's ``next_cursor``) and ``limit``.
+    """
+    if not session.get("logged_in"):
+        return jsonify(error="Not logged in"), 401
+    record_type = request.args.get("type", "").strip().upper()
+    prefix = request.args.get("prefix", "").strip()
+    limit = request.args.get("limit", "").strip()
+    if limit and not (limit.isdigit() and 1 <= int(limit) <= zone_io.MAX_LIST_LIMIT):
+        return jsonify(error=f"limit must be a whole number from 1 to {zone_io.MAX_LIST_LIMIT}"), 400
+    limit = int(limit) if limit else zone_io.DEFAULT_LIST_LIMIT
+    # Colons separate the SCAN request's fields, so neither filter may contain one
+    if record_type and not record_type.isalnum():
+        return jsonify(error=f"Invalid record type '{record_type}'"), 400
+    if ":" in prefix:
+        return jsonify(error="prefix must not contain ':'"), 400
+    fields = ("domain", "record_type", "value", "ttl")
+    if request.args.get("stream") in ("1", "true"):
+        def generate():
+            try:
+                for record in backend.scan(record_type, prefix, limit):
+                    yield json.dumps(dict(zip(fields, record))) + "\n"
+            except (ValueError, ConnectionError) as e:
+                yield json.dumps({"error": str(e)}) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    cursor = request.args.get("cursor", "")
+    try:
+        if ":" in cursor:
+            raise ValueError(f"Malformed SCAN cursor '{cursor}'")
+        zone_io.parse_scan_cursor(cursor)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        page, next_cursor = scan_page(cursor, record_type, prefix, limit)
+    except ValueError as e:
+        return jsonify(error=str(e)), 502
+    return jsonify(records=[dict(zip(fields, record)) for record in page], next_cursor=next_cursor or None)
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -0,0 +1,441 @@
+"""Reproducible load generator and benchmark for the primary and secondary servers.
+
+Starts a primary and a secondary in a temporary directory (so each run gets a
+fresh ``dns_records.db``) against a throwaway Redis, seeds them with records
+through ``BULK:``, replays the selected workloads and writes throughput and
+latency percentiles per command to a JSON file for comparing runs:
+
+    python benchmark.py --records 20000 --duration 10 --output results.json
+    python benchmark.py --workloads zipf,misses --mode async --concurrency 128
+
+Workloads:
+    zipf      Zipf-distributed reads of the seeded names
+    writes    bursts of ADD/UPDATE/DELETE interleaved with Zipf reads
+    misses    mostly lookups of names that do not exist
+    failover  reads and writes through DnsClient while the primary is killed and restarted
+
+Redis is ``--redis-url`` if given, otherwise a ``redis-server`` on a free port,
+otherwise a fakeredis server if that package is installed.
+"""
+import argparse
+import bisect
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import dns_client
+import protocol
+import zone_tool
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS = ("zipf", "writes", "misses", "failover")
+DEFAULT_RECORDS = 10000
+DEFAULT_DURATION = 10.0
+DEFAULT_CONCURRENCY = 64
+DEFAULT_ZIPF_EXPONENT = 1.1
+DEFAULT_BURST_SIZE = 200
+MISS_RATIO = 0.9
+WRITE_RATIO_DURING_FAILOVER = 0.1
+STARTUP_TIMEOUT = 15.0
+REQUEST_TIMEOUT = 10.0  # Seconds before a request still unanswered is counted as an error
+ZONE = "bench.test"
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, log_path, timeout=STARTUP_TIMEOUT):
+    """Block until ``port`` accepts connections, failing early if ``process`` exits."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as log:
+                raise RuntimeError(f"Process exited with {process.returncode}:\n{log.read()[-2000:]}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+class Cluster:
+    """A throwaway Redis, primary and secondary, all on free local ports."""
+
+    def __init__(self, workdir, mode, redis_url=None):
+        self.workdir = workdir
+        self.mode = mode
+        self.redis_url = redis_url
+        self.primary_port = free_port()
+        self.secondary_port = free_port()
+        self.processes = {}
+
+    def _spawn(self, name, args, cwd, env=None):
+        log_path = os.path.join(self.workdir, f"{name}.log")
+        log = open(log_path, "a")
+        process = subprocess.Popen(args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        log.close()
+        self.processes[name] = (process, log_path)
+        return process, log_path
+
+    def _start_redis(self):
+        if self.redis_url:
+            return
+        port = free_port()
+        if shutil.which("redis-server"):
+            args = ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"]
+        else:
+            try:
+                import fakeredis  # noqa: F401
+            except ImportError:
+                raise RuntimeError("Need --redis-url, redis-server on PATH, or the fakeredis package")
+            args = [sys.executable, "-c", "import sys; from fakeredis import TcpFakeServer; "
+                    "TcpFakeServer(('127.0.0.1', int(sys.argv[1])), server_type='redis').serve_forever()", str(port)]
+        process, log_path = self._spawn("redis", args, self.workdir)
+        wait_for_port(port, process, log_path)
+        self.redis_url = f"redis://127.0.0.1:{port}/0"
+
+    def start_primary(self):
+        directory = os.path.join(self.workdir, "primary")
+        os.makedirs(directory, exist_ok=True)
+        args = [sys.executable, os.path.join(BACKEND_DIR, "primary_server.py"),
+                "--port", str(self.primary_port), "--mode", self.mode]
+        process, log_path = self._spawn("primary", args, directory, dict(os.environ, DNS_REDIS_URL=self.redis_url))
+        wait_for_port(self.primary_port, process, log_path)
+
+    def start_secondary(self):
+        directory = os.path.join(self.workdir, "secondary")
+        os.makedirs(directory, exist_ok=True)
+        args = [sys.executable, os.path.join(BACKEND_DIR, "secondary_server.py"),
+                "--port", str(self.secondary_port), "--mode", self.mode,
+                "--primary", f"127.0.0.1:{self.primary_port}", "--bootstrap"]
+        process, log_path = self._spawn("secondary", args, directory, dict(os.environ, DNS_REDIS_URL=self.redis_url))
+        wait_for_port(self.secondary_port, process, log_path)
+
+    def start(self):
+        self._start_redis()
+        self.start_primary()
+
+    def stop(self, name):
+        process, _ = self.processes.pop(name)
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def close(self):
+        for name in reversed(list(self.processes)):
+            self.stop(name)
+
+    @property
+    def primary(self):
+        return ("127.0.0.1", self.primary_port)
+
+    @property
+    def secondary(self):
+        return ("127.0.0.1", self.secondary_port)
+
+
+class ZipfSampler:
+    """Draw indexes in ``[0, n)`` with probability proportional to ``1 / (rank + 1) ** exponent``."""
+
+    def __init__(self, n, exponent, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, n + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def sample(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+def record_name(index):
+    return f"host{index}.{ZONE}"
+
+
+def seed_records(cluster, count, workdir):
+    """Load ``count`` A records into the primary through the BULK command."""
+    path = os.path.join(workdir, "seed.csv")
+    with open(path, "w") as seed:
+        for index in range(count):
+            seed.write(f"{record_name(index)},A,10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}\n")
+    return zone_tool.import_zone(cluster.primary, path, "csv")
+
+
+def zipf_queries(options, rng):
+    sampler = ZipfSampler(options.records, options.zipf_exponent, rng)
+    while True:
+        yield "QUERY", f"{record_name(sampler.sample())}:A"
+
+
+def write_burst_queries(options, rng):
+    reads = zipf_queries(options, rng)
+    serial = 0
+    while True:
+        for _ in range(options.burst_size):
+            serial += 1
+            name = f"burst{rng.randrange(options.records)}.{ZONE}"
+            roll = rng.random()
+            if roll < 0.7:
+                yield "ADD", f"ADD:{name}:A:192.0.2.{serial & 255}"
+            elif roll < 0.9:
+                yield "UPDATE", f"UPDATE:{name}:A:198.51.100.{serial & 255}"
+            else:
+                yield "DELETE", f"DELETE:{name}:A"
+        for _ in range(options.burst_size):
+            yield next(reads)
+
+
+def miss_queries(options, rng):
+    hits = zipf_queries(options, rng)
+    # Scanners mix one-off names with a smaller set they keep retrying
+    repeated = ZipfSampler(options.records, options.zipf_exponent, rng)
+    while True:
+        roll = rng.random()
+        if roll >= MISS_RATIO:
+            yield next(hits)
+        elif roll < MISS_RATIO / 2:
+            yield "MISS", f"missing{rng.getrandbits(48)}.{ZONE}:A"
+        else:
+            yield "MISS", f"typo{repeated.sample()}.{ZONE}:A"
+
+
+def failover_queries(options, rng):
+    reads = zipf_queries(options, rng)
+    serial = 0
+    while True:
+        if rng.random() < WRITE_RATIO_DURING_FAILOVER:
+            serial += 1
+            yield "ADD", f"ADD:failover{serial}.{ZONE}:A:203.0.113.{serial & 255}"
+        else:
+            yield next(reads)
+
+
+class Recorder:
+    """Per-command latency samples, error counts and [BUSY] counts.
+
+    Requests the server turned away [BUSY] never ran, so they are counted apart
+    and left out of the latency samples and throughput.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.busy = {}
+        self._lock = threading.Lock()
+
+    def record(self, command, latency, error):
+        with self._lock:
+            self.latencies.setdefault(command, []).append(latency)
+            if error:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+    def record_busy(self, command):
+        with self._lock:
+            self.busy[command] = self.busy.get(command, 0) + 1
+
+    def summary(self, elapsed):
+        results = {}
+        for command in sorted(set(self.latencies) | set(self.busy)):
+            samples = sorted(self.latencies.get(command, []))
+            summary = {
+                "count": len(samples),
+                "errors": self.errors.get(command, 0),
+                "busy": self.busy.get(command, 0),
+                "throughput": round(len(samples) / elapsed, 1),
+            }
+            for percentile in PERCENTILES:
+                index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+                summary[f"p{percentile}_ms"] = round(samples[index] * 1000, 3) if samples else None
+            summary["max_ms"] = round(samples[-1] * 1000, 3) if samples else None
+            results[command] = summary
+        return results
+
+
+def run_load(submit, queries, concurrency, duration, events=()):
+    """Keep ``concurrency`` requests in flight for ``duration`` seconds and return the results.
+
+    ``submit(query)`` must return a Future. ``events`` are ``(offset, callable)``
+    pairs fired once that many seconds into the run, from a separate thread.
+    A request still unanswered REQUEST_TIMEOUT seconds after the run is counted
+    as an error, so a connection that drops its replies cannot hang the run.
+    """
+    recorder = Recorder()
+    slots = threading.BoundedSemaphore(concurrency)
+    in_flight = {}  # Future -> (command, sent_at), until it is recorded
+    started = time.perf_counter()
+    stop_at = started + duration
+
+    def fire_events():
+        for offset, action in sorted(events, key=lambda event: event[0]):
+            time.sleep(max(0.0, started + offset - time.perf_counter()))
+            action()
+
+    event_thread = threading.Thread(target=fire_events, daemon=True)
+    event_thread.start()
+
+    def finish(future):
+        request = in_flight.pop(future, None)
+        if request is None:
+            return  # Already counted as timed out
+        command, sent_at = request
+        latency = time.perf_counter() - sent_at
+        try:
+            response = future.result(timeout=0)  # Only called once the future is done
+        except Exception:
+            recorder.record(command, latency, True)
+        else:
+            if response.startswith(protocol.BUSY_TAG):
+                recorder.record_busy(command)
+            else:
+                recorder.record(command, latency, response.startswith("[ERROR]"))
+        slots.release()
+
+    for command, query in queries:
+        if time.perf_counter() >= stop_at:
+            break
+        if not slots.acquire(timeout=REQUEST_TIMEOUT):
+            break  # Every request in flight is stuck; stop sending and count them below
+        sent_at = time.perf_counter()
+        try:
+            future = submit(query)
+        except Exception:
+            recorder.record(command, time.perf_counter() - sent_at, True)
+            slots.release()
+            continue
+        in_flight[future] = (command, sent_at)
+        future.add_done_callback(finish)
+    # Wait for the stragglers, but not forever
+    concurrent.futures.wait(list(in_flight), timeout=REQUEST_TIMEOUT)
+    timed_out = 0
+    for future in list(in_flight):
+        request = in_flight.pop(future, None)
+        if request is not None:
+            recorder.record(request[0], time.perf_counter() - request[1], True)
+            future.cancel()
+            timed_out += 1
+    if timed_out:
+        print(f"[WARN] {timed_out} request(s) got no answer within {REQUEST_TIMEOUT:g}s; counted as errors.")
+    event_thread.join()
+    elapsed = time.perf_counter() - started
+    return {"duration": round(elapsed, 3), "commands": recorder.summary(elapsed)}
+
+
+def run_workload(name, cluster, options, rng):
+    if name == "failover":
+        client = dns_client.DnsClient([cluster.primary, cluster.secondary])
+        events = [(options.duration / 3, lambda: cluster.stop("primary")),
+                  (options.duration * 2 / 3, cluster.start_primary)]
+        try:
+            return run_load(client.submit, failover_queries(options, rng), options.concurrency,
+                            options.duration, events)
+        finally:
+            client.close()
+
+    generators = {"zipf": zipf_queries, "writes": write_burst_queries, "misses": miss_queries}
+    target = cluster.secondary if options.target == "secondary" else cluster.primary
+    pool = protocol.ConnectionPool(target)
+    try:
+        return run_load(pool.submit, generators[name](options, rng), options.concurrency, options.duration)
+    finally:
+        pool.close()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_workloads(text):
+    names = [name.strip() for name in text.split(",") if name.strip()]
+    unknown = set(names) - set(WORKLOADS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown workload(s): {', '.join(sorted(unknown))}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the primary and secondary DNS servers.")
+    parser.add_argument("--workloads", type=parse_workloads, default=list(WORKLOADS),
+                        help=f"Comma-separated workloads to run (default: {','.join(WORKLOADS)})")
+    parser.add_argument("--records", type=int, default=DEFAULT_RECORDS,
+                        help=f"Records seeded before the run (default: {DEFAULT_RECORDS})")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help=f"Seconds per workload (default: {DEFAULT_DURATION:g})")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Requests in flight at once (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--zipf-exponent", type=float, default=DEFAULT_ZIPF_EXPONENT,
+                        help=f"Skew of the read distribution (default: {DEFAULT_ZIPF_EXPONENT})")
+    parser.add_argument("--burst-size", type=int, default=DEFAULT_BURST_SIZE,
+                        help=f"Writes per burst in the writes workload (default: {DEFAULT_BURST_SIZE})")
+    parser.add_argument("--target", choices=("primary", "secondary"), default="primary",
+                        help="Server the zipf, writes and misses workloads run against (default: primary)")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="threaded",
+                        help="Connection handling model for both servers (default: threaded)")
+    parser.add_argument("--redis-url", help="Use this Redis instead of starting a throwaway one")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the workloads (default: 1)")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file the results are written to (default: benchmark_results.json)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory with the server logs")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="dns-benchmark-")
+    cluster = Cluster(workdir, options.mode, options.redis_url)
+    results = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(options).items() if key not in ("output", "keep")},
+        "workloads": {},
+    }
+    try:
+        cluster.start()
+        print(f"[INFO] {seed_records(cluster, options.records, workdir)}")
+        cluster.start_secondary()
+        for name in options.workloads:
+            print(f"[INFO] Running {name} for {options.duration:g}s...")
+            rng = random.Random(f"{options.seed}:{name}")
+            results["workloads"][name] = run_workload(name, cluster, options, rng)
+            for command, summary in results["workloads"][name]["commands"].items():
+                if not summary["count"]:
+                    print(f"  {command:<7} no answers  busy {summary['busy']}  errors {summary['errors']}")
+                    continue
+                print(f"  {command:<7} {summary['throughput']:>9.1f}/s  p50 {summary['p50_ms']:.2f} ms  "
+                      f"p95 {summary['p95_ms']:.2f} ms  p99 {summary['p99_ms']:.2f} ms  errors {summary['errors']}  "
+                      f"busy {summary['busy']}")
+    finally:
+        cluster.close()
+        if options.keep:
+            print(f"[INFO] Server logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(options.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"[INFO] Results written to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
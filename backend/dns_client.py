@@ -1,42 +1,84 @@
-import socket
+"""Command line and programmatic client for the DNS servers.
+
+Interactive use:
+    python dns_client.py
+
+Batch use, one query per line from a file or stdin, answered in input order:
+    python dns_client.py --batch queries.txt --concurrency 128
+    cat queries.txt | python dns_client.py --batch -
+
+Against a sharded deployment, requests are routed by a shard map file:
+    python dns_client.py --shard-map shards.json --batch queries.txt
+
+From Python:
+    client = DnsClient()
+    client.query("example.com:A")
+    client.query_many(["example.com:A", "example.org:MX"])
+"""
+import argparse
+import heapq
+import itertools
 import logging
+import os
 import signal
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+import protocol
+import server_core
+import sharding
+import storage
+import zone_io
 
 PRIMARY_SERVER = ("127.0.0.1", 8053)
 SECONDARY_SERVER = ("127.0.0.1", 8054)
-RETRY_ATTEMPTS = 3
-RETRY_DELAY = 2
+DEFAULT_TIMEOUT = 5.0  # Overall budget for one query across every server
+DEFAULT_PRIMARY_DEADLINE = 0.25  # Seconds before a slow read is duplicated to the next server
+MIN_HEDGE_DELAY = 0.01
+CONNECT_TIMEOUT = 1.0
+DEFAULT_CONCURRENCY = 64
+LATENCY_SMOOTHING = 0.2  # Weight of the newest sample in the latency average
+FAILURE_THRESHOLD = 3  # Consecutive failures that open a server's circuit
+CIRCUIT_OPEN_TIME = 1.0  # Seconds an open circuit skips the server, doubled each time it trips again
+MAX_CIRCUIT_OPEN_TIME = 30.0
+DEFAULT_PROBE_INTERVAL = 2.0
+PROBE_TIMEOUT = 1.0
+PROBE_QUERY = "probe.invalid:A"  # Reserved name, so it is a cheap cached miss on every server
+WRITE_COMMANDS = ("ADD:", "UPDATE:", "DELETE:")
 
-# Configure logging
-logging.basicConfig(filename="dns_client.log", level=logging.INFO, 
-                    format="%(asctime)s - %(levelname)s - %(message)s")
 
-def handle_exit(signal, frame):
-    print("\n[INFO] Goodbye!")
-    sys.exit(0)
+def _valid_write(query):
+    """Return True if an ADD or UPDATE has a domain, type and value, and a valid TTL if it has one."""
+    try:
+        zone_io.parse_write_query(query)
+    except ValueError:
+        return False
+    return True
 
-signal.signal(signal.SIGINT, handle_exit)
 
 def validate_query(query):
     query = query.strip().upper()  # Normalize to uppercase
     if query == "QUIT":
         return "QUIT"
 
+    if query == metrics.STATS_COMMAND:
+        return "STATS"
+
     if query.startswith("ADD:"):
-        parts = query.split(":")
-        if len(parts) == 4:
+        if _valid_write(query):
             return "ADD"
         else:
-            print("[ERROR] Malformed ADD query. Example: ADD:example.com:A:192.168.1.1")
+            print("[ERROR] Malformed ADD query. Example: ADD:example.com:A:192.168.1.1[:3600]")
             return None
     elif query.startswith("UPDATE:"):
-        parts = query.split(":")
-        if len(parts) == 4:
+        if _valid_write(query):
             return "UPDATE"
         else:
-            print("[ERROR] Malformed UPDATE query. Example: UPDATE:example.com:A:192.168.1.1")
+            print("[ERROR] Malformed UPDATE query. Example: UPDATE:example.com:A:192.168.1.1[:3600]")
             return None
     elif query.startswith("DELETE:"):
         parts = query.split(":")
@@ -45,6 +87,20 @@ def validate_query(query):
         else:
             print("[ERROR] Malformed DELETE query. Example: DELETE:example.com:A")
             return None
+    elif query.startswith("LIST:"):
+        parts = query.split(":")
+        if len(parts) == 2 or (len(parts) == 3 and parts[2].isdigit()):
+            return "LIST"
+        else:
+            print("[ERROR] Malformed LIST query. Example: LIST:example.com[:100]")
+            return None
+    elif query.startswith("SCAN:"):
+        try:
+            zone_io.parse_scan_query(query)
+            return "SCAN"
+        except ValueError:
+            print("[ERROR] Malformed SCAN query. Example: SCAN:[<cursor>][:100[:A[:www.]]]")
+            return None
     else:
         parts = query.split(":")
         if len(parts) == 2:
@@ -53,40 +109,633 @@ def validate_query(query):
             print("[ERROR] Malformed query. Example: example.com:A")
             return None
 
-def send_query(server_address, query):
+
+class ServerHealth:
+    """Latency tracking and a circuit breaker for one server.
+
+    Latency is an exponentially weighted average of successful requests.
+    ``FAILURE_THRESHOLD`` consecutive failures open the circuit: the server is
+    skipped (unless every server is failing) for a cool-down that doubles each
+    time it trips again. Once the cool-down expires the circuit is half-open
+    and a single trial request is let through; its outcome, or any probe's,
+    closes or reopens the circuit.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.latency = None
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = 0.0
+        self.successes_total = 0
+        self.failures_total = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency):
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.failures = 0
+            self.trips = 0
+            self.successes_total += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.failures_total += 1
+            if self.failures >= FAILURE_THRESHOLD:
+                self.trips += 1
+                backoff = min(CIRCUIT_OPEN_TIME * 2 ** (self.trips - 1), MAX_CIRCUIT_OPEN_TIME)
+                self.retry_at = time.monotonic() + backoff
+
+    def state(self):
+        """Return ``"closed"``, ``"open"`` or ``"half-open"``."""
+        if self.failures < FAILURE_THRESHOLD:
+            return "closed"
+        return "open" if time.monotonic() < self.retry_at else "half-open"
+
+    def may_request(self):
+        """Return True if ``allow_request()`` would let a request through, without claiming the trial."""
+        return self.failures < FAILURE_THRESHOLD or time.monotonic() >= self.retry_at
+
+    def allow_request(self):
+        """Return True if a request may go to this server now.
+
+        In the half-open state only the first caller gets through; the circuit
+        stays shut for everyone else until that trial (or a probe) reports back.
+        Call it only when the request is about to be sent.
+        """
+        if self.failures < FAILURE_THRESHOLD:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now < self.retry_at:
+                return False
+            self.retry_at = now + CIRCUIT_OPEN_TIME
+            return True
+
+    def score(self):
+        """Lower is better: the smoothed latency, inflated by recent failures."""
+        return (self.latency or 0.0) * (1 + self.failures)
+
+    def stats(self):
+        return {
+            "server": f"{self.address[0]}:{self.address[1]}",
+            "state": self.state(),
+            "latency_ms": round(self.latency * 1000, 3) if self.latency is not None else None,
+            "failures": self.failures,
+            "successes_total": self.successes_total,
+            "failures_total": self.failures_total,
+        }
+
+
+class _Scheduler:
+    """One daemon thread that runs callbacks at monotonic-clock deadlines."""
+
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name="dns-client-timers", daemon=True).start()
+
+    def call_at(self, when, callback):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._order), callback))
+            if self._heap[0][0] == when:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            callback()
+
+
+class _HedgedRequest:
+    """One query racing across servers; ``result`` resolves with the first answer."""
+
+    def __init__(self, client, query, read):
+        self.client = client
+        self.query = query
+        self.read = read
+        candidates, self.gated = client._ranked(read)
+        self.candidates = deque(candidates)
+        self.in_flight = {}
+        self.last_error = None
+        self.busy_response = None
+        self.result = Future()
+        self._lock = threading.Lock()
+        self.deadline = time.monotonic() + client.timeout
+
+    def start(self):
+        self.client._scheduler.call_at(self.deadline, self._on_deadline)
+        self._launch_next()
+        return self.result
+
+    def _launch_next(self):
+        while True:
+            with self._lock:
+                if self.result.done():
+                    return
+                if not self.candidates:
+                    if not self.in_flight:
+                        self._fail()
+                    return
+                pool = self.candidates.popleft()
+            if self.gated and not self.client.health[pool.address].allow_request():
+                continue  # Another request took this server's half-open trial
+            sent_at = time.monotonic()
+            try:
+                future = pool.submit(self.query)
+            except (OSError, protocol.ProtocolError) as e:
+                self.client.health[pool.address].record_failure()
+                self.last_error = e
+                continue
+            with self._lock:
+                self.in_flight[future] = pool
+            future.add_done_callback(lambda future, pool=pool, sent_at=sent_at: self._on_done(future, pool, sent_at))
+            if self.read and self.candidates:
+                self.client._scheduler.call_at(sent_at + self.client._hedge_delay(pool), self._on_hedge)
+            return
+
+    def _on_done(self, future, pool, sent_at):
+        with self._lock:
+            self.in_flight.pop(future, None)
+            if self.result.done():
+                return
+        try:
+            response = future.result()
+        except Exception as e:
+            self.client.health[pool.address].record_failure()
+            self.last_error = e
+            self._launch_next()  # Fail over at once rather than after the hedge delay
+            return
+        if response.startswith(server_core.BUSY_TAG):
+            # The server turned the request away without running it, so even a write is safe to resend
+            self.client.health[pool.address].record_failure()
+            self.busy_response = response
+            self._launch_next()
+            return
+        self.client.health[pool.address].record_success(time.monotonic() - sent_at)
+        with self._lock:
+            if not self.result.done():
+                self.result.set_result(response)
+            losers = list(self.in_flight)
+        for loser in losers:
+            loser.cancel()  # Their answers are no longer needed
+
+    def _on_hedge(self):
+        if not self.result.done():
+            self._launch_next()
+
+    def _on_deadline(self):
+        with self._lock:
+            if self.result.done():
+                return
+            for pool in self.in_flight.values():
+                self.client.health[pool.address].record_failure()
+            self._fail()
+            timed_out = list(self.in_flight)
+        for future in timed_out:
+            future.cancel()
+
+    def _fail(self):
+        if self.busy_response is not None:
+            self.result.set_result(self.busy_response)  # Every server that answered was overloaded
+            return
+        detail = f": {self.last_error}" if self.last_error else ""
+        self.result.set_exception(ConnectionError(
+            f"No server answered {self.query!r} within {self.client.timeout}s{detail}"))
+
+
+def _write_succeeded(future):
+    """Return True if a write's Future resolved with a response that is neither an error nor BUSY."""
+    if future.cancelled() or future.exception() is not None:
+        return False
+    return not future.result().startswith(("[ERROR]", server_core.BUSY_TAG))
+
+
+class _QueryMethods:
+    """Blocking and batched helpers for clients that implement ``submit()``."""
+
+    def query(self, query):
+        """Send one text-protocol request and block until the first response arrives."""
+        return self.submit(query).result()
+
+    def query_many(self, queries, concurrency=DEFAULT_CONCURRENCY):
+        """Yield ``(query, response)`` for every query, in input order, running them concurrently.
+
+        At most ``concurrency`` queries are in flight and the input is consumed
+        lazily, so arbitrarily long inputs use bounded memory. A query that no
+        server answered yields an ``[ERROR]`` response rather than raising.
+        """
+        window = deque()
+
+        def take():
+            query, future = window.popleft()
+            try:
+                return query, future.result()
+            except ConnectionError as e:
+                return query, f"[ERROR] {e}"
+
+        for query in queries:
+            window.append((query, self.submit(query)))
+            if len(window) >= concurrency:
+                yield take()
+        while window:
+            yield take()
+
+    def scan(self, record_type=None, prefix="", page_size=zone_io.DEFAULT_LIST_LIMIT):
+        """Yield every ``(domain, record_type, value, ttl)`` record in name order, one SCAN page at a time.
+
+        Only one page is held at once, so scanning any number of records uses
+        bounded memory. Raises ValueError if a server answers with an error.
+        """
+        cursor = ""
+        while True:
+            response = self.query(f"SCAN:{cursor}:{page_size}:{record_type or ''}:{prefix}")
+            records, cursor = zone_io.parse_scan(response)
+            yield from records
+            if not cursor:
+                return
+
+
+class DnsClient(_QueryMethods):
+    """Hedged, health-aware client for a primary and its secondaries.
+
+    Every server gets a pool of persistent pipelined connections. Reads go to
+    the healthiest server first (the primary, until latencies are known); if it
+    has not answered within its hedge delay, a duplicate is sent to the next
+    server and the first answer wins. The delay is three times the server's
+    smoothed latency, capped at ``primary_deadline``. Writes are never
+    duplicated: they go to the primary and move on to a secondary only when
+    the primary cannot be reached. A ``[BUSY]`` answer from an overloaded
+    server counts as a failure and moves any request on to the next server.
+
+    Requests are driven by callbacks and one timer thread, so thousands can be
+    in flight without a thread each. ``start_probes()`` adds a background
+    thread that measures every server periodically, so circuits close again
+    and latencies stay current without real requests paying for it.
+    """
+
+    def __init__(self, servers=(PRIMARY_SERVER, SECONDARY_SERVER), timeout=DEFAULT_TIMEOUT,
+                 primary_deadline=DEFAULT_PRIMARY_DEADLINE, pool_size=protocol.DEFAULT_POOL_SIZE):
+        self.timeout = timeout
+        self.primary_deadline = primary_deadline
+        self.pools = [protocol.ConnectionPool(address, pool_size, min(timeout, CONNECT_TIMEOUT))
+                      for address in servers]
+        self.health = {pool.address: ServerHealth(pool.address) for pool in self.pools}
+        self._scheduler = _Scheduler()
+
+    def _ranked(self, read):
+        """Return ``(pools, gated)``: the pools to try in order, and whether their circuits still apply.
+
+        Circuits are only peeked at here; a half-open trial is claimed when a
+        request is actually sent to that server.
+        """
+        if not read:
+            order = list(self.pools)  # Writes always start at the primary
+        else:
+            order = sorted(self.pools, key=lambda pool: self.health[pool.address].score())
+        allowed = [pool for pool in order if self.health[pool.address].may_request()]
+        if allowed:
+            return allowed, True
+        return order, False  # With every circuit open, trying anyway beats failing outright
+
+    def _hedge_delay(self, pool):
+        latency = self.health[pool.address].latency
+        if latency is None:
+            return self.primary_deadline
+        return min(max(3 * latency, MIN_HEDGE_DELAY), self.primary_deadline)
+
+    def submit(self, query):
+        """Send one text-protocol request and return a Future for the first response.
+
+        The Future raises ConnectionError if no server answered within ``timeout``.
+        """
+        return _HedgedRequest(self, query, not query.startswith(WRITE_COMMANDS)).start()
+
+    def probe(self, timeout=PROBE_TIMEOUT):
+        """Send ``PROBE_QUERY`` to every server at once and record each outcome."""
+        sent = []
+        for pool in self.pools:
+            try:
+                sent.append((pool, time.monotonic(), pool.submit(PROBE_QUERY)))
+            except (OSError, protocol.ProtocolError):
+                self.health[pool.address].record_failure()
+        deadline = time.monotonic() + timeout
+        for pool, sent_at, future in sent:
+            try:
+                future.result(max(0.0, deadline - time.monotonic()))
+            except Exception:
+                self.health[pool.address].record_failure()
+                continue
+            self.health[pool.address].record_success(time.monotonic() - sent_at)
+
+    def start_probes(self, interval=DEFAULT_PROBE_INTERVAL):
+        """Probe every server every ``interval`` seconds from a daemon thread."""
+        def run():
+            while True:
+                self.probe()
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="dns-client-probes", daemon=True).start()
+
+    def stats(self):
+        """Return the health of every server, in configured order."""
+        return [self.health[pool.address].stats() for pool in self.pools]
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+class ShardedClient(_QueryMethods):
+    """Routes each request to a DnsClient for the shard that owns its domain.
+
+    The shard map file is checked for changes at most every
+    ``sharding.MAP_RELOAD_INTERVAL`` seconds, so running clients follow a
+    rebalance without a restart. While one is staged, writes for moving domains
+    also go to the next owner, once the current owner has applied them; a write
+    the owner failed or turned away is not forwarded. The current owner's
+    answer is returned, since it keeps serving reads until the
+    cut-over. LIST for a zone such as ``com``,
+    whose names can live on any shard, asks every shard and merges the answers,
+    and so does SCAN.
+    """
+
+    def __init__(self, shard_map, timeout=DEFAULT_TIMEOUT, primary_deadline=DEFAULT_PRIMARY_DEADLINE,
+                 pool_size=protocol.DEFAULT_POOL_SIZE):
+        self.shard_map = shard_map
+        self._client_options = {"timeout": timeout, "primary_deadline": primary_deadline, "pool_size": pool_size}
+        self._clients = {}  # (name, servers) -> DnsClient, so moving a shard to new servers gets a new client
+        self._lock = threading.Lock()
+        self._probe_interval = None
+        self._checked_at = time.monotonic()
+        self._map_version = _file_version(shard_map.path)
+
+    def _client(self, name):
+        key = (name, tuple(self.shard_map.servers(name)))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = DnsClient(key[1], **self._client_options)
+                if self._probe_interval:
+                    client.start_probes(self._probe_interval)
+            return client
+
+    def _shard_names(self):
+        shard_map = self.shard_map
+        names = list(shard_map.ring.names)
+        if shard_map.next_ring is not None:
+            names.extend(name for name in shard_map.next_ring.names if name not in names)
+        return names
+
+    def _maybe_reload(self):
+        path = self.shard_map.path
+        now = time.monotonic()
+        if path is None or now - self._checked_at < sharding.MAP_RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        version = _file_version(path)
+        if version == self._map_version:
+            return
+        try:
+            shard_map = sharding.load_shard_map(path)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Keeping the current shard map; could not reload {path}: {e}")
+            return
+        self._map_version = version
+        self.shard_map = shard_map
+        print(f"[INFO] Reloaded shard map {path} (ring: {', '.join(shard_map.ring.names)}"
+              + (f"; moving to: {', '.join(shard_map.next_ring.names)})" if shard_map.next_ring else ")"))
+
+    def submit(self, query):
+        """Send one request to the shard owning its domain and return a Future for the response."""
+        self._maybe_reload()
+        shard_map = self.shard_map
+        domain = sharding.query_domain(query)
+        if query.startswith("SCAN:") and len(shard_map.ring.names) > 1:
+            return self._scan_everywhere(shard_map, query)
+        if domain is None:
+            return self._client(shard_map.ring.names[0]).submit(query)  # Server-wide commands such as STATS
+        if query.startswith("LIST:") and sharding.spans_shards(domain):
+            return self._list_everywhere(shard_map, query, domain)
+        if query.startswith(WRITE_COMMANDS):
+            owner, *moving = shard_map.write_owners(domain)
+            future = self._client(owner).submit(query)
+
+            def forward(future):
+                # Only once the owner has logged the write, so anything the next owner holds is
+                # also in the change log shard_tool.py replays; a failure here is covered by that replay
+                if _write_succeeded(future):
+                    for name in moving:
+                        self._client(name).submit(query)
+            if moving:
+                future.add_done_callback(forward)
+            return future
+        return self._client(shard_map.owner(domain)).submit(query)
+
+    def _ask_every_shard(self, shard_map, query, merge):
+        """Send ``query`` to every shard and resolve with ``merge(responses)``, a list of ``(shard, response)``."""
+        names = list(shard_map.ring.names)
+        futures = [self._client(name).submit(query) for name in names]
+        merged = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                result = merge([(name, future.result()) for name, future in zip(names, futures)])
+            except Exception as e:
+                merged.set_exception(e)
+                return
+            merged.set_result(result)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return merged
+
+    def _list_everywhere(self, shard_map, query, zone):
+        """Send LIST to every shard and merge the records each one owns, in reversed-label order."""
+        fields = query.split(":")
+        limit = int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else zone_io.DEFAULT_LIST_LIMIT
+
+        def merge(responses):
+            records = []
+            for name, response in responses:
+                try:
+                    listing = zone_io.parse_listing(response)
+                except ValueError:
+                    return response  # Pass the first shard error through unchanged
+                # Mid-rebalance, a record can briefly sit on two shards; keep the owner's copy
+                records.extend(record for record in listing if shard_map.owner(record[0]) == name)
+            records.sort(key=lambda record: (storage.reverse_domain(record[0]), record[1]))
+            return zone_io.format_listing(zone, records[:limit])
+
+        return self._ask_every_shard(shard_map, query, merge)
+
+    def _scan_everywhere(self, shard_map, query):
+        """Send SCAN to every shard and merge one page of the records each one owns, in name order.
+
+        Every shard resumes from the same cursor, since the keys are global. A
+        shard that has more records only vouches for keys up to the last one it
+        returned, so the merged page stops there; the next page picks up the rest.
+        """
+        try:
+            limit = zone_io.parse_scan_query(query)[1]
+        except ValueError:
+            return self._client(shard_map.ring.names[0]).submit(query)  # Let a server report the malformed request
+
+        def merge(responses):
+            records = []
+            covered = None  # Highest key every shard has answered up to, or None if all were exhausted
+            for name, response in responses:
+                try:
+                    page, next_cursor = zone_io.parse_scan(response)
+                except ValueError:
+                    return response
+                records.extend(record for record in page if shard_map.owner(record[0]) == name)
+                if next_cursor:
+                    last = page[-1][:2]
+                    covered = last if covered is None else min(covered, last)
+            records.sort(key=lambda record: record[:2])
+            if covered is not None:
+                records = [record for record in records if record[:2] <= covered]
+            if len(records) > limit:
+                records = records[:limit]
+                next_cursor = zone_io.format_scan_cursor(*records[-1][:2])
+            else:
+                next_cursor = zone_io.format_scan_cursor(*covered) if covered else ""
+            return zone_io.format_scan(records, next_cursor)
+
+        return self._ask_every_shard(shard_map, query, merge)
+
+    def start_probes(self, interval=DEFAULT_PROBE_INTERVAL):
+        """Probe every server of every shard every ``interval`` seconds, including shards added later."""
+        for name in self._shard_names():
+            self._client(name)
+        with self._lock:
+            self._probe_interval = interval  # Clients created from now on start probing themselves
+            clients = list(self._clients.values())
+        for client in clients:
+            client.start_probes(interval)
+
+    def stats(self):
+        """Return the health of every server, shard by shard, tagged with the shard name."""
+        return [dict(health, shard=name) for name in self._shard_names() for health in self._client(name).stats()]
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+def _file_version(path):
+    """Return a value that changes whenever the file at ``path`` is replaced or modified."""
+    if path is None:
+        return None
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect(server_address)
-            sock.sendall(query.encode())
-            response = sock.recv(1024).decode()
-            return response
-    except ConnectionRefusedError as e:
-        logging.warning(f"Failed to connect to {server_address} - {e}")
-        print(f"[WARN] Failed to connect to {server_address} - {e}")
+        status = os.stat(path)
+    except OSError:
         return None
+    return status.st_ino, status.st_mtime_ns
+
+
+_default_client = None
+
 
 def query_server(query):
-    for attempt in range(1, RETRY_ATTEMPTS + 1):
-        print(f"[INFO] Sending query to Primary DNS Server...")
-        response = send_query(PRIMARY_SERVER, query)
-        if response:
-            logging.info(f"Query: {query} | Response: {response}")
-            return response
-        print(f"[WARN] Attempt {attempt}: Failed to connect to Primary Server.")
-        print(f"[INFO] Retrying in {RETRY_DELAY} seconds...")
-        time.sleep(RETRY_DELAY)
-
-    print("[INFO] Primary server failed. Trying Secondary DNS Server...")
-    response = send_query(SECONDARY_SERVER, query)
-    if response:
-        logging.info(f"Query: {query} | Response: {response}")
-        return response
-
-    print("[ERROR] Both servers are unavailable. Please try again later.")
-    logging.error(f"Query: {query} | Response: Both servers unavailable.")
-    return "[ERROR] Both servers are unavailable."
+    """Send one query through the shared default client and log the outcome."""
+    global _default_client
+    if _default_client is None:
+        _default_client = DnsClient()
+    try:
+        response = _default_client.query(query)
+    except ConnectionError as e:
+        print("[ERROR] Both servers are unavailable. Please try again later.")
+        logging.error(f"Query: {query} | Response: Both servers unavailable. ({e})")
+        return "[ERROR] Both servers are unavailable."
+    logging.info(f"Query: {query} | Response: {response}")
+    return response
+
+
+def _read_queries(source):
+    for line in source:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def run_batch(client, path, concurrency):
+    """Answer every query in ``path`` (or stdin for ``-``) and print ``query => response`` lines."""
+    started = time.monotonic()
+    count = errors = 0
+    with (sys.stdin if path == "-" else open(path)) as source:
+        for query, response in client.query_many(_read_queries(source), concurrency):
+            print(f"{query} => {response}")
+            count += 1
+            errors += response.startswith("[ERROR]")
+    elapsed = time.monotonic() - started
+    print(f"[INFO] {count} queries in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f}/s), "
+          f"{errors} errors", file=sys.stderr)
+    for health in client.stats():
+        print(f"[INFO] {health}", file=sys.stderr)
+
+
+def handle_exit(signal, frame):
+    print("\n[INFO] Goodbye!")
+    sys.exit(0)
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Query and update records on the DNS servers.")
+    parser.add_argument("--batch", metavar="PATH",
+                        help="Run every query in PATH (one per line, - for stdin) instead of prompting")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"Queries in flight at once in batch mode (default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--primary", type=server_core.parse_address, default=PRIMARY_SERVER,
+                        help="Primary server as host:port (default: 127.0.0.1:8053)")
+    parser.add_argument("--secondary", type=server_core.parse_address, action="append",
+                        help="Secondary server as host:port, may be repeated (default: 127.0.0.1:8054)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help=f"Seconds to wait for any server to answer a query (default: {DEFAULT_TIMEOUT:g})")
+    parser.add_argument("--primary-deadline-ms", type=float, default=DEFAULT_PRIMARY_DEADLINE * 1000,
+                        help="Longest wait before a slow read is also sent to the next server "
+                             f"(default: {DEFAULT_PRIMARY_DEADLINE * 1000:g})")
+    parser.add_argument("--shard-map", metavar="PATH",
+                        help="Route each query to its shard using this shard map; overrides --primary/--secondary")
+    args = parser.parse_args()
+
+    global _default_client
+    if args.shard_map:
+        try:
+            shard_map = sharding.load_shard_map(args.shard_map)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Could not load shard map {args.shard_map}: {e}")
+            sys.exit(1)
+        _default_client = ShardedClient(shard_map, timeout=args.timeout,
+                                        primary_deadline=args.primary_deadline_ms / 1000)
+    else:
+        _default_client = DnsClient([args.primary] + (args.secondary or [SECONDARY_SERVER]), timeout=args.timeout,
+                                    primary_deadline=args.primary_deadline_ms / 1000)
+    signal.signal(signal.SIGINT, handle_exit)
+    if args.batch:
+        run_batch(_default_client, args.batch, args.concurrency)
+        return
+
+    # Configure logging
+    logging.basicConfig(filename="dns_client.log", level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
     print("[INFO] DNS Client started. Type 'quit' to exit.")
     while True:
         query = input("Enter DNS query or command (e.g., example.com:A, ADD:<domain>:<record_type>:<value>): ")
@@ -0,0 +1,384 @@
+"""Standard DNS (RFC 1035) UDP and TCP listeners in front of the record store.
+
+Stock resolvers and tools such as ``dig`` can query the servers directly:
+
+    dig @127.0.0.1 -p 5353 example.com A
+
+Only standard queries with a single question are answered. A, AAAA, CNAME, MX,
+TXT, NS and PTR records are encoded from the stored text values; MX values are
+``"<preference> <exchange>"`` (a bare exchange gets preference 10). CNAMEs are
+followed for other query types, and a missing name is NXDOMAIN while a name
+without the requested type is an empty NOERROR answer. Records are answered
+with their own TTL, or ``RECORD_TTL`` if they have none.
+"""
+import socket
+import struct
+import threading
+
+DEFAULT_UDP_WORKERS = 2
+UDP_BATCH_SIZE = 32  # Datagrams drained per wakeup before answering them
+MAX_UDP_PAYLOAD = 512  # Without EDNS, larger answers are truncated so the client retries over TCP
+MAX_EDNS_PAYLOAD = 4096
+MAX_MESSAGE_SIZE = 65535
+TCP_IDLE_TIMEOUT = 30
+MAX_TCP_CONNECTIONS = 1024  # Open DNS-over-TCP connections, one thread each, before new ones are closed
+MAX_CNAME_CHAIN = 8
+RECORD_TTL = 3600  # For records without their own TTL; matches how long the servers keep them in Redis
+DEFAULT_MX_PREFERENCE = 10
+TEMPLATE_CACHE_SIZE = 100000
+
+HEADER = struct.Struct("!HHHHHH")
+RR_FIXED = struct.Struct("!HHIH")  # type, class, ttl, rdlength
+QUESTION_FIXED = struct.Struct("!HH")
+
+CLASS_IN = 1
+TYPE_OPT = 41
+TYPE_CODES = {"A": 1, "NS": 2, "CNAME": 5, "PTR": 12, "MX": 15, "TXT": 16, "AAAA": 28}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+OPCODE_MASK = 0x7800
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+NAME_POINTER = b"\xc0\x0c"  # The question name always starts right after the header
+# A zero-TTL OPT record advertising our own UDP payload size
+OPT_RECORD = b"\x00" + RR_FIXED.pack(TYPE_OPT, MAX_EDNS_PAYLOAD, 0, 0)
+
+
+class Query:
+    """One parsed question. ``question`` holds its raw wire bytes, echoed back verbatim."""
+
+    __slots__ = ("id", "flags", "name", "qtype", "qclass", "question", "edns_payload")
+
+    def __init__(self, query_id, flags, name, qtype, qclass, question, edns_payload):
+        self.id = query_id
+        self.flags = flags
+        self.name = name
+        self.qtype = qtype
+        self.qclass = qclass
+        self.question = question
+        self.edns_payload = edns_payload
+
+
+def parse_query(data):
+    """Parse a query message from a memoryview without copying more than the question.
+
+    Raises ValueError if the message is malformed.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Message shorter than a header")
+    query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    if flags & FLAG_QR or qdcount != 1:
+        raise ValueError("Not a single-question query")
+
+    offset = HEADER.size
+    labels = []
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated question name")
+        length = data[offset]
+        offset += 1
+        if length == 0:
+            break
+        if length > 63:
+            raise ValueError("Compressed or invalid label in question")
+        labels.append(bytes(data[offset:offset + length]).decode("ascii").lower())
+        offset += length
+    if offset + QUESTION_FIXED.size > len(data):
+        raise ValueError("Truncated question")
+    qtype, qclass = QUESTION_FIXED.unpack_from(data, offset)
+    offset += QUESTION_FIXED.size
+    question = bytes(data[HEADER.size:offset])
+
+    edns_payload = None
+    # A plain query carries nothing but its OPT record after the question
+    if arcount == 1 and ancount == 0 and nscount == 0 and offset + 1 + RR_FIXED.size <= len(data):
+        if data[offset] == 0:
+            rr_type, rr_class, _, _ = RR_FIXED.unpack_from(data, offset + 1)
+            if rr_type == TYPE_OPT:
+                edns_payload = min(max(rr_class, MAX_UDP_PAYLOAD), MAX_EDNS_PAYLOAD)
+    return Query(query_id, flags, ".".join(labels), qtype, qclass, question, edns_payload)
+
+
+def encode_name(name):
+    """Encode a dotted name as uncompressed wire-format labels."""
+    name = name.rstrip(".")
+    encoded = bytearray()
+    for label in name.split(".") if name else ():
+        raw = label.encode("ascii")
+        if not 0 < len(raw) <= 63:
+            raise ValueError(f"Invalid label in {name!r}")
+        encoded.append(len(raw))
+        encoded += raw
+    encoded.append(0)
+    if len(encoded) > 255:
+        raise ValueError(f"Name too long: {name!r}")
+    return bytes(encoded)
+
+
+def encode_rdata(record_type, value):
+    """Encode a stored text value as RDATA. Raises ValueError if it does not fit the type."""
+    if record_type == "A":
+        return socket.inet_pton(socket.AF_INET, value.strip())
+    if record_type == "AAAA":
+        return socket.inet_pton(socket.AF_INET6, value.strip())
+    if record_type in ("CNAME", "NS", "PTR"):
+        return encode_name(value.strip())
+    if record_type == "MX":
+        fields = value.split()
+        if len(fields) == 1:
+            return struct.pack("!H", DEFAULT_MX_PREFERENCE) + encode_name(fields[0])
+        return struct.pack("!H", int(fields[0])) + encode_name(fields[1])
+    if record_type == "TXT":
+        raw = value.encode()
+        chunks = [raw[index:index + 255] for index in range(0, len(raw), 255)] or [b""]
+        return b"".join(bytes((len(chunk),)) + chunk for chunk in chunks)
+    raise ValueError(f"Unsupported record type {record_type}")
+
+
+class WireServer:
+    """Answer DNS wire-format queries using a server's own record lookup.
+
+    ``lookup(domain, record_type)`` returns ``(value, from_cache, ttl)`` with a
+    None value for a missing record and a None ``ttl`` where the record has no
+    TTL of its own, and ``domain_exists(domain)`` tells NXDOMAIN apart from an
+    empty answer, so queries go through the same L1/Redis/SQLite path as the
+    text protocol. With ``cached_records(keys)``, which returns the same tuples
+    or None per key from the caches alone, a name's record and its CNAME are
+    fetched together in one Redis round trip.
+
+    Encoded responses are kept as templates keyed by the question and the
+    answer values, so a repeated query costs a dictionary lookup and splicing
+    in the ID and each answer's TTL, whose offsets the template remembers. A
+    changed value changes the key, so templates never go stale, and a changed
+    TTL reuses the template.
+    """
+
+    def __init__(self, lookup, domain_exists, cached_records=None, template_cache_size=TEMPLATE_CACHE_SIZE):
+        self.lookup = lookup
+        self.cached_records = cached_records
+        self.domain_exists = domain_exists
+        self.template_cache_size = template_cache_size
+        self._templates = {}
+        self.queries = 0
+        self.errors = 0
+
+    def _lookup_owner(self, owner, record_type):
+        """Return ``((value, ttl), (cname_target, ttl))`` for ``owner``; the CNAME matters only without a value."""
+        cached = (None, None)
+        if self.cached_records is not None and record_type != "CNAME":
+            cached = self.cached_records([(owner, record_type), (owner, "CNAME")])
+        value, _, ttl = cached[0] or self.lookup(owner, record_type)
+        if value is not None or record_type == "CNAME":
+            return (value, ttl), (None, None)
+        target, _, target_ttl = cached[1] or self.lookup(owner, "CNAME")
+        return (None, None), (target, target_ttl)
+
+    def resolve(self, name, record_type):
+        """Return ``(rcode, answers)`` with ``answers`` as ``(owner, record_type, value, ttl)`` tuples."""
+        answers = []
+        owner = name
+        for _ in range(MAX_CNAME_CHAIN):
+            (value, ttl), (target, target_ttl) = self._lookup_owner(owner, record_type)
+            if value is not None:
+                answers.append((owner, record_type, value, ttl))
+                return RCODE_NOERROR, answers
+            if target is None:
+                break
+            answers.append((owner, "CNAME", target, target_ttl))
+            owner = target.strip().rstrip(".").lower()
+        if answers or self.domain_exists(name):
+            return RCODE_NOERROR, answers
+        return RCODE_NXDOMAIN, answers
+
+    def _build(self, query, rcode, answers, limit):
+        """Encode a response with a zero ID; returns ``(message, ttl_offsets)``, one offset per answer kept."""
+        flags = FLAG_QR | FLAG_AA | (query.flags & FLAG_RD) | rcode
+        records = []
+        ttl_offsets = []
+        offset = HEADER.size + len(query.question)
+        for owner, record_type, value, ttl in answers:
+            rdata = encode_rdata(record_type, value)
+            name = NAME_POINTER if owner == query.name else encode_name(owner)
+            ttl = RECORD_TTL if ttl is None else ttl
+            ttl_offsets.append(offset + len(name) + 4)  # After the type and class
+            records.append(name + RR_FIXED.pack(TYPE_CODES[record_type], CLASS_IN, ttl, len(rdata)) + rdata)
+            offset += len(records[-1])
+        additional = OPT_RECORD if query.edns_payload else b""
+        body = b"".join(records)
+        if HEADER.size + len(query.question) + len(body) + len(additional) > limit:
+            flags |= FLAG_TC
+            records, body, ttl_offsets = [], b"", []
+        header = HEADER.pack(0, flags, 1, len(records), 0, 1 if additional else 0)
+        return header + query.question + body + additional, tuple(ttl_offsets)
+
+    def _error(self, data, rcode):
+        """Answer a query we could not handle with just an rcode, if it has a usable header."""
+        if len(data) < HEADER.size:
+            return None
+        query_id, flags = struct.unpack_from("!HH", data)
+        if flags & FLAG_QR:
+            return None  # Never answer responses
+        return HEADER.pack(query_id, FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD)) | rcode, 0, 0, 0, 0)
+
+    def answer(self, data, transport="udp"):
+        """Return the response bytes for one query message, or None if it should be dropped."""
+        self.queries += 1
+        try:
+            query = parse_query(data)
+        except (ValueError, UnicodeDecodeError):
+            self.errors += 1
+            return self._error(data, RCODE_FORMERR)
+        if query.flags & OPCODE_MASK:
+            return self._error(data, RCODE_NOTIMP)
+        if query.qclass != CLASS_IN:
+            return self._error(data, RCODE_REFUSED)
+
+        if transport == "udp":
+            limit = query.edns_payload or MAX_UDP_PAYLOAD
+        else:
+            limit = MAX_MESSAGE_SIZE
+        record_type = TYPE_NAMES.get(query.qtype)
+        try:
+            if record_type is None:
+                # Types we cannot serve still get an authoritative answer for the name
+                rcode = RCODE_NOERROR if self.domain_exists(query.name) else RCODE_NXDOMAIN
+                answers = []
+            else:
+                rcode, answers = self.resolve(query.name, record_type)
+            # TTLs are left out of the key and patched in below, so a ticking TTL does not rebuild the template
+            key = (query.question, query.flags & FLAG_RD, query.edns_payload, limit, rcode,
+                   tuple(answer[:3] for answer in answers))
+            template = self._templates.get(key)
+            if template is None:
+                template = self._build(query, rcode, answers, limit)
+                if len(self._templates) >= self.template_cache_size:
+                    self._templates.clear()
+                self._templates[key] = template
+        except Exception as e:
+            self.errors += 1
+            print(f"[WARN] DNS query for {query.name} failed: {e}")
+            return self._error(data, RCODE_SERVFAIL)
+        message, ttl_offsets = template
+        if not ttl_offsets:
+            return struct.pack("!H", query.id) + message[2:]
+        response = bytearray(message)
+        struct.pack_into("!H", response, 0, query.id)
+        for offset, (_, _, _, ttl) in zip(ttl_offsets, answers):
+            struct.pack_into("!I", response, offset, RECORD_TTL if ttl is None else ttl)
+        return bytes(response)
+
+    def serve_udp(self, sock, batch_size=UDP_BATCH_SIZE):
+        """Answer datagrams from ``sock`` forever.
+
+        Python has no ``recvmmsg()``, so each wakeup drains up to ``batch_size``
+        queued datagrams with non-blocking reads into preallocated buffers before
+        answering them, which keeps per-datagram overhead close to one syscall.
+        """
+        buffers = [bytearray(MAX_EDNS_PAYLOAD) for _ in range(batch_size)]
+        views = [memoryview(buffer) for buffer in buffers]
+        dontwait = getattr(socket, "MSG_DONTWAIT", 0)
+        received = []
+        while True:
+            try:
+                size, address = sock.recvfrom_into(buffers[0])
+                received.append((views[0][:size], address))
+                while dontwait and len(received) < batch_size:
+                    try:
+                        size, address = sock.recvfrom_into(buffers[len(received)], 0, dontwait)
+                    except BlockingIOError:
+                        break
+                    received.append((views[len(received)][:size], address))
+                for data, address in received:
+                    response = self.answer(data, "udp")
+                    if response is not None:
+                        sock.sendto(response, address)
+            except OSError as e:
+                if sock.fileno() < 0:
+                    return
+                print(f"[WARN] DNS UDP error: {e}")
+            finally:
+                received.clear()
+
+    def _recv_exactly(self, conn, view):
+        received = 0
+        while received < len(view):
+            count = conn.recv_into(view[received:])
+            if count == 0:
+                return False
+            received += count
+        return True
+
+    def handle_tcp(self, conn, address):
+        """Answer length-prefixed queries on one TCP connection until the client closes it."""
+        buffer = bytearray(MAX_MESSAGE_SIZE)
+        view = memoryview(buffer)
+        conn.settimeout(TCP_IDLE_TIMEOUT)
+        try:
+            while True:
+                if not self._recv_exactly(conn, view[:2]):
+                    return
+                (length,) = struct.unpack_from("!H", buffer)
+                if not self._recv_exactly(conn, view[:length]):
+                    return
+                response = self.answer(view[:length], "tcp")
+                if response is None:
+                    return
+                conn.sendall(struct.pack("!H", len(response)) + response)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def serve_tcp(self, sock, max_connections=MAX_TCP_CONNECTIONS):
+        """Accept DNS-over-TCP connections forever, one thread each, closing any beyond ``max_connections``."""
+        slots = threading.BoundedSemaphore(max_connections)
+
+        def serve(conn, address):
+            try:
+                self.handle_tcp(conn, address)
+            finally:
+                slots.release()
+
+        while True:
+            try:
+                conn, address = sock.accept()
+            except OSError:
+                return
+            if not slots.acquire(blocking=False):
+                conn.close()  # The client retries, or falls back to another server
+                continue
+            threading.Thread(target=serve, args=(conn, address), daemon=True).start()
+
+    def start(self, host, port, udp_workers=DEFAULT_UDP_WORKERS, reuse_port=False,
+              max_tcp_connections=MAX_TCP_CONNECTIONS):
+        """Bind UDP and TCP ``port`` and serve both from daemon threads.
+
+        ``reuse_port`` lets several worker processes bind the same port; the
+        kernel then spreads datagrams and connections across them.
+        """
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        udp_sock = socket.socket(family, socket.SOCK_DGRAM)
+        tcp_sock = socket.socket(family, socket.SOCK_STREAM)
+        tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_sock.bind((host, port))
+        tcp_sock.bind((host, port))
+        tcp_sock.listen(socket.SOMAXCONN)
+        for index in range(max(1, udp_workers)):
+            threading.Thread(target=self.serve_udp, args=(udp_sock,), name=f"dns-udp-{index}", daemon=True).start()
+        threading.Thread(target=self.serve_tcp, args=(tcp_sock, max_tcp_connections), name="dns-tcp",
+                         daemon=True).start()
+        print(f"[INFO] Answering standard DNS queries on {host}:{port} (UDP and TCP)")
+        return udp_sock, tcp_sock
@@ -0,0 +1,232 @@
+"""Read path and text protocol dispatch shared by the primary and secondary servers."""
+import math
+import time
+
+import metrics
+import record_cache
+import redis_cache
+import zone_io
+
+
+class RecordLookup:
+    """Answers lookups from L1, then Redis, then SQLite, caching what it reads on the way back.
+
+    ``pinned_source``, if given, is called once per batch of lookups and returns
+    a ``get(domain, record_type)`` to try between L1 and Redis, returning
+    ``(value, ttl)`` or None, or returns None to skip it. The secondary uses it
+    to answer from its zone image, keeping every key in a batch on one image.
+    """
+
+    def __init__(self, store, local_cache, shared_cache, access, default_ttl, pinned_source=None):
+        self.store = store
+        self.local_cache = local_cache
+        self.shared_cache = shared_cache
+        self.access = access
+        self.default_ttl = default_ttl  # Seconds records without their own TTL stay in Redis
+        self.pinned_source = pinned_source
+        self.miss_flights = record_cache.SingleFlight()
+
+    def _redis_hit(self, cache_key, cached_value, remaining, cache_version):
+        """Copy a value found in Redis into L1, for no longer than Redis keeps it, and return ``(value, ttl)``.
+
+        The TTL to answer with is the time Redis has left on the key, which never
+        exceeds the record's own TTL. Returns ``(None, None)`` for a cached miss.
+        """
+        metrics.inc("dns_cache_lookups_total", 'layer="redis",result="hit"')
+        if cached_value == record_cache.NEGATIVE_ENTRY:
+            self.local_cache.set_negative(cache_key, version=cache_version)
+            return None, None
+        record_ttl = math.ceil(remaining) if remaining else None
+        self.local_cache.set(cache_key, cached_value, ttl=remaining, version=cache_version, record_ttl=record_ttl)
+        return cached_value, record_ttl
+
+    def read_record(self, domain, record_type, cache_version):
+        """Read ``(value, ttl)`` from SQLite, falling back to wildcards, and cache the answer in Redis and L1."""
+        cache_key = f"{domain}:{record_type}"
+        started = time.perf_counter()
+        record = self.store.fetch_record(domain, record_type)
+        metrics.observe("dns_sqlite_query_seconds", 'query="record"', time.perf_counter() - started)
+        if record is not None:
+            value, ttl = record
+            self.shared_cache.fill(cache_key, value, ttl or self.default_ttl)
+            self.local_cache.set(cache_key, value, ttl=ttl, version=cache_version, record_ttl=ttl)
+            return value, ttl
+
+        # Changing a wildcard does not invalidate the names it answered for, so
+        # synthesised answers are cached no longer than misses are
+        started = time.perf_counter()
+        value = self.store.find_wildcard(domain, record_type)
+        metrics.observe("dns_sqlite_query_seconds", 'query="wildcard"', time.perf_counter() - started)
+        negative_ttl = self.local_cache.negative_ttl
+        if negative_ttl > 0:
+            cached_value = record_cache.NEGATIVE_ENTRY if value is None else value
+            # NX so this never overwrites a value an ADD cached after our read
+            self.shared_cache.fill_if_absent(cache_key, cached_value, negative_ttl)
+            self.local_cache.set(cache_key, cached_value, ttl=negative_ttl, version=cache_version)
+        return value, None
+
+    def load_record(self, domain, record_type, cache_version):
+        """Fetch ``(value, ttl)`` for a record missing from both caches, sharing another process's in-flight read."""
+        cache_key = f"{domain}:{record_type}"
+        token = None
+        if self.shared_cache.fill_lock_ms and self.shared_cache.available():
+            token = self.shared_cache.lock_fill(cache_key)
+            if token is None:
+                cached_value, remaining = self.shared_cache.wait_for_fill(cache_key)
+                if cached_value:
+                    metrics.inc("dns_coalesced_misses_total", 'scope="redis"')
+                    return self._redis_hit(cache_key, cached_value, remaining, cache_version)
+        try:
+            return self.read_record(domain, record_type, cache_version)
+        finally:
+            if token is not None:
+                self.shared_cache.unlock_fill(cache_key, token)
+
+    def cached_records(self, keys):
+        """Look ``(domain, record_type)`` keys up in L1, the pinned source, then Redis, with one Redis round trip.
+
+        Returns ``(value, True, ttl)`` per key found in any of them (a None value for
+        a cached miss), or None where none has the key.
+        """
+        results = [None] * len(keys)
+        cache_keys = []
+        missing = []
+        pinned = self.pinned_source() if self.pinned_source else None
+        for index, (domain, record_type) in enumerate(keys):
+            cache_key = f"{domain}:{record_type}"
+            self.access.touch(cache_key)
+            local_entry = self.local_cache.get_entry(cache_key)
+            if local_entry is not None:
+                local_value, record_ttl = local_entry
+                results[index] = (None if local_value == record_cache.NEGATIVE_ENTRY else local_value), True, record_ttl
+                continue
+            record = pinned(domain, record_type) if pinned else None
+            if record is not None:
+                results[index] = record[0], True, record[1]
+                continue
+            cache_keys.append(cache_key)
+            missing.append(index)
+        if not missing:
+            return results
+
+        cache_version = self.local_cache.version()
+        for index, cache_key, (cached_value, remaining) in zip(missing, cache_keys,
+                                                               self.shared_cache.get_many(cache_keys)):
+            if cached_value:
+                value, record_ttl = self._redis_hit(cache_key, cached_value, remaining, cache_version)
+                results[index] = value, True, record_ttl
+        return results
+
+    def lookup_record(self, domain, record_type):
+        """Return ``(value, from_cache, ttl)`` for a record, or ``(None, from_cache, None)`` if it does not exist.
+
+        ``ttl`` is None where no TTL is known, such as for a record without one of its own.
+        """
+        cache_version = self.local_cache.version()
+        cached = self.cached_records([(domain, record_type)])[0]
+        if cached is not None:
+            return cached
+        metrics.inc("dns_cache_lookups_total", 'layer="redis",result="miss"')
+        # Concurrent misses for the same record wait for one SQLite read. Keying by the
+        # cache version keeps a lookup that started after a write from sharing an older read.
+        (value, ttl), shared = self.miss_flights.do((f"{domain}:{record_type}", cache_version),
+                                                    lambda: self.load_record(domain, record_type, cache_version))
+        if shared:
+            metrics.inc("dns_coalesced_misses_total", 'scope="process"')
+        return value, False, ttl
+
+    def domain_exists(self, domain):
+        """Return True if ``domain`` has a record of any type, caching the answer in L1 as long as a miss."""
+        cache_key = domain + record_cache.NAME_KEY_SUFFIX
+        exists = self.local_cache.get(cache_key)
+        if exists is not None:
+            return exists
+        cache_version = self.local_cache.version()
+        exists = self.store.domain_exists(domain)
+        if self.local_cache.negative_ttl > 0:
+            self.local_cache.set(cache_key, exists, ttl=self.local_cache.negative_ttl, version=cache_version)
+        return exists
+
+    def query_record(self, domain, record_type):
+        """Query a DNS record from the cache or database."""
+        try:
+            value, from_cache, _ = self.lookup_record(domain, record_type)
+            if value is None:
+                return "Record not found."
+            if from_cache:
+                return f"DNS Response (from cache): {record_type} record for {domain} -> {value}"
+            return f"DNS Response: {record_type} record for {domain} -> {value}"
+        except Exception as e:
+            return f"[ERROR] Failed to query record: {e}"
+
+    def list_zone(self, zone, limit=zone_io.DEFAULT_LIST_LIMIT):
+        """List the records in ``zone`` and below it, in reversed-label order."""
+        if not zone.strip("."):
+            return "[ERROR] LIST needs a zone, for example LIST:example.com"
+        records = self.store.list_zone(zone, min(limit, zone_io.MAX_LIST_LIMIT))
+        return zone_io.format_listing(zone, records)
+
+    def scan_records(self, after, limit, record_type=None, prefix=""):
+        """Return one SCAN page of the records after the ``after`` key, in name order."""
+        # One extra row tells whether another page exists
+        records = self.store.scan(after, limit + 1, record_type, prefix)
+        if len(records) <= limit:
+            return zone_io.format_scan(records, "")
+        records = records[:limit]
+        return zone_io.format_scan(records, zone_io.format_scan_cursor(*records[-1][:2]))
+
+    def warm_caches(self, hot_keys_file, budget):
+        """Load the records that were hottest before the restart into Redis and L1, within ``budget`` seconds."""
+        cache_keys = self.access.load(hot_keys_file)
+        if not cache_keys or budget <= 0:
+            return
+        started = time.monotonic()
+        count = redis_cache.warm_up(self.shared_cache, self.store.fetch_record, cache_keys, self.default_ttl, budget,
+                                    on_load=lambda cache_key, value, ttl: self.local_cache.set(cache_key, value,
+                                                                                               ttl=ttl, record_ttl=ttl))
+        print(f"[INFO] Warmed {count} of {len(cache_keys)} hot records in {time.monotonic() - started:.1f}s.")
+
+    def process_query(self, query, add_record, delete_record, commands=None):
+        """Parse a text protocol request and dispatch it to the matching operation.
+
+        Writes go to the server's own ``add_record(domain, record_type, value, ttl)``
+        and ``delete_record(domain, record_type)``. ``commands`` maps further
+        request prefixes to handlers that take the whole request.
+        """
+        for prefix, handler in (commands or {}).items():
+            if query.startswith(prefix):
+                return handler(query)
+        if query.startswith(("ADD:", "UPDATE:")):
+            command = query.partition(":")[0]
+            try:
+                return add_record(*zone_io.parse_write_query(query))
+            except ValueError:
+                return (f"[ERROR] Malformed {command} query. Use the format: "
+                        f"{command}:<domain>:<record_type>:<value>[:<ttl>] "
+                        "(a numeric last field is the TTL; end the value with ':' to keep it)")
+        elif query.startswith("DELETE:"):
+            try:
+                _, domain, record_type = query.split(":")
+                return delete_record(zone_io.normalize_name(domain), record_type.upper())
+            except ValueError:
+                return "[ERROR] Malformed DELETE query. Use the format: DELETE:<domain>:<record_type>"
+        elif query.startswith("LIST:"):
+            try:
+                fields = query.split(":")
+                if len(fields) == 2:
+                    return self.list_zone(zone_io.normalize_name(fields[1]))
+                _, zone, limit = fields
+                return self.list_zone(zone_io.normalize_name(zone), int(limit))
+            except ValueError:
+                return "[ERROR] Malformed LIST query. Use the format: LIST:<zone>[:<limit>]"
+        elif query.startswith("SCAN:"):
+            try:
+                return self.scan_records(*zone_io.parse_scan_query(query))
+            except ValueError:
+                return "[ERROR] Malformed SCAN query. Use the format: SCAN:[<cursor>][:<limit>[:<type>[:<prefix>]]]"
+        else:
+            try:
+                domain, record_type = query.split(":")
+                return self.query_record(zone_io.normalize_name(domain), record_type.upper())
+            except ValueError:
+                return "[ERROR] Malformed query. Use the format: <domain>:<record_type>"
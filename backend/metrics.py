@@ -0,0 +1,249 @@
+"""Process-wide counters, latency histograms and gauges for the DNS servers.
+
+Hot paths only touch a dictionary owned by the calling thread, so recording
+never takes a lock or contends with other threads. ``collect()`` merges the
+per-thread shards when someone asks for the numbers, through the ``STATS``
+command or the optional Prometheus text endpoint (``--metrics-port``).
+"""
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMANDS = ("ADD", "UPDATE", "DELETE", "CHANGES", "LIST", "SCAN")
+STATS_COMMAND = "STATS"
+RETIRE_EVERY = 256  # New per-thread shards between folds of exited threads' shards
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def command_label(query):
+    """Return the ``command="..."`` label for a text protocol request."""
+    head = query.partition(":")[0].strip()
+    command = head if head in COMMANDS or head == STATS_COMMAND else "QUERY"
+    return f'command="{command}"'
+
+
+class Registry:
+    """Thread-sharded metric storage.
+
+    Counters and histograms are keyed by ``(name, labels)``, where ``labels`` is
+    a preformatted Prometheus label string such as ``command="ADD"``. Gauges
+    are callables evaluated at collection time.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) for every thread that recorded anything
+        self._retired = {}  # Totals folded in from threads that have exited
+        self._lock = threading.Lock()
+        self._new_shards = 0
+        self._descriptions = {}
+        self._gauges = {}
+        self._ratios = {}
+
+    def describe(self, name, kind, help_text):
+        """Set the Prometheus type (counter, gauge or histogram) and help text for ``name``."""
+        self._descriptions[name] = (kind, help_text)
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                self._new_shards += 1
+                if self._new_shards >= RETIRE_EVERY:
+                    self._retire_dead()
+        return shard
+
+    def _retire_dead(self):
+        """Fold the shards of exited threads into ``_retired``; called with the lock held."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard)
+        self._shards = alive
+        self._new_shards = 0
+
+    def inc(self, name, labels="", amount=1):
+        """Add ``amount`` to a counter, or to an up/down gauge when ``amount`` is negative."""
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        """Record one duration in a histogram."""
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(BUCKETS) + 1) + [0.0]  # Bucket counts, +Inf, then the sum
+        counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        counts[-1] += seconds
+
+    def gauge(self, name, help_text, function):
+        """Register ``function`` as a gauge; it returns a number or a ``{labels: number}`` dict."""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = function
+
+    def ratio(self, name, help_text, counter, hit_labels, miss_labels):
+        """Register a gauge reporting ``hits / (hits + misses)`` of one counter's two label sets."""
+        self.describe(name, "gauge", help_text)
+        self._ratios[name] = (counter, hit_labels, miss_labels)
+
+    def collect(self):
+        """Return ``(values, gauges)``: merged counters/histograms and evaluated gauges."""
+        with self._lock:
+            self._retire_dead()
+            shards = [shard for _, shard in self._shards]
+            values = _merge({}, self._retired)
+        for shard in shards:
+            _merge(values, shard)
+        gauges = {}
+        for name, (counter, hit_labels, miss_labels) in self._ratios.items():
+            hits = values.get((counter, hit_labels), 0)
+            lookups = hits + values.get((counter, miss_labels), 0)
+            gauges[(name, "")] = round(hits / lookups, 4) if lookups else 0.0
+        for name, function in self._gauges.items():
+            try:
+                result = function()
+            except Exception:
+                continue  # A gauge whose source is down (say, Redis) is simply omitted
+            if isinstance(result, dict):
+                gauges.update(((name, labels), value) for labels, value in result.items())
+            elif result is not None:
+                gauges[(name, "")] = result
+        return values, gauges
+
+    def render_prometheus(self):
+        """Render every metric in the Prometheus text exposition format."""
+        values, gauges = self.collect()
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(list(values.items()) + list(gauges.items()), key=lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                kind, help_text = self._descriptions.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, list):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    bucket_label = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{_labels(labels, bucket_label)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def render_stats(self):
+        """Render a JSON summary for the STATS command, with estimated latency percentiles."""
+        values, gauges = self.collect()
+        counters, histograms = {}, {}
+        for (name, labels), value in sorted(values.items()):
+            key = f"{name}{_labels(labels)}"
+            if isinstance(value, list):
+                count = sum(value[:-1])
+                histograms[key] = {
+                    "count": count,
+                    "mean_ms": round(value[-1] / count * 1000, 3) if count else 0.0,
+                    "p50_ms": _percentile_ms(value, 0.50),
+                    "p95_ms": _percentile_ms(value, 0.95),
+                    "p99_ms": _percentile_ms(value, 0.99),
+                }
+            else:
+                counters[key] = value
+        return json.dumps({
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "counters": counters,
+            "gauges": {f"{name}{_labels(labels)}": value for (name, labels), value in sorted(gauges.items())},
+            "histograms": histograms,
+        }, indent=2)
+
+
+def _merge(into, shard):
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            current = into.get(key)
+            into[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            into[key] = into.get(key, 0) + value
+    return into
+
+
+def _labels(*parts):
+    joined = ",".join(part for part in parts if part)
+    return f"{{{joined}}}" if joined else ""
+
+
+def _percentile_ms(counts, quantile):
+    """Estimate a percentile by interpolating inside the histogram bucket that contains it."""
+    total = sum(counts[:-1])
+    if not total:
+        return 0.0
+    rank = quantile * total
+    cumulative = 0
+    lower = 0.0
+    for index, count in enumerate(counts[:-1]):
+        upper = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+        if count and cumulative + count >= rank:
+            return round((lower + (upper - lower) * (rank - cumulative) / count) * 1000, 3)
+        cumulative += count
+        lower = upper
+    return round(BUCKETS[-1] * 1000, 3)
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+gauge = registry.gauge
+ratio = registry.ratio
+describe = registry.describe
+
+describe("dns_request_duration_seconds", "histogram", "Time to answer a text protocol request, by command")
+describe("dns_stream_duration_seconds", "histogram", "Time spent in a streaming command such as BULK or SNAPSHOT")
+describe("dns_connections_active", "gauge", "Client connections currently open")
+describe("dns_connections_total", "counter", "Client connections accepted")
+describe("dns_cache_lookups_total", "counter", "Record lookups by cache layer and result")
+describe("dns_sqlite_query_seconds", "histogram", "Time spent in SQLite reads on the query path")
+describe("dns_sqlite_commit_seconds", "histogram", "Time spent committing record changes to SQLite")
+describe("dns_redis_command_seconds", "histogram", "Round trip time of Redis cache operations, by operation")
+describe("dns_refresh_ahead_total", "counter", "Hot records reloaded before their Redis keys expired")
+describe("dns_coalesced_misses_total", "counter", "Cache misses answered by another request's SQLite read, by scope")
+describe("dns_request_queue_seconds", "histogram", "Time requests waited for a worker thread")
+describe("dns_requests_shed_total", "counter", "Requests answered BUSY without running, by reason")
+ratio("dns_redis_hit_ratio", "Share of Redis lookups on the query path that found the record",
+      "dns_cache_lookups_total", 'layer="redis",result="hit"', 'layer="redis",result="miss"')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown out the server's own log
+
+
+def start_http_server(host, port):
+    """Serve ``/metrics`` in the Prometheus text format from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[INFO] Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
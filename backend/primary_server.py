@@ -1,23 +1,52 @@
-import socket
+import os
 import redis
-import sqlite3
 import threading
 import signal
 import sys
+import time
+
+import dns_wire
+import lookup
+import metrics
+import record_cache
+import redis_cache
+import replication
+import server_core
+import storage
+import write_pipeline
+import zone_io
 
 DB_FILE = "dns_records.db"
+REDIS_URL = os.environ.get("DNS_REDIS_URL", "redis://localhost:6379/0")
 REDIS_CHANNEL = "dns_updates"
 PENDING_UPDATES_KEY = "pending_updates"
+CACHE_TTL = 3600  # Seconds records without their own TTL stay in Redis
+BULK_BATCH_SIZE = 5000
+PENDING_BATCH_SIZE = 500
+MAINTENANCE_INTERVAL = 30  # Seconds between pending-update drains and change log trims
+DEFAULT_CHANGE_LOG_RETENTION = 1000000  # Changes kept for secondaries to catch up from
 
 # Connect to Redis
 try:
-    redis_client = redis.StrictRedis(host='localhost', port=6379, decode_responses=True)
+    redis_client = redis.StrictRedis.from_url(REDIS_URL, decode_responses=True)
     redis_client.ping()  # Check if Redis is running
     print("[INFO] Connected to Redis successfully.")
 except redis.ConnectionError as e:
     print(f"[ERROR] Could not connect to Redis: {e}")
     sys.exit(1)
 
+# Pooled SQLite connections, the in-process L1 cache and the shared Redis cache behind it
+store = storage.RecordStore(DB_FILE, change_log=True)
+local_cache = record_cache.RecordCache()
+shared_cache = redis_cache.RedisCache(redis_client, REDIS_CHANNEL, PENDING_UPDATES_KEY)
+# Approximate lookup counts per record, for refresh-ahead and the warm-up after a restart
+access = record_cache.AccessSketch()
+# Reloads hot records before their Redis keys expire
+refresher = redis_cache.RefreshAhead(shared_cache, store.fetch_record, CACHE_TTL, access,
+                                     on_change=local_cache.invalidate)
+# The L1, Redis and SQLite read path, and the text protocol commands both servers share
+records = lookup.RecordLookup(store, local_cache, shared_cache, access, CACHE_TTL)
+
 # Graceful exit handler
 def handle_exit(signal, frame):
     print("\n[INFO] Shutting down Primary DNS Server...")
@@ -27,149 +56,231 @@ signal.signal(signal.SIGINT, handle_exit)
 
 def init_db():
     """Initialize the SQLite database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS dns_records (
-            domain TEXT NOT NULL,
-            record_type TEXT NOT NULL,
-            value TEXT NOT NULL,
-            PRIMARY KEY (domain, record_type)
-        )
-    """)
-    conn.commit()
-    conn.close()
+    store.init_db()
     print("[INFO] SQLite database initialized.")
 
-def add_record(domain, record_type, value):
-    """Add a DNS record to the database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO dns_records (domain, record_type, value) VALUES (?, ?, ?)
-    """, (domain, record_type, value))
-    conn.commit()
-    conn.close()
-
-    cache_key = f"{domain}:{record_type}"
-    redis_client.setex(cache_key, 3600, value)
-    redis_client.publish(REDIS_CHANNEL, f"ADD:{domain}:{record_type}:{value}")
-    return f"Record added: {record_type} record for {domain} -> {value}"
-
-def update_record(domain, record_type, value):
-    """Update a DNS record in the database."""
-    return add_record(domain, record_type, value)
+def publish_changes(pipe, mutations, serials):
+    """Queue the cache updates and serial-tagged replication notices for a committed batch."""
+    for (action, domain, record_type, value, ttl), serial in zip(mutations, serials):
+        cache_key = f"{domain}:{record_type}"
+        if action == "DELETE":
+            pipe.delete(cache_key)
+        else:
+            pipe.setex(cache_key, ttl or CACHE_TTL, value)
+        pipe.publish(REDIS_CHANNEL, replication.format_update(action, domain, record_type, value, serial, ttl))
+
+# Batches concurrent ADD/UPDATE/DELETE requests into group commits
+writer = write_pipeline.GroupCommitWriter(store, shared_cache, publish_changes)
+
+def add_record(domain, record_type, value, ttl=None):
+    """Add a DNS record to the database, optionally with its own TTL in seconds."""
+    writer.submit("ADD", domain, record_type, value, ttl).result()
+    local_cache.invalidate(f"{domain}:{record_type}")
+    return f"Record added: {record_type} record for {domain} -> {value}" + (f" (TTL {ttl}s)" if ttl else "")
 
 def delete_record(domain, record_type):
     """Delete a DNS record from the database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        DELETE FROM dns_records WHERE domain = ? AND record_type = ?
-    """, (domain, record_type))
-    conn.commit()
-    conn.close()
-
-    cache_key = f"{domain}:{record_type}"
-    redis_client.delete(cache_key)
-    redis_client.publish(REDIS_CHANNEL, f"DELETE:{domain}:{record_type}")
+    writer.submit("DELETE", domain, record_type).result()
+    local_cache.invalidate(f"{domain}:{record_type}")
     return f"Record deleted: {record_type} record for {domain}"
 
-def query_record(domain, record_type):
-    """Query a DNS record from the cache or database."""
-    cache_key = f"{domain}:{record_type}"
-    cached_value = redis_client.get(cache_key)
-    if cached_value:
-        return f"DNS Response (from cache): {record_type} record for {domain} -> {cached_value}"
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT value FROM dns_records WHERE domain = ? AND record_type = ?
-    """, (domain, record_type))
-    result = cursor.fetchone()
-    conn.close()
-
-    if result:
-        redis_client.setex(cache_key, 3600, result[0])
-        return f"DNS Response: {record_type} record for {domain} -> {result[0]}"
-    return "Record not found."
+def bulk_import(header, stream):
+    """Stream a BULK:<format> upload into SQLite, Redis and the secondaries in batches."""
+    fmt = header.partition(":")[2] or "zone"
+    if fmt not in zone_io.FORMATS:
+        stream.write(f"[ERROR] Unknown bulk format '{fmt}'. Use one of: {', '.join(zone_io.FORMATS)}".encode())
+        return
+    total = 0
+    for batch in zone_io.batched(zone_io.parse_records(stream, fmt), BULK_BATCH_SIZE):
+        serials = store.bulk_upsert(batch)
+        pipe = shared_cache.pipeline()
+        for domain, record_type, value, ttl in batch:
+            pipe.setex(f"{domain}:{record_type}", ttl or CACHE_TTL, value)
+        # One notice per batch: newline-separated update messages
+        pipe.publish(REDIS_CHANNEL, "\n".join(replication.format_update("ADD", domain, record_type, value, serial, ttl)
+                                              for (domain, record_type, value, ttl), serial in zip(batch, serials)))
+        pipe.execute()
+        for domain, record_type, _, _ in batch:
+            local_cache.invalidate(f"{domain}:{record_type}")
+        total += len(batch)
+    print(f"[INFO] Bulk import loaded {total} records.")
+    stream.write(f"Bulk import complete: {total} records loaded".encode())
+
+def bulk_export(header, stream):
+    """Stream every record to the client as a zone file or CSV, one batch at a time."""
+    fmt = header.partition(":")[2] or "zone"
+    if fmt not in zone_io.FORMATS:
+        stream.write(f"[ERROR] Unknown export format '{fmt}'. Use one of: {', '.join(zone_io.FORMATS)}".encode())
+        return
+    if fmt == "csv":
+        stream.write(zone_io.format_records([zone_io.CSV_HEADER], fmt).encode())
+    for batch in store.iter_records(BULK_BATCH_SIZE):
+        stream.write(zone_io.format_records(batch, fmt).encode())
+
+def stream_snapshot(header, stream):
+    """Stream a consistent, compressed snapshot of every record, tagged with its change log serial."""
+    if header != replication.SNAPSHOT_COMMAND:
+        stream.write(f"[ERROR] Unsupported snapshot request. Use: {replication.SNAPSHOT_COMMAND}".encode())
+        return
+    snapshot = store.snapshot(replication.SNAPSHOT_BATCH_SIZE)
+    try:
+        serial = next(snapshot)
+        stream.write(f"SNAPSHOT:{serial}\n".encode())
+        count = 0
+        for rows in snapshot:
+            stream.write(replication.encode_snapshot_chunk(rows))
+            count += len(rows)
+        stream.write(replication.SNAPSHOT_END)
+        print(f"[INFO] Streamed a snapshot of {count} records at serial {serial}.")
+    finally:
+        snapshot.close()
+
+def get_changes(after_serial, limit):
+    """Return the change log entries after ``after_serial`` for a catching-up secondary."""
+    limit = min(limit, replication.MAX_CATCH_UP_BATCH)
+    if after_serial < store.oldest_serial() - 1:
+        return f"[ERROR] RESYNC: change log starts at serial {store.oldest_serial()}, requested {after_serial + 1}"
+    changes = store.fetch_changes(after_serial, limit)
+    # Read the high-water mark afterwards so it never trails the returned changes
+    return replication.format_changes(changes, store.latest_serial())
 
 def handle_pending_updates():
-    """Process pending updates from the secondary server."""
-    print("[INFO] Checking for pending updates from the secondary server...")
+    """Process pending updates from the secondary server in batches."""
     while True:
-        update = redis_client.rpop(PENDING_UPDATES_KEY)
-        if not update:
-            break  # No more pending updates
+        # Atomically take the oldest entries, which sit at the tail of the list
+        pipe = redis_client.pipeline()
+        pipe.lrange(PENDING_UPDATES_KEY, -PENDING_BATCH_SIZE, -1)
+        pipe.ltrim(PENDING_UPDATES_KEY, 0, -PENDING_BATCH_SIZE - 1)
+        updates, _ = pipe.execute()
+        if not updates:
+            break
 
+        submitted = []
+        for update in reversed(updates):
+            try:
+                _, action, domain, record_type, value, ttl = replication.parse_update(update)
+                future = writer.submit(action, domain, record_type, value, ttl)
+                submitted.append((update, f"{domain}:{record_type}", future))
+            except ValueError as e:
+                print(f"[WARN] {e}")
+        for update, cache_key, future in submitted:
+            try:
+                future.result()
+                local_cache.invalidate(cache_key)
+                print(f"[INFO] Processed pending update: {update}")
+            except Exception as e:
+                print(f"[ERROR] Failed to process pending update: {update} | Error: {e}")
+
+def run_maintenance(retention):
+    """Periodically drain pending updates and trim the change log."""
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
         try:
-            action, domain, record_type, *value = update.split(":")
-            if action == "ADD" or action == "UPDATE":
-                add_record(domain, record_type, value[0])
-                print(f"[INFO] Processed {action.lower()} for {domain}:{record_type} -> {value[0]}")
-            elif action == "DELETE":
-                delete_record(domain, record_type)
-                print(f"[INFO] Processed delete for {domain}:{record_type}")
-            else:
-                print(f"[WARN] Unknown action in pending update: {update}")
+            handle_pending_updates()
+            removed = store.trim_change_log(retention)
+            if removed:
+                print(f"[INFO] Trimmed {removed} entries from the change log.")
         except Exception as e:
-            print(f"[ERROR] Failed to process pending update: {update} | Error: {e}")
+            print(f"[ERROR] Maintenance failed: {e}")
 
-def handle_client(client_socket, client_address):
-    """Handle incoming client requests."""
-    print(f"[INFO] Connection established with {client_address}")
+def listen_for_invalidations():
+    """Drop in-process cache entries for records changed by any server, resubscribing if Redis drops us."""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(REDIS_CHANNEL)
+            local_cache.clear()  # Notices sent while we were not subscribed are lost
+            for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                for update_message in message["data"].splitlines():  # Bulk loads publish one batched notice
+                    try:
+                        _, _, domain, record_type, _, _ = replication.parse_update(update_message)
+                        local_cache.invalidate(f"{domain}:{record_type}")
+                    except ValueError:
+                        print(f"[WARN] Ignoring malformed update message: {update_message}")
+        except redis_cache.UNAVAILABLE as e:
+            print(f"[WARN] Lost the Redis update channel: {e}. Reconnecting...")
+            local_cache.clear()  # Nothing invalidates it while we are not subscribed
+            time.sleep(1)
+
+def changes_query(query):
+    """Answer ``CHANGES:<after_serial>:<limit>`` for a catching-up secondary."""
     try:
-        query = client_socket.recv(1024).decode()
-        if query.startswith("ADD:"):
-            try:
-                _, domain, record_type, value = query.split(":")
-                response = add_record(domain, record_type, value)
-            except ValueError:
-                response = "[ERROR] Malformed ADD query. Use the format: ADD:<domain>:<record_type>:<value>"
-        elif query.startswith("UPDATE:"):
-            try:
-                _, domain, record_type, value = query.split(":")
-                response = update_record(domain, record_type, value)
-            except ValueError:
-                response = "[ERROR] Malformed UPDATE query. Use the format: UPDATE:<domain>:<record_type>:<value>"
-        elif query.startswith("DELETE:"):
-            try:
-                _, domain, record_type = query.split(":")
-                response = delete_record(domain, record_type)
-            except ValueError:
-                response = "[ERROR] Malformed DELETE query. Use the format: DELETE:<domain>:<record_type>"
-        else:
-            try:
-                domain, record_type = query.split(":")
-                response = query_record(domain, record_type)
-            except ValueError:
-                response = "[ERROR] Malformed query. Use the format: <domain>:<record_type>"
-        client_socket.sendall(response.encode())
-    except Exception as e:
-        print(f"[ERROR] {e}")
-        client_socket.sendall(f"[ERROR] Internal server error: {e}".encode())
-    finally:
-        client_socket.close()
-        print(f"[INFO] Connection closed with {client_address}")
+        _, after_serial, limit = query.split(":")
+        return get_changes(int(after_serial), int(limit))
+    except ValueError:
+        return "[ERROR] Malformed CHANGES query. Use the format: CHANGES:<after_serial>:<limit>"
+
+def process_query(query):
+    """Parse a text protocol request and dispatch it to the matching operation."""
+    return records.process_query(query, add_record, delete_record, {"CHANGES:": changes_query})
+
+def register_metrics():
+    """Expose the primary's caches, write pipeline and pending queue as gauges."""
+    metrics.gauge("dns_l1_cache_entries", "Records held in the in-process cache", lambda: local_cache.stats()["entries"])
+    metrics.gauge("dns_l1_cache_hit_ratio", "Share of in-process cache lookups that hit",
+                  lambda: local_cache.stats()["hit_ratio"])
+    metrics.gauge("dns_pending_updates", "Secondary writes waiting in the pending_updates list",
+                  shared_cache.pending_count)
+    metrics.gauge("dns_group_commit_batches", "Group commits since startup", lambda: writer.batches)
+    metrics.gauge("dns_group_commit_mutations", "Mutations committed since startup", lambda: writer.mutations)
+    metrics.gauge("dns_unpublished_mutations", "Committed mutations waiting for Redis to come back",
+                  writer.unpublished)
+
+def add_arguments(parser):
+    """Add the primary-only command line options."""
+    parser.add_argument("--batch-size", type=int, default=write_pipeline.DEFAULT_MAX_BATCH,
+                        help=f"Most mutations committed in one transaction (default: {write_pipeline.DEFAULT_MAX_BATCH})")
+    parser.add_argument("--batch-delay-ms", type=float, default=write_pipeline.DEFAULT_MAX_DELAY * 1000,
+                        help="Milliseconds to wait for more writes before committing a batch "
+                             f"(default: {write_pipeline.DEFAULT_MAX_DELAY * 1000:g})")
+    parser.add_argument("--change-log-retention", type=int, default=DEFAULT_CHANGE_LOG_RETENTION,
+                        help="Change log entries kept for secondaries to catch up from "
+                             f"(default: {DEFAULT_CHANGE_LOG_RETENTION})")
 
-def start_server():
-    """Start the primary DNS server."""
+def start_server(options=None):
+    """Start the primary DNS server, as a supervisor of ``--processes`` workers when there are several."""
+    options = options or server_core.parse_args("Primary DNS Server", 8053, argv=[], configure=add_arguments)
     init_db()
-    handle_pending_updates()  # Process pending updates on startup
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(("127.0.0.1", 8053))
-    server_socket.listen(5)
-    print("[INFO] Primary DNS Server is listening on 127.0.0.1:8053...")
-    try:
-        while True:
-            client_socket, client_address = server_socket.accept()
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-            client_thread.start()
-    except KeyboardInterrupt:
-        print("\n[INFO] Server shutting down...")
-    finally:
-        server_socket.close()
+    # Before forking, so every worker starts with the warmed in-process cache
+    local_cache.configure(max_entries=options.l1_size, ttl=options.l1_ttl, negative_ttl=options.negative_ttl)
+    access.capacity = options.hot_keys
+    records.warm_caches(options.hot_keys_file, options.warm_up_budget)
+    if options.processes > 1:
+        store.close()  # Each forked worker opens its own SQLite connections
+        server_core.supervise("Primary DNS Server", options.processes, lambda index: run_worker(options, index))
+    else:
+        run_worker(options)
+
+def run_worker(options, index=0):
+    """Serve requests in this process; only worker 0 drains pending updates, trims the change log and saves hot keys."""
+    shared_cache.fill_lock_ms = options.fill_lock_ms
+    refresher.start(options.refresh_interval)
+    writer.max_batch = options.batch_size
+    writer.max_delay = options.batch_delay_ms / 1000
+    reuse_port = options.processes > 1
+    register_metrics()
+    if options.metrics_port:
+        metrics.start_http_server(options.host, options.metrics_port + index)
+    writer.start()
+    if index == 0:
+        print("[INFO] Checking for pending updates from the secondary server...")
+        handle_pending_updates()  # Process pending updates on startup
+        access.start_saving(options.hot_keys_file)
+        threading.Thread(target=run_maintenance, args=(options.change_log_retention,), daemon=True).start()
+    threading.Thread(target=listen_for_invalidations, daemon=True).start()
+    if options.dns_port:
+        wire_server = dns_wire.WireServer(records.lookup_record, records.domain_exists, records.cached_records)
+        wire_server.start(options.host, options.dns_port, options.dns_udp_workers, reuse_port,
+                          options.max_connections)
+    server_core.serve(process_query, (options.host, options.port), "Primary DNS Server",
+                      mode=options.mode, backlog=options.backlog, workers=options.workers,
+                      queue_depth=options.queue_depth, deadline=options.request_deadline_ms / 1000,
+                      stream_handlers={"BULK:": bulk_import, "EXPORT:": bulk_export,
+                                       "SNAPSHOT:": stream_snapshot},
+                      reuse_port=reuse_port, drain_timeout=options.drain_timeout,
+                      max_connections=options.max_connections)
 
 if __name__ == "__main__":
-    start_server()
+    start_server(server_core.parse_args("Primary DNS Server", 8053, configure=add_arguments))
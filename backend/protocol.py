@@ -0,0 +1,398 @@
+"""Wire protocol helpers shared by the DNS servers and their clients.
+
+Version 1 is the original text protocol: one request per connection, answered
+and closed by the server. Version 2 keeps the same request strings but carries
+them in length-prefixed frames tagged with a request ID, so many requests can be
+in flight on one long-lived connection and answered out of order.
+
+A v2 client opens with ``MAGIC``. A v2 server echoes it back; a v1 server treats
+it as a malformed query, answers with an error and closes, which tells the
+client to fall back to one-shot v1 requests.
+"""
+import itertools
+import socket
+import struct
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+MAGIC = b"\x00DNS2"  # Never a valid v1 request, which always starts with printable text
+HEADER = struct.Struct("!II")  # request_id, payload length
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_POOL_SIZE = 2
+BUSY_TAG = "[BUSY]"  # Starts every response to a request, or connection, the server turned away
+LEGACY_WORKERS = 16  # Threads that carry one-shot v1 requests for pools against old servers
+CONNECT_WORKERS = 4  # Threads that open pooled connections, so submit() never waits on a connect
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that is not a valid v2 frame."""
+
+
+class ProtocolNotSupported(ConnectionError):
+    """Raised when the server only speaks the v1 protocol."""
+
+
+def is_v2_preamble(data):
+    """Return True if the first bytes read from a client start a v2 handshake."""
+    return data[:1] == MAGIC[:1]
+
+
+def encode_frame(request_id, message):
+    """Encode a request or response string as a v2 frame."""
+    payload = message.encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(request_id, len(payload)) + payload
+
+
+class FrameReader:
+    """Read v2 frames from a blocking socket."""
+
+    def __init__(self, sock, initial=b""):
+        self._sock = sock
+        self._buffer = bytearray(initial)
+
+    def _fill(self, size):
+        while len(self._buffer) < size:
+            chunk = self._sock.recv(max(65536, size - len(self._buffer)))
+            if not chunk:
+                return False
+            self._buffer += chunk
+        return True
+
+    def expect_preamble(self):
+        """Consume the v2 handshake bytes, raising ProtocolError if they do not match."""
+        if not self._fill(len(MAGIC)) or bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ProtocolError("Invalid protocol preamble")
+        del self._buffer[:len(MAGIC)]
+
+    def read_frame(self):
+        """Return the next ``(request_id, message)`` pair, or None on a clean EOF."""
+        if not self._fill(HEADER.size):
+            if self._buffer:
+                raise ProtocolError("Connection closed in the middle of a frame header")
+            return None
+        request_id, length = HEADER.unpack_from(self._buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        end = HEADER.size + length
+        if not self._fill(end):
+            raise ProtocolError("Connection closed in the middle of a frame")
+        payload = bytes(self._buffer[HEADER.size:end])
+        del self._buffer[:end]
+        return request_id, payload.decode()
+
+
+async def read_frame_async(reader):
+    """Return the next ``(request_id, message)`` pair from an asyncio stream, or None on EOF."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except EOFError as e:  # asyncio.IncompleteReadError
+        if e.partial:
+            raise ProtocolError("Connection closed in the middle of a frame header")
+        return None
+    request_id, length = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    try:
+        payload = await reader.readexactly(length)
+    except EOFError:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return request_id, payload.decode()
+
+
+def _settle(future, result=None, error=None):
+    """Resolve ``future`` with ``result`` or ``error``, unless it is already done (say, cancelled)."""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def send_legacy(address, query, timeout=DEFAULT_TIMEOUT):
+    """Send a single v1 request on a fresh connection and read the response until EOF."""
+    with socket.create_connection(address, timeout=timeout) as sock:
+        sock.sendall(query.encode())
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b"".join(chunks).decode()
+
+
+class PipelinedConnection:
+    """A persistent v2 connection that multiplexes many in-flight requests.
+
+    Cancelling a request's Future forgets the request, so a response that
+    never comes does not pin it in memory; ``request()`` cancels on timeout.
+    """
+
+    def __init__(self, address, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        self._sock = socket.create_connection(address, timeout=timeout)
+        try:
+            self._sock.sendall(MAGIC)
+            reply = b""
+            while len(reply) < len(MAGIC):
+                chunk = self._sock.recv(len(MAGIC) - len(reply))
+                if not chunk:
+                    break
+                reply += chunk
+        except OSError:
+            self._sock.close()
+            raise
+        if reply != MAGIC:
+            self._sock.close()
+            if not reply or reply == BUSY_TAG.encode()[:len(MAGIC)]:
+                # A v1 server always answers the preamble with an error, so this was a shed connection
+                raise ConnectionError(f"{address} turned the connection away")
+            raise ProtocolNotSupported(f"{address} does not support protocol v2")
+
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = FrameReader(self._sock)
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+        self.closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def submit(self, query):
+        """Send ``query`` and return a Future that resolves to the response string."""
+        future = Future()
+        with self._pending_lock:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.address} is closed")
+            request_id = next(self._request_ids) & 0xFFFFFFFF
+            self._pending[request_id] = future
+        future.add_done_callback(lambda future, request_id=request_id: self._forget(request_id, future))
+        try:
+            frame = encode_frame(request_id, query)
+            with self._send_lock:
+                self._sock.sendall(frame)
+        except ProtocolError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        except OSError as e:
+            self._fail(e)
+            raise ConnectionError(f"Failed to send to {self.address}: {e}") from e
+        return future
+
+    def request(self, query, timeout=DEFAULT_TIMEOUT):
+        """Send ``query`` and block until its response arrives."""
+        future = self.submit(query)
+        try:
+            return future.result(timeout)
+        finally:
+            future.cancel()  # Only has an effect after a timeout
+
+    def _forget(self, request_id, future):
+        """Drop a cancelled request from ``_pending``; a late response for it is ignored."""
+        if future.cancelled():
+            with self._pending_lock:
+                if self._pending.get(request_id) is future:
+                    del self._pending[request_id]
+
+    def _read_loop(self):
+        error = None
+        try:
+            while True:
+                frame = self._reader.read_frame()
+                if frame is None:
+                    break
+                request_id, message = frame
+                with self._pending_lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None:
+                    _settle(future, message)
+        except (OSError, ProtocolError) as e:
+            error = e
+        self._fail(error or ConnectionError(f"Connection closed by {self.address}"))
+
+    def _fail(self, error):
+        with self._pending_lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            _settle(future, error=ConnectionError(str(error)))
+        self._sock.close()
+
+    def close(self):
+        """Close the connection, failing any requests still in flight."""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._fail(ConnectionError("Connection closed by client"))
+
+
+_connections = {}
+_legacy_servers = set()
+_connections_lock = threading.Lock()
+
+
+def _get_connection(address, timeout):
+    """Return the shared v2 connection for ``address``, or None if it only speaks v1."""
+    with _connections_lock:
+        if address in _legacy_servers:
+            return None
+        connection = _connections.get(address)
+        if connection is not None and not connection.closed:
+            return connection
+        try:
+            connection = PipelinedConnection(address, timeout)
+        except ProtocolNotSupported:
+            _legacy_servers.add(address)
+            return None
+        _connections[address] = connection
+        return connection
+
+
+def _discard(address, connection):
+    with _connections_lock:
+        if _connections.get(address) is connection:
+            del _connections[address]
+    connection.close()
+
+
+def request(address, query, timeout=DEFAULT_TIMEOUT):
+    """Send ``query`` to ``address`` over a shared persistent connection.
+
+    Servers that only speak v1 get a one-shot connection per request instead. A
+    cached connection that turns out to be stale is replaced and retried once.
+    """
+    for attempt in range(2):
+        connection = _get_connection(address, timeout)
+        if connection is None:
+            return send_legacy(address, query, timeout)
+        try:
+            return connection.request(query, timeout)
+        except ConnectionError:
+            _discard(address, connection)
+            if attempt:
+                raise
+
+
+_legacy_executor = None
+_connect_executor = None
+_executors_lock = threading.Lock()
+
+
+def _submit_legacy(address, query, timeout):
+    global _legacy_executor
+    with _executors_lock:
+        if _legacy_executor is None:
+            _legacy_executor = ThreadPoolExecutor(max_workers=LEGACY_WORKERS, thread_name_prefix="dns-legacy")
+    return _legacy_executor.submit(send_legacy, address, query, timeout)
+
+
+def _submit_connect(task):
+    global _connect_executor
+    with _executors_lock:
+        if _connect_executor is None:
+            _connect_executor = ThreadPoolExecutor(max_workers=CONNECT_WORKERS, thread_name_prefix="dns-connect")
+    return _connect_executor.submit(task)
+
+
+def _chain(source, target):
+    """Resolve ``target`` with the outcome of ``source`` once it completes; cancelling ``target`` cancels ``source``."""
+    def copy(source):
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            _settle(target, error=source.exception())
+        else:
+            _settle(target, source.result())
+    source.add_done_callback(copy)
+    target.add_done_callback(lambda target: source.cancel() if target.cancelled() else None)
+
+
+class ConnectionPool:
+    """Up to ``size`` persistent v2 connections to one server, used round-robin.
+
+    ``submit()`` never blocks on a response, so a caller can have requests in
+    flight to several servers at once. Nor does it block on a connect: a slot
+    without a live connection is (re)connected on a small shared thread pool,
+    outside the pool lock, and the request is sent once that finishes. Against
+    a v1-only server, requests run as one-shot connections on another shared
+    thread pool instead.
+    """
+
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.address = address
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.legacy = False
+        self._connections = [None] * self.size
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def _connect(self, index):
+        """Open a connection for slot ``index``, keeping whichever one another caller installed first."""
+        connection = PipelinedConnection(self.address, self.timeout)
+        with self._lock:
+            current = self._connections[index]
+            if current is None or current.closed:
+                self._connections[index] = connection
+                return connection
+        connection.close()
+        return current
+
+    def _submit_connecting(self, index, query):
+        """Connect slot ``index`` off the caller's thread, then send ``query``."""
+        future = Future()
+
+        def run():
+            if not self.legacy:
+                try:
+                    _chain(self._connect(index).submit(query), future)
+                    return
+                except ProtocolNotSupported:
+                    self.legacy = True
+                except (OSError, ProtocolError) as e:
+                    _settle(future, error=e)
+                    return
+            _chain(_submit_legacy(self.address, query, self.timeout), future)
+        _submit_connect(run)
+        return future
+
+    def submit(self, query):
+        """Send ``query`` and return a Future for the response string.
+
+        The Future raises OSError if no connection to the server can be made.
+        """
+        if self.legacy:
+            return _submit_legacy(self.address, query, self.timeout)
+        index = next(self._next) % self.size
+        with self._lock:
+            connection = self._connections[index]
+        if connection is None or connection.closed:
+            return self._submit_connecting(index, query)
+        try:
+            return connection.submit(query)
+        except ConnectionError:
+            return self._submit_connecting(index, query)  # Closed since we looked; reconnect the slot
+
+    def request(self, query, timeout=DEFAULT_TIMEOUT):
+        """Send ``query`` and block until its response arrives."""
+        future = self.submit(query)
+        try:
+            return future.result(timeout)
+        finally:
+            future.cancel()  # Only has an effect after a timeout
+
+    def close(self):
+        """Close every pooled connection."""
+        with self._lock:
+            connections, self._connections = self._connections, [None] * self.size
+        for connection in connections:
+            if connection is not None:
+                connection.close()
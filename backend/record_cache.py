@@ -0,0 +1,290 @@
+"""In-process L1 cache that sits in front of the Redis ``domain:type`` keys."""
+import json
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_TTL = 300  # Seconds; bounds staleness if an invalidation message is ever missed
+DEFAULT_NEGATIVE_TTL = 60  # Seconds a "record not found" answer is cached, in Redis and in-process
+# Cached in place of a value, under the same key, to remember that a record does not exist
+NEGATIVE_ENTRY = "\x00NXDOMAIN"
+NAME_KEY_SUFFIX = ":*"  # ``<domain>:*`` caches whether a name has any record; invalidating one of them drops it
+DEFAULT_HOT_KEYS = 10000  # Most-looked-up keys remembered, saved and warmed on startup
+DEFAULT_HOT_KEYS_FILE = "hot_keys_{port}.json"  # Per server port, so servers sharing a directory keep their own
+HOT_KEYS_SAVE_INTERVAL = 60  # Seconds between saves; every count is halved after each one
+SKETCH_WIDTH = 1 << 16  # Counters per count-min row; a power of two
+SKETCH_DEPTH = 4
+
+
+class RecordCache:
+    """A bounded, TTL-aware LRU cache of record values keyed by ``domain:type``.
+
+    Entries are invalidated explicitly when a ``dns_updates`` message arrives.
+    Because a reader may fetch a value from Redis or SQLite while a write for the
+    same key is in flight, fills are tagged with the cache version seen before
+    the fetch and dropped if any invalidation happened in between.
+
+    Lookups that found nothing are cached as ``NEGATIVE_ENTRY`` for
+    ``negative_ttl`` seconds, so repeated misses never reach Redis or SQLite.
+    Each entry also remembers the TTL to answer the record with, if it has one.
+    Invalidating ``domain:type`` also drops the cached existence of ``domain``.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at, record_ttl)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, max_entries=None, ttl=None, negative_ttl=None):
+        """Change the size limit or TTLs, evicting entries if the cache shrank."""
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if ttl is not None:
+                self.ttl = ttl
+            if negative_ttl is not None:
+                self.negative_ttl = negative_ttl
+            self._evict_overflow()
+
+    def version(self):
+        """Return a token to pass to ``set()`` for a value fetched after this call."""
+        return self._version
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None on a miss or expiry."""
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def get_entry(self, key):
+        """Return ``(value, record_ttl)`` for ``key``, or None on a miss or expiry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, record_ttl = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, record_ttl
+
+    def set(self, key, value, ttl=None, version=None, record_ttl=None):
+        """Cache ``value`` under ``key`` unless it was invalidated since ``version``.
+
+        ``ttl`` bounds how long the entry is kept; ``record_ttl`` is handed back
+        by ``get_entry()`` as the TTL to answer the record with.
+        """
+        if self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = (value, expires_at, record_ttl)
+            self._entries.move_to_end(key)
+            self._evict_overflow()
+
+    def set_negative(self, key, version=None):
+        """Remember that ``key`` does not exist, unless it was invalidated since ``version``."""
+        if self.negative_ttl > 0:
+            self.set(key, NEGATIVE_ENTRY, ttl=self.negative_ttl, version=version)
+
+    def invalidate(self, key):
+        """Drop ``key`` so the next lookup falls through to Redis."""
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            self._entries.pop(key, None)
+            self._entries.pop(key.rpartition(":")[0] + NAME_KEY_SUFFIX, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Return a snapshot of the cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller for a key runs the function. Callers that arrive while it
+    runs wait for it and share its result (or exception) instead of repeating
+    the work, so a burst of misses on one record costs a single SQLite read.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function):
+        """Return ``(result, shared)``, where ``shared`` is True if another caller's call produced it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = function()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+
+
+class AccessSketch:
+    """Approximate lookup counts per ``domain:type`` key in fixed memory, with the hottest keys kept by name.
+
+    A count-min sketch (SKETCH_DEPTH rows of SKETCH_WIDTH counters) estimates
+    how often each key was looked up. It never undercounts, and overcounts only
+    when a key collides with busier ones in every row. Keys whose estimate
+    makes the top ``capacity`` are remembered with it. Counts are halved after
+    every save, so the ranking follows recent traffic.
+
+    ``touch()`` takes no lock: two threads racing on a counter just lose a count.
+    """
+
+    def __init__(self, capacity=DEFAULT_HOT_KEYS):
+        self.capacity = capacity
+        self._rows = [array("Q", bytes(8 * SKETCH_WIDTH)) for _ in range(SKETCH_DEPTH)]
+        self._top = {}  # key -> estimated count, for up to twice ``capacity`` keys between prunes
+        self._floor = 0  # Lowest estimate kept by the last prune
+        self._lock = threading.Lock()
+
+    def touch(self, key, count=1):
+        """Count ``count`` lookups of ``key``."""
+        if self.capacity <= 0:
+            return
+        # Double hashing derives every row's index from one hash
+        hashed = hash(key)
+        step = (hashed >> 32) | 1
+        estimate = None
+        for depth, row in enumerate(self._rows):
+            index = (hashed + depth * step) & (SKETCH_WIDTH - 1)
+            value = row[index] + count
+            row[index] = value
+            if estimate is None or value < estimate:
+                estimate = value
+        top = self._top
+        if key in top:
+            top[key] = estimate
+        elif len(top) < self.capacity or estimate > self._floor:
+            with self._lock:
+                self._admit(key, estimate)
+
+    def _admit(self, key, estimate):
+        """Add ``key`` to the hot set; called with the lock held.
+
+        The set may grow to twice ``capacity`` before it is cut back to the
+        hottest ``capacity`` keys, so admitting a key costs O(log capacity)
+        amortised instead of a scan for the coldest one every time.
+        """
+        self._top[key] = estimate
+        if len(self._top) >= 2 * self.capacity:
+            kept = self.top()
+            self._top = dict(kept)
+            self._floor = kept[-1][1]
+
+    def top(self, limit=None):
+        """Return up to ``limit`` (by default ``capacity``) ``(key, estimated_count)`` pairs, hottest first."""
+        ranked = sorted(list(self._top.items()), key=lambda item: item[1], reverse=True)
+        return ranked[:self.capacity if limit is None else limit]
+
+    def decay(self):
+        """Halve every count."""
+        with self._lock:
+            for row in self._rows:
+                row[:] = array("Q", (value >> 1 for value in row))
+            self._top = {key: count >> 1 for key, count in self._top.items() if count > 1}
+            self._floor >>= 1
+
+    def save(self, path):
+        """Write the hot keys and their counts to ``path``, replacing it atomically."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as out:
+            json.dump(self.top(), out, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        """Seed the counts from a file written by ``save()`` and return its keys, hottest first.
+
+        A missing, unreadable or malformed file yields no keys.
+        """
+        try:
+            with open(path) as source:
+                saved = [(key, count) for key, count in json.load(source)]
+            if not all(isinstance(key, str) and isinstance(count, int) for key, count in saved):
+                raise ValueError("expected a list of [key, count] pairs")
+        except FileNotFoundError:
+            return []
+        except (OSError, TypeError, ValueError) as e:
+            print(f"[WARN] Could not read hot keys from {path}: {e}")
+            return []
+        for key, count in saved:
+            self.touch(key, count)
+        return [key for key, _ in saved]
+
+    def start_saving(self, path, interval=HOT_KEYS_SAVE_INTERVAL):
+        """Save to ``path`` and then decay every ``interval`` seconds from a daemon thread."""
+        if self.capacity > 0:
+            threading.Thread(target=self._save_periodically, args=(path, interval),
+                             name="hot-keys", daemon=True).start()
+
+    def _save_periodically(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save(path)
+            except OSError as e:
+                print(f"[WARN] Could not save hot keys to {path}: {e}")
+            self.decay()
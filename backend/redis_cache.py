@@ -0,0 +1,341 @@
+"""Shared Redis access for the record cache, update notices and the pending queue.
+
+Each operation takes one round trip. Reads of several records are pipelined. A write
+on a secondary updates the cache key, publishes the notice and queues it for
+the primary in one Lua script, so the three steps are atomic and cost one RTT.
+
+Reads and fills are best effort: once Redis stops answering they are skipped
+for RETRY_INTERVAL at a time, so lookups fall through to SQLite instead of
+failing or waiting on a dead connection. Writes are not: a write Redis does
+not take raises, so the caller can roll back what it committed locally.
+"""
+import os
+import threading
+import time
+
+import redis
+
+import metrics
+import record_cache
+
+DEFAULT_FILL_LOCK_MS = 0  # Off: only requests within one process share a SQLite read
+FILL_LOCK_PREFIX = "fill-lock:"
+FILL_POLL_INTERVAL = 0.005  # Seconds between checks for another process's fill
+DEFAULT_REFRESH_INTERVAL = 5.0  # Seconds between refresh-ahead passes
+REFRESH_MIN_HITS = 3  # Recent lookups, as counted by the access sketch, that make a record worth refreshing
+REFRESH_MAX_KEYS = 1000  # Hottest records considered per pass
+RETRY_INTERVAL = 1.0  # Seconds reads and fills skip Redis after it stopped answering
+UNAVAILABLE = (redis.ConnectionError, redis.TimeoutError)
+DEFAULT_WARM_UP_BUDGET = 5.0  # Seconds a starting server spends loading hot records before it listens
+WARM_UP_BATCH = 500  # Records read from SQLite and written to Redis per pipeline during warm-up
+
+# KEYS[1]: cache key; KEYS[2], if given: pending updates list
+# ARGV: value ("" with ARGV[5] == "1" to delete), TTL seconds, channel, notice, delete flag
+WRITE_SCRIPT = """
+if ARGV[5] == "1" then
+    redis.call("DEL", KEYS[1])
+else
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+end
+redis.call("PUBLISH", ARGV[3], ARGV[4])
+if #KEYS > 1 then
+    redis.call("LPUSH", KEYS[2], ARGV[4])
+end
+return 1
+"""
+
+# KEYS[1]: cache key; ARGV: value seen before the SQLite read, fresh value, TTL seconds.
+# A write that changed the key in the meantime wins.
+REFRESH_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# Deletes the fill lock KEYS[1] only if it still holds our token ARGV[1]
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class RedisCache:
+    """Record cache keys (``domain:type``), the update channel and the pending list in one Redis.
+
+    Scripts are loaded once and run with EVALSHA; redis-py reloads them
+    transparently if the server was restarted and forgot them.
+
+    With ``fill_lock_ms`` set, a process about to read a missing record from
+    SQLite first takes a short lock on it, and other processes (including
+    other servers sharing this Redis) wait for its fill instead of reading too.
+    """
+
+    def __init__(self, client, channel, pending_key, fill_lock_ms=DEFAULT_FILL_LOCK_MS):
+        self.client = client
+        self.channel = channel
+        self.pending_key = pending_key
+        self.fill_lock_ms = fill_lock_ms
+        self._write_script = client.register_script(WRITE_SCRIPT)
+        self._unlock_script = client.register_script(UNLOCK_SCRIPT)
+        self._retry_at = 0.0
+        self._down = False
+
+    def _timed(self, op, started):
+        metrics.observe("dns_redis_command_seconds", f'op="{op}"', time.perf_counter() - started)
+
+    def available(self):
+        """Return False while reads and fills are skipping Redis after a failure."""
+        return time.monotonic() >= self._retry_at
+
+    def failed(self, error):
+        """Skip Redis reads and fills for the next RETRY_INTERVAL seconds."""
+        if not self._down:
+            self._down = True
+            print(f"[WARN] Redis is unavailable ({error}); lookups bypass it until it is back.")
+        # Idle pooled connections to a restarted Redis are all dead; drop them rather than failing on each in turn.
+        # Connections in use (such as a subscription) are left to their owners.
+        self.client.connection_pool.disconnect(inuse_connections=False)
+        self._retry_at = time.monotonic() + RETRY_INTERVAL
+
+    def _recovered(self):
+        if self._down:
+            self._down = False
+            print("[INFO] Redis is reachable again.")
+
+    def get_many(self, cache_keys):
+        """Return ``(value, remaining_seconds)`` for each of ``cache_keys`` in one round trip.
+
+        ``value`` is None where the key is missing (or Redis is unavailable), and
+        ``remaining_seconds`` is None for a key without an expiry.
+        """
+        if not cache_keys:
+            return []
+        if not self.available():
+            return [(None, None)] * len(cache_keys)
+        pipe = self.client.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipe.get(cache_key)
+            pipe.pttl(cache_key)
+        started = time.perf_counter()
+        try:
+            replies = pipe.execute()
+        except UNAVAILABLE as e:
+            self.failed(e)
+            return [(None, None)] * len(cache_keys)
+        self._timed("get", started)
+        self._recovered()
+        return [(value, remaining_ms / 1000 if remaining_ms > 0 else None)
+                for value, remaining_ms in zip(replies[::2], replies[1::2])]
+
+    def fill_many(self, items):
+        """Cache ``(cache_key, value, ttl)`` items read from SQLite in one round trip."""
+        if not items or not self.available():
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for cache_key, value, ttl in items:
+            pipe.set(cache_key, value, ex=ttl)
+        started = time.perf_counter()
+        try:
+            pipe.execute()
+        except UNAVAILABLE as e:
+            self.failed(e)
+            return
+        self._timed("fill", started)
+
+    def _fill(self, cache_key, value, ttl, nx):
+        if not self.available():
+            return
+        started = time.perf_counter()
+        try:
+            self.client.set(cache_key, value, ex=ttl, nx=nx)
+        except UNAVAILABLE as e:
+            self.failed(e)
+            return
+        self._timed("fill", started)
+
+    def fill(self, cache_key, value, ttl):
+        """Cache a value read from SQLite."""
+        self._fill(cache_key, value, ttl, nx=False)
+
+    def fill_if_absent(self, cache_key, value, ttl):
+        """Cache a miss or wildcard answer, unless a write cached a real value since it was looked up."""
+        self._fill(cache_key, value, ttl, nx=True)
+
+    def write(self, cache_key, value, ttl, notice, enqueue=False):
+        """Cache ``value`` (or drop the key if it is None) and publish ``notice``, atomically.
+
+        With ``enqueue``, the notice is also pushed onto the pending list for the
+        primary to apply. Raises a redis error if Redis did not take the write.
+        """
+        keys = [cache_key, self.pending_key] if enqueue else [cache_key]
+        args = ["", ttl, self.channel, notice, "1"] if value is None else [value, ttl, self.channel, notice, "0"]
+        started = time.perf_counter()
+        try:
+            self._write_script(keys=keys, args=args)
+        except UNAVAILABLE as e:
+            self.failed(e)
+            raise
+        self._timed("write", started)
+        self._recovered()
+
+    def lock_fill(self, cache_key):
+        """Try to take the fill lock on ``cache_key``; returns a token to unlock with, or None if it is held.
+
+        Also returns None if Redis is unreachable; ``wait_for_fill()`` then
+        returns no value at once, so the caller reads SQLite itself.
+        """
+        if not self.available():
+            return None
+        token = os.urandom(8).hex()
+        started = time.perf_counter()
+        try:
+            locked = self.client.set(FILL_LOCK_PREFIX + cache_key, token, px=self.fill_lock_ms, nx=True)
+        except UNAVAILABLE as e:
+            self.failed(e)
+            return None
+        self._timed("lock", started)
+        return token if locked else None
+
+    def unlock_fill(self, cache_key, token):
+        """Release a fill lock taken with ``token``; if Redis is unreachable the lock simply expires."""
+        if not self.available():
+            return
+        try:
+            self._unlock_script(keys=[FILL_LOCK_PREFIX + cache_key], args=[token])
+        except UNAVAILABLE as e:
+            self.failed(e)
+
+    def wait_for_fill(self, cache_key):
+        """Wait for the holder of ``cache_key``'s fill lock to cache it.
+
+        Returns ``(value, remaining_seconds)`` as ``get_many()`` does. The value is
+        None if the lock was released or expired without a value being cached,
+        or if Redis became unreachable, in which case the caller reads SQLite itself.
+        """
+        deadline = time.monotonic() + self.fill_lock_ms / 1000
+        lock_key = FILL_LOCK_PREFIX + cache_key
+        while time.monotonic() < deadline and self.available():
+            time.sleep(FILL_POLL_INTERVAL)
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(cache_key)
+            pipe.pttl(cache_key)
+            pipe.exists(lock_key)
+            try:
+                value, remaining_ms, locked = pipe.execute()
+            except UNAVAILABLE as e:
+                self.failed(e)
+                break
+            if value or not locked:
+                return value, remaining_ms / 1000 if remaining_ms > 0 else None
+        return None, None
+
+    def pipeline(self):
+        """Return a non-transactional pipeline for batching many commands into one round trip."""
+        return self.client.pipeline(transaction=False)
+
+    def pending_count(self):
+        return self.client.llen(self.pending_key)
+
+
+def warm_up(cache, load, cache_keys, default_ttl, budget, on_load=None):
+    """Copy records from SQLite into Redis, in the order given, until ``budget`` seconds have passed.
+
+    Each batch of WARM_UP_BATCH keys is read from SQLite and written with one
+    pipeline. ``on_load(cache_key, value, ttl)`` is called for every record
+    loaded, to fill an in-process cache too. Keys without a record are skipped.
+    Returns how many records were loaded.
+    """
+    deadline = time.monotonic() + budget
+    loaded = 0
+    for start in range(0, len(cache_keys), WARM_UP_BATCH):
+        if time.monotonic() >= deadline:
+            break
+        items = []
+        for cache_key in cache_keys[start:start + WARM_UP_BATCH]:
+            domain, _, record_type = cache_key.rpartition(":")
+            record = load(domain, record_type)
+            if record is not None:
+                items.append((cache_key, *record))
+        cache.fill_many([(cache_key, value, ttl or default_ttl) for cache_key, value, ttl in items])
+        if on_load:
+            for item in items:
+                on_load(*item)
+        loaded += len(items)
+    return loaded
+
+
+class RefreshAhead:
+    """Re-reads hot records from SQLite shortly before their Redis keys expire.
+
+    Lookups count every record they answer in an access sketch. Each pass takes
+    its hottest records with at least REFRESH_MIN_HITS recent lookups, reads
+    their values and remaining TTLs in one round trip, and reloads the ones due
+    to expire before the pass after next. Hot records therefore never fall out
+    of Redis, and a record with a short TTL is re-read from SQLite every pass
+    while it stays hot. A reload only replaces the value it read from Redis, so
+    it never undoes a write made in the meantime.
+    """
+
+    def __init__(self, cache, load, default_ttl, access, on_change=None):
+        self.cache = cache
+        self.load = load  # (domain, record_type) -> (value, ttl) or None
+        self.default_ttl = default_ttl
+        self.access = access  # record_cache.AccessSketch
+        self.on_change = on_change
+        self.interval = 0
+        self._script = cache.client.register_script(REFRESH_SCRIPT)
+
+    def start(self, interval=DEFAULT_REFRESH_INTERVAL):
+        if interval > 0:
+            self.interval = interval
+            threading.Thread(target=self._run, name="refresh-ahead", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.cache.available():
+                continue
+            try:
+                self.refresh()
+            except UNAVAILABLE as e:
+                self.cache.failed(e)
+            except Exception as e:
+                print(f"[WARN] Refresh-ahead pass failed: {e}")
+
+    def refresh(self):
+        """Run one pass and return how many records were reloaded."""
+        hot = [key for key, count in self.access.top(REFRESH_MAX_KEYS) if count >= REFRESH_MIN_HITS]
+        if not hot:
+            return 0
+        pipe = self.cache.pipeline()
+        for cache_key in hot:
+            pipe.get(cache_key)
+            pipe.pttl(cache_key)
+        replies = pipe.execute()
+        window_ms = 2 * self.interval * 1000
+        pipe = self.cache.pipeline()
+        changed = []
+        for cache_key, cached_value, remaining_ms in zip(hot, replies[::2], replies[1::2]):
+            # Missing keys (-2) load on the next lookup; cached misses expire on their own
+            if not cached_value or cached_value == record_cache.NEGATIVE_ENTRY or not 0 <= remaining_ms < window_ms:
+                continue
+            domain, _, record_type = cache_key.rpartition(":")
+            record = self.load(domain, record_type)
+            if record is None:
+                continue  # Deleted, or a wildcard answer; let it expire
+            value, ttl = record
+            self._script(keys=[cache_key], args=[cached_value, value, ttl or self.default_ttl], client=pipe)
+            if value != cached_value:
+                changed.append(cache_key)
+        refreshed = sum(pipe.execute()) if len(pipe) else 0
+        metrics.inc("dns_refresh_ahead_total", 'result="refreshed"', refreshed)
+        if changed:
+            metrics.inc("dns_refresh_ahead_total", 'result="changed"', len(changed))
+            if self.on_change:
+                for cache_key in changed:
+                    self.on_change(cache_key)
+        return refreshed
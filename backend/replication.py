@@ -0,0 +1,133 @@
+"""Replication message formats shared by the primary and secondary servers.
+
+Every mutation on the primary gets a serial from its change log. Update
+notices on the ``dns_updates`` channel carry it as a leading field:
+
+    <serial>:ADD:<domain>:<record_type>:<value>
+    <serial>:ADD:<domain>:<record_type>/<ttl>:<value>
+    <serial>:DELETE:<domain>:<record_type>
+
+The ``/<ttl>`` suffix is present only for records with their own TTL. It rides
+on the type because values may themselves contain colons.
+
+Notices without a serial (for example writes accepted by a secondary while the
+primary was down) keep the original ``ACTION:domain:type[:value]`` form.
+
+Secondaries fetch the changes they missed with ``CHANGES:<after_serial>:<limit>``,
+which the primary answers with a ``CHANGES:<latest_serial>:<count>`` header line
+followed by one serial-prefixed notice per line.
+
+A new or hopelessly stale secondary instead bootstraps from ``SNAPSHOT:zlib``.
+The primary answers with a ``SNAPSHOT:<serial>`` line, then a series of chunks
+(a 4-byte big-endian length followed by a zlib-compressed JSON array of
+``[domain, record_type, value, ttl]`` rows), and a zero-length chunk to finish. All
+rows come from one read transaction, so they are exactly the state at ``serial``.
+"""
+import json
+import struct
+import zlib
+
+DEFAULT_CATCH_UP_BATCH = 1000
+MAX_CATCH_UP_BATCH = 10000
+SNAPSHOT_COMMAND = "SNAPSHOT:zlib"
+SNAPSHOT_BATCH_SIZE = 10000
+SNAPSHOT_CHUNK = struct.Struct("!I")
+SNAPSHOT_END = SNAPSHOT_CHUNK.pack(0)
+SNAPSHOT_COMPRESSION_LEVEL = 1  # Transfer time is dominated by CPU, not bandwidth, on a LAN
+
+
+class ResyncRequired(Exception):
+    """Raised when the changes a replica needs have been trimmed from the change log."""
+
+
+def format_update(action, domain, record_type, value=None, serial=None, ttl=None):
+    """Render one update notice."""
+    if action == "DELETE":
+        message = f"{action}:{domain}:{record_type}"
+    elif ttl is None:
+        message = f"{action}:{domain}:{record_type}:{value}"
+    else:
+        message = f"{action}:{domain}:{record_type}/{ttl}:{value}"
+    return message if serial is None else f"{serial}:{message}"
+
+
+def parse_update(message):
+    """Return ``(serial, action, domain, record_type, value, ttl)`` for a notice; serial and ttl may be None.
+
+    UPDATE is normalised to ADD, since both store the new value. Raises ValueError
+    for malformed notices.
+    """
+    serial = None
+    head, _, rest = message.partition(":")
+    if head.isdigit():
+        serial = int(head)
+        message = rest
+    action, domain, record_type, *value = message.split(":", 3)
+    record_type, _, ttl = record_type.partition("/")
+    if action == "UPDATE":
+        action = "ADD"
+    if action == "ADD":
+        if not value:
+            raise ValueError(f"Missing value in update notice: {message}")
+        return serial, action, domain, record_type, value[0], int(ttl) if ttl else None
+    if action == "DELETE":
+        return serial, action, domain, record_type, None, None
+    raise ValueError(f"Unknown action in update notice: {message}")
+
+
+def format_changes(changes, latest_serial):
+    """Render a CHANGES response for ``(serial, action, domain, record_type, value, ttl)`` rows."""
+    lines = [f"CHANGES:{latest_serial}:{len(changes)}"]
+    lines.extend(format_update(action, domain, record_type, value, serial, ttl)
+                 for serial, action, domain, record_type, value, ttl in changes)
+    return "\n".join(lines)
+
+
+def parse_changes(response):
+    """Parse a CHANGES response into ``(latest_serial, changes)``.
+
+    Raises ResyncRequired if the primary no longer has the requested range, and
+    ValueError for any other unexpected response.
+    """
+    if response.startswith("[ERROR] RESYNC"):
+        raise ResyncRequired(response)
+    header, *lines = response.split("\n")
+    tag, latest, count = header.split(":")
+    if tag != "CHANGES" or int(count) != len(lines):
+        raise ValueError(f"Unexpected CHANGES response: {header}")
+    return int(latest), [parse_update(line) for line in lines]
+
+
+def encode_snapshot_chunk(rows):
+    """Compress a batch of ``(domain, record_type, value, ttl)`` rows into one snapshot chunk."""
+    payload = zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), SNAPSHOT_COMPRESSION_LEVEL)
+    return SNAPSHOT_CHUNK.pack(len(payload)) + payload
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ConnectionError("Snapshot stream ended unexpectedly")
+    return data
+
+
+def read_snapshot(stream):
+    """Read a snapshot header from a binary file-like ``stream``.
+
+    Returns ``(serial, batches)``, where ``batches`` lazily yields lists of
+    ``(domain, record_type, value, ttl)`` tuples as chunks arrive.
+    """
+    header = stream.readline().decode().strip()
+    tag, _, serial = header.partition(":")
+    if tag != "SNAPSHOT" or not serial.isdigit():
+        raise ValueError(f"Unexpected snapshot response: {header}")
+
+    def batches():
+        while True:
+            (length,) = SNAPSHOT_CHUNK.unpack(_read_exactly(stream, SNAPSHOT_CHUNK.size))
+            if length == 0:
+                return
+            rows = json.loads(zlib.decompress(_read_exactly(stream, length)))
+            yield [tuple(row) for row in rows]
+
+    return int(serial), batches()
@@ -1,24 +1,70 @@
-import socket
+import os
 import redis
-import sqlite3
+import socket
 import threading
 import signal
 import sys
 import time
 
+import dns_wire
+import lookup
+import metrics
+import protocol
+import record_cache
+import redis_cache
+import replication
+import server_core
+import storage
+import zone_image
+import zone_io
+
 DB_FILE = "dns_records.db"
+REDIS_URL = os.environ.get("DNS_REDIS_URL", "redis://localhost:6379/0")
 REDIS_CHANNEL = "dns_updates"
-CACHE_TTL = 3600  # Cache Time-To-Live in seconds
+CACHE_TTL = 3600  # Seconds records without their own TTL stay in Redis
 PENDING_UPDATES_KEY = "pending_updates"
-
-# Connect to Redis
+PRIMARY_SERVER = ("127.0.0.1", 8053)
+CATCH_UP_INTERVAL = 30  # Seconds between change log polls while no notices arrive
+CLEAR_ALL = "*"  # Sent on the applied channel after a bootstrap replaced every record
+DEFAULT_IMAGE_INTERVAL = 60  # Seconds between zone image rebuilds while records keep changing
+IMAGE_WATCH_INTERVAL = 1.0  # Seconds between checks for a newly published zone image
+
+# Connect to Redis. Lookups bypass it while it is down, so the secondary still starts and serves.
+redis_client = redis.StrictRedis.from_url(REDIS_URL, decode_responses=True)
 try:
-    redis_client = redis.StrictRedis(host="localhost", port=6379, db=0, decode_responses=True)
     redis_client.ping()
     print("[INFO] Connected to Redis successfully.")
 except redis.ConnectionError as e:
-    print(f"[ERROR] Could not connect to Redis: {e}")
-    sys.exit(1)
+    print(f"[WARN] Could not connect to Redis: {e}. Serving from SQLite until it is back.")
+
+# Pooled SQLite connections, the in-process L1 cache and the shared Redis cache behind it
+store = storage.RecordStore(DB_FILE)
+local_cache = record_cache.RecordCache()
+shared_cache = redis_cache.RedisCache(redis_client, REDIS_CHANNEL, PENDING_UPDATES_KEY)
+# Approximate lookup counts per record, for refresh-ahead and the warm-up after a restart
+access = record_cache.AccessSketch()
+# Reloads hot records before their Redis keys expire
+refresher = redis_cache.RefreshAhead(shared_cache, store.fetch_record, CACHE_TTL, access,
+                                     on_change=local_cache.invalidate)
+# The read path (L1, the zone image if any, Redis, SQLite) and the text protocol commands both servers share
+records = lookup.RecordLookup(store, local_cache, shared_cache, access, CACHE_TTL)
+
+# Replication position in the primary's change log
+primary_address = PRIMARY_SERVER
+last_applied_serial = 0
+latest_primary_serial = 0  # Highest serial the primary is known to have assigned
+last_applied_at = None
+needs_resync = False
+# Set when running as several worker processes; worker 0 publishes the keys it applied here
+applied_channel = None
+
+# Read-only zone image (--zone-image), swapped whole whenever a newer one is published
+zone_image_path = None
+image = None
+image_identity = None  # File identity of the last image loaded, to spot a newly published one
+# Keys changed since the image was built, with the serial an image must reach to cover them
+image_dirty = {}
+image_dirty_lock = threading.Lock()
 
 
 # Graceful exit handler
@@ -31,191 +77,452 @@ signal.signal(signal.SIGINT, handle_exit)
 
 def init_db():
     """Initialize the SQLite database."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS dns_records (
-            domain TEXT NOT NULL,
-            record_type TEXT NOT NULL,
-            value TEXT NOT NULL,
-            PRIMARY KEY (domain, record_type)
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
+    store.init_db()
     print("[INFO] SQLite database initialized.")
 
 
-def add_record(domain, record_type, value):
-    """Add a DNS record to the database."""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT OR REPLACE INTO dns_records (domain, record_type, value) VALUES (?, ?, ?)",
-            (domain, record_type, value),
-        )
-        conn.commit()
-        conn.close()
+def mark_image_dirty(keys, serial=None):
+    """Answer ``keys`` from the caches and SQLite instead of the image until one at ``serial`` or later is loaded.
+
+    A write accepted by this secondary has no serial yet, so it waits for an
+    image newer than any change applied so far.
+    """
+    if zone_image_path is None:
+        return
+    if serial is None:
+        serial = max(last_applied_serial, image.serial if image is not None else 0) + 1
+    with image_dirty_lock:
+        for key in keys:
+            image_dirty[key] = max(serial, image_dirty.get(key, 0))
 
-        cache_key = f"{domain}:{record_type}"
-        redis_client.setex(cache_key, CACHE_TTL, value)
 
-        # Publish to Redis for primary server sync
-        update_message = f"ADD:{domain}:{record_type}:{value}"
-        redis_client.publish(REDIS_CHANNEL, update_message)
-        redis_client.lpush(PENDING_UPDATES_KEY, update_message)  # Store pending update
-        return f"Record added: {record_type} record for {domain} -> {value}"
+def load_image():
+    """Map the zone image at ``zone_image_path`` and answer from it. Returns False if it cannot be used."""
+    global image, image_identity, image_dirty
+    try:
+        new_image = zone_image.ZoneImage(zone_image_path)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Could not load zone image {zone_image_path}: {e}")
+        return False
+    image_identity = new_image.identity
+    image = new_image
+    # Swapped in before pruning, so a lookup in between only skips the image needlessly
+    with image_dirty_lock:
+        image_dirty = {key: serial for key, serial in image_dirty.items() if serial > new_image.serial}
+    print(f"[INFO] Serving {len(new_image)} records from zone image {zone_image_path} at serial {new_image.serial}.")
+    return True
+
+
+def build_image():
+    """Write a zone image of every record from one SQLite read transaction, publish it and load it."""
+    started = time.monotonic()
+    snapshot = store.snapshot(replication.SNAPSHOT_BATCH_SIZE)
+    try:
+        serial = next(snapshot)
+        count = zone_image.write_image(zone_image_path, serial, snapshot)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Could not build zone image {zone_image_path}: {e}")
+        return False
+    finally:
+        snapshot.close()
+    print(f"[INFO] Built a zone image of {count} records at serial {serial} in {time.monotonic() - started:.1f}s.")
+    return load_image()
+
+
+def open_image():
+    """Load the zone image at startup, rebuilding it first unless it is exactly as current as the database."""
+    global image
+    if os.path.exists(zone_image_path) and load_image():
+        if image.serial == last_applied_serial:
+            return
+        print(f"[INFO] Zone image is at serial {image.serial}, the database at {last_applied_serial}; rebuilding.")
+        image = None
+    build_image()
+
+
+def publish_images(interval):
+    """Rebuild the zone image every ``interval`` seconds while records keep changing."""
+    while True:
+        time.sleep(interval)
+        if image is None or image_dirty:
+            build_image()
+
+
+def watch_image():
+    """Load each zone image worker 0 publishes."""
+    while True:
+        time.sleep(IMAGE_WATCH_INTERVAL)
+        try:
+            stat = os.stat(zone_image_path)
+        except OSError:
+            continue
+        if (stat.st_ino, stat.st_mtime_ns) != image_identity:
+            load_image()
+
+
+def add_record(domain, record_type, value, ttl=None):
+    """Add a DNS record to the database, optionally with its own TTL in seconds.
+
+    The record is committed only once Redis has queued it for the primary, so a
+    write Redis cannot take is rolled back and reported as an error.
+    """
+    if not shared_cache.available():
+        return "[ERROR] Failed to add record: Redis is unavailable, so the write cannot reach the primary"
+    try:
+        cache_key = f"{domain}:{record_type}"
+        mark_image_dirty([cache_key])
+        # Cache it, notify the other servers and queue it for the primary in one round trip
+        update_message = replication.format_update("ADD", domain, record_type, value, ttl=ttl)
+        store.upsert(domain, record_type, value, ttl,
+                     before_commit=lambda: shared_cache.write(cache_key, value, ttl or CACHE_TTL, update_message,
+                                                              enqueue=True))
+        local_cache.invalidate(cache_key)
+        return f"Record added: {record_type} record for {domain} -> {value}" + (f" (TTL {ttl}s)" if ttl else "")
     except Exception as e:
         return f"[ERROR] Failed to add record: {e}"
 
 
-def update_record(domain, record_type, value):
-    """Update a DNS record in the database."""
-    return add_record(domain, record_type, value)
-
-
 def delete_record(domain, record_type):
-    """Delete a DNS record from the database."""
+    """Delete a DNS record from the database, committing only once Redis has queued it for the primary."""
+    if not shared_cache.available():
+        return "[ERROR] Failed to delete record: Redis is unavailable, so the write cannot reach the primary"
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM dns_records WHERE domain = ? AND record_type = ?", (domain, record_type)
-        )
-        conn.commit()
-        conn.close()
-
         cache_key = f"{domain}:{record_type}"
-        redis_client.delete(cache_key)
-
-        # Publish to Redis for primary server sync
-        update_message = f"DELETE:{domain}:{record_type}"
-        redis_client.publish(REDIS_CHANNEL, update_message)
-        redis_client.lpush(PENDING_UPDATES_KEY, update_message)  # Store pending update
+        mark_image_dirty([cache_key])
+        store.delete(domain, record_type,
+                     before_commit=lambda: shared_cache.write(cache_key, None, CACHE_TTL,
+                                                              f"DELETE:{domain}:{record_type}", enqueue=True))
+        local_cache.invalidate(cache_key)
         return f"Record deleted: {record_type} record for {domain}"
     except Exception as e:
         return f"[ERROR] Failed to delete record: {e}"
 
 
-def query_record(domain, record_type):
-    """Query a DNS record from the cache or database."""
-    try:
-        cache_key = f"{domain}:{record_type}"
-        cached_value = redis_client.get(cache_key)
-        if cached_value:
-            return f"DNS Response (from cache): {record_type} record for {domain} -> {cached_value}"
-
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT value FROM dns_records WHERE domain = ? AND record_type = ?", (domain, record_type)
-        )
-        result = cursor.fetchone()
-        conn.close()
-
-        if result:
-            redis_client.setex(cache_key, CACHE_TTL, result[0])
-            return f"DNS Response: {record_type} record for {domain} -> {result[0]}"
-        return "Record not found."
-    except Exception as e:
-        return f"[ERROR] Failed to query record: {e}"
-
+def image_source():
+    """Return a lookup in the zone image being served now, skipping records changed since it was built.
+
+    Every key in a batch comes from the same image, even if a new one is swapped in meanwhile.
+    """
+    current_image = image
+    if current_image is None:
+        return None
+
+    def get(domain, record_type):
+        if f"{domain}:{record_type}" in image_dirty:
+            return None
+        # A name the image does not have may still match a wildcard, so it is looked for further down
+        record = current_image.get(domain, record_type)
+        if record is not None:
+            metrics.inc("dns_cache_lookups_total", 'layer="image",result="hit"')
+        return record
+
+    return get
+
+
+def process_query(query):
+    """Parse a text protocol request and dispatch it to the matching operation."""
+    return records.process_query(query, add_record, delete_record)
+
+
+def replication_lag():
+    """Return how many of the primary's changes this replica has not applied yet."""
+    return max(0, latest_primary_serial - last_applied_serial)
+
+
+def register_metrics(replicating=True):
+    """Expose the secondary's caches, pending queue and, when ``replicating``, replication position as gauges."""
+    metrics.gauge("dns_l1_cache_entries", "Records held in the in-process cache", lambda: local_cache.stats()["entries"])
+    metrics.gauge("dns_l1_cache_hit_ratio", "Share of in-process cache lookups that hit",
+                  lambda: local_cache.stats()["hit_ratio"])
+    metrics.gauge("dns_pending_updates", "Writes waiting in the pending_updates list for the primary",
+                  shared_cache.pending_count)
+    if zone_image_path:
+        metrics.gauge("dns_zone_image_records", "Records in the zone image being served",
+                      lambda: len(image) if image is not None else None)
+        metrics.gauge("dns_zone_image_serial", "Change log serial of the zone image being served",
+                      lambda: image.serial if image is not None else None)
+        metrics.gauge("dns_zone_image_dirty_keys", "Records changed since the zone image was built",
+                      lambda: len(image_dirty))
+    if not replicating:
+        return
+    metrics.gauge("dns_replication_last_applied_serial", "Last change log serial applied", lambda: last_applied_serial)
+    metrics.gauge("dns_replication_lag_serials", "Primary changes not yet applied", replication_lag)
+    metrics.gauge("dns_replication_seconds_since_apply", "Seconds since a replicated change was last applied",
+                  lambda: None if last_applied_at is None else round(time.monotonic() - last_applied_at, 3))
+
+
+def add_arguments(parser):
+    """Add the secondary-only command line options."""
+    parser.add_argument("--primary", type=server_core.parse_address, default=PRIMARY_SERVER,
+                        help="Primary server to replicate from, as host:port (default: 127.0.0.1:8053)")
+    parser.add_argument("--bootstrap", action="store_true",
+                        help="Replace the local records with a snapshot from the primary before serving")
+    parser.add_argument("--zone-image", default=None,
+                        help="Serve lookups from a memory-mapped zone image kept at this path, rebuilt from "
+                             "SQLite as records change (default: off)")
+    parser.add_argument("--image-interval", type=float, default=DEFAULT_IMAGE_INTERVAL,
+                        help="Seconds between zone image rebuilds while records keep changing "
+                             f"(default: {DEFAULT_IMAGE_INTERVAL})")
+
+
+def start_server(options=None):
+    """Start the secondary DNS server, as a supervisor of ``--processes`` workers when there are several."""
+    global primary_address, last_applied_serial, applied_channel, zone_image_path
+    options = options or server_core.parse_args("Secondary DNS Server", 8054, argv=[], configure=add_arguments)
+    primary_address = options.primary
+    zone_image_path = options.zone_image
+    init_db()
+    last_applied_serial = store.last_applied_serial()
+    if options.bootstrap:
+        bootstrap_from_primary()
+    if zone_image_path:
+        open_image()
+        records.pinned_source = image_source
+    # Before forking, so every worker starts with the warmed in-process cache
+    local_cache.configure(max_entries=options.l1_size, ttl=options.l1_ttl, negative_ttl=options.negative_ttl)
+    access.capacity = options.hot_keys
+    records.warm_caches(options.hot_keys_file, options.warm_up_budget)
+    if options.processes > 1:
+        applied_channel = f"{REDIS_CHANNEL}:applied:{options.port}"
+        store.close()  # Each forked worker opens its own SQLite connections
+        server_core.supervise("Secondary DNS Server", options.processes, lambda index: run_worker(options, index))
+    else:
+        run_worker(options)
+
+
+def run_worker(options, index=0):
+    """Serve requests in this process.
+
+    Only worker 0 replicates from the primary. Two processes applying the same
+    changes at different times could briefly roll a record back, so the other
+    workers just drop their in-process entries once worker 0 announces what it
+    applied on ``applied_channel``.
+    """
+    global last_applied_serial
+    shared_cache.fill_lock_ms = options.fill_lock_ms
+    refresher.start(options.refresh_interval)
+    replicating = index == 0
+    if replicating:
+        access.start_saving(options.hot_keys_file)
+    register_metrics(replicating)
+    if options.metrics_port:
+        metrics.start_http_server(options.host, options.metrics_port + index)
 
-def handle_client(client_socket, client_address):
-    """Handle incoming client requests."""
-    print(f"[INFO] Connection established with {client_address}")
     try:
-        query = client_socket.recv(1024).decode()
-        if query.startswith("ADD:"):
-            try:
-                _, domain, record_type, value = query.split(":")
-                response = add_record(domain, record_type, value)
-            except ValueError:
-                response = "[ERROR] Malformed ADD query. Use the format: ADD:<domain>:<record_type>:<value>"
-        elif query.startswith("UPDATE:"):
-            try:
-                _, domain, record_type, value = query.split(":")
-                response = update_record(domain, record_type, value)
-            except ValueError:
-                response = "[ERROR] Malformed UPDATE query. Use the format: UPDATE:<domain>:<record_type>:<value>"
-        elif query.startswith("DELETE:"):
-            try:
-                _, domain, record_type = query.split(":")
-                response = delete_record(domain, record_type)
-            except ValueError:
-                response = "[ERROR] Malformed DELETE query. Use the format: DELETE:<domain>:<record_type>"
+        if replicating:
+            last_applied_serial = store.last_applied_serial()  # A restarted worker resumes from the database
+            print(f"[INFO] Replication resumes after change log serial {last_applied_serial}.")
+            listener_thread = threading.Thread(target=listen_for_updates, daemon=True)
         else:
-            try:
-                domain, record_type = query.split(":")
-                response = query_record(domain, record_type)
-            except ValueError:
-                response = "[ERROR] Malformed query. Use the format: <domain>:<record_type>"
-        client_socket.sendall(response.encode())
+            listener_thread = threading.Thread(target=listen_for_invalidations, daemon=True)
+        listener_thread.start()
+        if zone_image_path:
+            if replicating:
+                threading.Thread(target=publish_images, args=(options.image_interval,), daemon=True).start()
+            else:
+                threading.Thread(target=watch_image, daemon=True).start()
+        if options.dns_port:
+            wire_server = dns_wire.WireServer(records.lookup_record, records.domain_exists, records.cached_records)
+            wire_server.start(options.host, options.dns_port, options.dns_udp_workers, options.processes > 1,
+                              options.max_connections)
+
+        server_core.serve(process_query, (options.host, options.port), "Secondary DNS Server",
+                          mode=options.mode, backlog=options.backlog, workers=options.workers,
+                          queue_depth=options.queue_depth, deadline=options.request_deadline_ms / 1000,
+                          reuse_port=options.processes > 1, drain_timeout=options.drain_timeout,
+                          max_connections=options.max_connections)
     except Exception as e:
         print(f"[ERROR] {e}")
-        client_socket.sendall(f"[ERROR] Internal server error: {e}".encode())
-    finally:
-        client_socket.close()
-        print(f"[INFO] Connection closed with {client_address}")
-
-
-def start_server():
-    """Start the secondary DNS server."""
-    init_db()
-
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        server_socket.bind(("127.0.0.1", 8054))
-        server_socket.listen(5)
-        print("[INFO] Secondary DNS Server is listening on 127.0.0.1:8054...")
 
-        listener_thread = threading.Thread(target=listen_for_updates, daemon=True)
-        listener_thread.start()
 
-        while True:
-            client_socket, client_address = server_socket.accept()
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-            client_thread.start()
-    except KeyboardInterrupt:
-        print("\n[INFO] Server shutting down...")
-    except Exception as e:
-        print(f"[ERROR] {e}")
-    finally:
-        server_socket.close()
+def announce_applied(pipe, serial, keys):
+    """Queue a notice telling the other worker processes which cache keys replication changed, up to ``serial``."""
+    if applied_channel:
+        pipe.publish(applied_channel, "\n".join([str(serial)] + keys))
+
+
+def listen_for_invalidations():
+    """Drop in-process cache entries changed by replication in worker 0 or by writes on any secondary.
+
+    Notices published while the subscription was down are lost, so after a
+    reconnect the caches and the image are dropped rather than trusted.
+    """
+    global image
+    reconnecting = False
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(REDIS_CHANNEL, applied_channel)
+            if reconnecting:
+                local_cache.clear()
+                image = None  # Until worker 0 publishes its next image
+            for message in pubsub.listen():
+                if message["channel"] == applied_channel:
+                    if message["data"] == CLEAR_ALL:
+                        local_cache.clear()
+                        image = None  # Until worker 0 publishes an image of the new records
+                        continue
+                    serial, *keys = message["data"].splitlines()
+                    mark_image_dirty(keys, int(serial))
+                else:
+                    # Worker 0 announces the primary's changes once applied; a secondary's own
+                    # writes are already in Redis by the time their unserialed notice is sent
+                    keys = []
+                    for update_message in message["data"].splitlines():
+                        try:
+                            serial, _, domain, record_type, _, _ = replication.parse_update(update_message)
+                        except ValueError:
+                            continue
+                        if serial is None:
+                            keys.append(f"{domain}:{record_type}")
+                    mark_image_dirty(keys)
+                for key in keys:
+                    local_cache.invalidate(key)
+        except redis_cache.UNAVAILABLE as e:
+            print(f"[WARN] Lost the Redis invalidation channel: {e}. Reconnecting...")
+            reconnecting = True
+            time.sleep(1)
 
 
 def listen_for_updates():
-    """Listen for updates from Redis."""
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe(REDIS_CHANNEL)
-    print("[INFO] Listening for updates from Primary DNS Server...")
-    for message in pubsub.listen():
-        if message["type"] == "message":
-            update_message = message["data"]
-            print(f"[INFO] Received update: {update_message}")
-            sync_with_primary(update_message)
+    """Listen for updates from Redis, catching up from the primary's change log on gaps and reconnects."""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(REDIS_CHANNEL)
+            print("[INFO] Listening for updates from Primary DNS Server...")
+            catch_up()  # Covers anything published while we were not subscribed
+            last_poll = time.monotonic()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message and message["type"] == "message":
+                    for update_message in message["data"].splitlines():  # Bulk loads publish one batched notice
+                        print(f"[INFO] Received update: {update_message}")
+                        sync_with_primary(update_message)
+                # A lost final notice leaves no gap to notice, so poll the change log too
+                if time.monotonic() - last_poll >= CATCH_UP_INTERVAL:
+                    catch_up()
+                    last_poll = time.monotonic()
+        except redis_cache.UNAVAILABLE as e:
+            print(f"[WARN] Lost the Redis update channel: {e}. Reconnecting...")
+            catch_up()  # Keep replicating from the change log while Redis is down
+            time.sleep(1)
+
+
+def apply_changes(changes):
+    """Apply serial-ordered ``(serial, action, domain, record_type, value, ttl)`` changes locally."""
+    global last_applied_serial, latest_primary_serial, last_applied_at
+    keys = [f"{domain}:{record_type}" for _, _, domain, record_type, _, _ in changes]
+    mark_image_dirty(keys, changes[-1][0])
+    store.apply_replicated(changes)
+    last_applied_serial = changes[-1][0]
+    latest_primary_serial = max(latest_primary_serial, last_applied_serial)
+    last_applied_at = time.monotonic()
+    pipe = shared_cache.pipeline()
+    for _, action, domain, record_type, value, ttl in changes:
+        if action == "DELETE":
+            pipe.delete(f"{domain}:{record_type}")
+        else:
+            pipe.setex(f"{domain}:{record_type}", ttl or CACHE_TTL, value)
+    announce_applied(pipe, last_applied_serial, keys)
+    try:
+        pipe.execute()
+    except redis_cache.UNAVAILABLE as e:
+        # SQLite is current; Redis keeps any older copies until they expire
+        print(f"[WARN] Could not update Redis with {len(changes)} replicated change(s): {e}")
+    for key in keys:
+        local_cache.invalidate(key)
+
+
+def bootstrap_from_primary():
+    """Replace the local records with a consistent snapshot streamed from the primary.
+
+    Rows go straight from the decompressed stream into SQLite in one transaction,
+    so queries keep seeing the previous data until the load commits. Replication
+    then resumes from the snapshot's change log serial.
+    """
+    global last_applied_serial, needs_resync, image
+    print(f"[INFO] Bootstrapping from primary {primary_address[0]}:{primary_address[1]}...")
+    started = time.monotonic()
+    try:
+        with socket.create_connection(primary_address) as sock:
+            sock.sendall(f"{replication.SNAPSHOT_COMMAND}\n".encode())
+            with sock.makefile("rb") as stream:
+                serial, batches = replication.read_snapshot(stream)
+                image = None  # Every record may change; the next rebuild publishes a new image
+                count = store.replace_all(batches, serial)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Bootstrap from primary failed: {e}")
+        return False
+    last_applied_serial = serial
+    needs_resync = False
+    local_cache.clear()
+    if applied_channel:
+        redis_client.publish(applied_channel, CLEAR_ALL)
+    print(f"[INFO] Loaded {count} records at serial {serial} in {time.monotonic() - started:.1f}s.")
+    return True
+
+
+def catch_up():
+    """Fetch and apply, in batches, every change the primary logged after our last applied serial."""
+    global needs_resync, latest_primary_serial
+    while True:
+        try:
+            response = protocol.request(
+                primary_address, f"CHANGES:{last_applied_serial}:{replication.DEFAULT_CATCH_UP_BATCH}")
+            latest_serial, changes = replication.parse_changes(response)
+            latest_primary_serial = max(latest_primary_serial, latest_serial)
+        except replication.ResyncRequired as e:
+            print(f"[WARN] The primary's change log no longer covers this replica ({e}).")
+            if not bootstrap_from_primary():
+                needs_resync = True  # Retried on the next catch-up
+                return
+            continue
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Could not catch up from primary {primary_address[0]}:{primary_address[1]}: {e}")
+            return
+        if changes:
+            apply_changes(changes)
+            print(f"[INFO] Caught up {len(changes)} change(s) to serial {last_applied_serial}.")
+        if not changes or last_applied_serial >= latest_serial:
+            return
 
 
 def sync_with_primary(update_message):
     """Sync updates from the primary server via Redis."""
+    global latest_primary_serial
     try:
-        action, domain, record_type, *value = update_message.split(":")
-        cache_key = f"{domain}:{record_type}"
-
-        if action == "ADD" or action == "UPDATE":
-            redis_client.setex(cache_key, CACHE_TTL, value[0])
-            print(f"[INFO] Synced {action.lower()} operation for {record_type} record of {domain}: {value[0]}")
-        elif action == "DELETE":
-            redis_client.delete(cache_key)
+        serial, action, domain, record_type, value, ttl = replication.parse_update(update_message)
+        if serial is not None:
+            latest_primary_serial = max(latest_primary_serial, serial)
+        if serial is None:
+            # Written by a secondary, so there is nothing to order; just refresh the cache
+            cache_key = f"{domain}:{record_type}"
+            mark_image_dirty([cache_key])
+            local_cache.invalidate(cache_key)
+            if action == "DELETE":
+                redis_client.delete(cache_key)
+            else:
+                redis_client.setex(cache_key, ttl or CACHE_TTL, value)
+            return
+        if serial > last_applied_serial + 1:
+            print(f"[WARN] Missed changes {last_applied_serial + 1}-{serial - 1}; catching up from the primary.")
+            catch_up()
+        if serial != last_applied_serial + 1:
+            # Either a catch-up already applied it, or we are still behind and applying
+            # it out of order would diverge; the next catch-up will pick it up
+            return
+
+        apply_changes([(serial, action, domain, record_type, value, ttl)])
+        if action == "DELETE":
             print(f"[INFO] Synced delete operation for {record_type} record of {domain}")
         else:
-            print(f"[WARN] Unknown action received: {action}")
+            print(f"[INFO] Synced add operation for {record_type} record of {domain}: {value}")
+    except ValueError as e:
+        print(f"[WARN] {e}")
     except Exception as e:
         print(f"[ERROR] Failed to sync with primary: {e}")
 
 
 if __name__ == "__main__":
-    start_server()
+    start_server(server_core.parse_args("Secondary DNS Server", 8054, configure=add_arguments))
@@ -0,0 +1,750 @@
+import abc
+import argparse
+import asyncio
+import heapq
+import itertools
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+import dns_wire
+import metrics
+import protocol
+import record_cache
+import redis_cache
+
+SERVER_MODES = ("threaded", "async")
+DEFAULT_BACKLOG = 1024  # The kernel silently caps this at net.core.somaxconn
+DEFAULT_WORKERS = 32  # Threads answering requests; bounds concurrent SQLite/Redis work
+DEFAULT_QUEUE_DEPTH = 256  # Requests waiting for a worker before new ones are answered BUSY
+DEFAULT_REQUEST_DEADLINE = 1.0  # Seconds a request may wait for a worker before it is answered BUSY
+DEFAULT_MAX_CONNECTIONS = 1024  # Open connections (and so threads) before new ones are answered BUSY and closed
+READ, WRITE = 0, 1  # Request priorities; reads are taken from the queue first
+WRITE_COMMANDS = ("ADD:", "UPDATE:", "DELETE:")
+BUSY_TAG = protocol.BUSY_TAG  # Starts every response to a request that was turned away without running
+BUSY_RESPONSE = f"{BUSY_TAG} Server is overloaded; try another server"
+MAX_REQUEST_SIZE = 1024
+DEFAULT_DRAIN_TIMEOUT = 10  # Seconds a draining server waits for open connections to finish
+RESTART_DELAY = 1.0  # Seconds before restarting a worker process that crashed right after starting
+
+
+def parse_address(text):
+    """Parse ``host:port`` (or just ``:port``) into an address tuple for argparse."""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def parse_args(description, default_port, argv=None, configure=None):
+    """Parse the command line options shared by the primary and secondary servers.
+
+    ``configure`` may add server-specific options to the parser before parsing.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=default_port, help=f"TCP port to bind (default: {default_port})")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="threaded",
+                        help="Connection handling model: one thread per connection, or a single asyncio event loop")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help=f"Listen backlog for pending connections (default: {DEFAULT_BACKLOG})")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Threads answering requests (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help="Requests that may wait for a worker thread; beyond that they are answered [BUSY] "
+                             f"(default: {DEFAULT_QUEUE_DEPTH})")
+    parser.add_argument("--request-deadline-ms", type=float, default=DEFAULT_REQUEST_DEADLINE * 1000,
+                        help="Milliseconds a request may wait for a worker thread before it is answered [BUSY] "
+                             f"instead (default: {DEFAULT_REQUEST_DEADLINE * 1000:g})")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="Open connections per listener, including the DNS TCP one; beyond that new ones are "
+                             f"turned away (default: {DEFAULT_MAX_CONNECTIONS})")
+    parser.add_argument("--l1-size", type=int, default=record_cache.DEFAULT_MAX_ENTRIES,
+                        help="Maximum records held in the in-process cache, 0 to disable "
+                             f"(default: {record_cache.DEFAULT_MAX_ENTRIES})")
+    parser.add_argument("--l1-ttl", type=int, default=record_cache.DEFAULT_TTL,
+                        help=f"Seconds a record may stay in the in-process cache (default: {record_cache.DEFAULT_TTL})")
+    parser.add_argument("--negative-ttl", type=int, default=record_cache.DEFAULT_NEGATIVE_TTL,
+                        help="Seconds a not-found lookup is cached in Redis and in-process, 0 to disable "
+                             f"(default: {record_cache.DEFAULT_NEGATIVE_TTL})")
+    parser.add_argument("--fill-lock-ms", type=int, default=redis_cache.DEFAULT_FILL_LOCK_MS,
+                        help="Lock a missing record in Redis for this long while one process reads it from SQLite, "
+                             "so other processes and servers wait for its fill; 0 to disable "
+                             f"(default: {redis_cache.DEFAULT_FILL_LOCK_MS})")
+    parser.add_argument("--refresh-interval", type=float, default=redis_cache.DEFAULT_REFRESH_INTERVAL,
+                        help="Seconds between passes that reload hot records before their Redis keys expire, "
+                             f"0 to disable (default: {redis_cache.DEFAULT_REFRESH_INTERVAL:g})")
+    parser.add_argument("--hot-keys", type=int, default=record_cache.DEFAULT_HOT_KEYS,
+                        help="Most-looked-up records to track and save to --hot-keys-file, 0 to disable "
+                             f"(default: {record_cache.DEFAULT_HOT_KEYS})")
+    parser.add_argument("--hot-keys-file", default=None,
+                        help="File the hot records are saved to every minute and warmed from on startup "
+                             f"(default: {record_cache.DEFAULT_HOT_KEYS_FILE.format(port='<port>')})")
+    parser.add_argument("--warm-up-budget", type=float, default=redis_cache.DEFAULT_WARM_UP_BUDGET,
+                        help="Seconds to spend loading the saved hot records into Redis and the in-process cache "
+                             f"before listening, 0 to skip (default: {redis_cache.DEFAULT_WARM_UP_BUDGET:g})")
+    parser.add_argument("--dns-port", type=int, default=None,
+                        help="Also answer standard DNS queries over UDP and TCP on this port (default: off)")
+    parser.add_argument("--dns-udp-workers", type=int, default=dns_wire.DEFAULT_UDP_WORKERS,
+                        help=f"Threads reading the DNS UDP socket (default: {dns_wire.DEFAULT_UDP_WORKERS})")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics over HTTP on this port; worker process N uses port + N "
+                             "(default: off)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Worker processes sharing the port through SO_REUSEPORT, restarted if they crash "
+                             "(default: 1)")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="Seconds to let open connections finish after SIGTERM "
+                             f"(default: {DEFAULT_DRAIN_TIMEOUT})")
+    if configure:
+        configure(parser)
+    options = parser.parse_args(argv)
+    if options.hot_keys_file is None:
+        options.hot_keys_file = record_cache.DEFAULT_HOT_KEYS_FILE.format(port=options.port)
+    return options
+
+
+class Busy(Exception):
+    """Raised for a request turned away, without running it, because the server is saturated."""
+
+
+class RequestPool:
+    """A fixed set of worker threads answering requests from a bounded queue, reads before writes.
+
+    ``submit()`` raises Busy at once while ``queue_depth`` requests are already
+    waiting, and a request still waiting ``deadline`` seconds after it arrived
+    fails with Busy instead of running, since its client has likely given up.
+    Either way the request never ran, so a client may safely send it to
+    another server. However hard the server is pushed, the thread count (and
+    with it the number of SQLite connections) stays fixed, and requests that
+    are answered are answered within their deadline.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH, deadline=DEFAULT_REQUEST_DEADLINE):
+        self.queue_depth = queue_depth
+        self.deadline = deadline
+        self._queue = []  # Heap of (priority, sequence, queued_at, future, function, args)
+        self._sequence = itertools.count()  # Keeps each priority first-in, first-out
+        self._ready = threading.Condition()
+        self._stopped = False
+        for index in range(workers):
+            threading.Thread(target=self._run, name=f"dns-worker-{index}", daemon=True).start()
+
+    def __len__(self):
+        with self._ready:
+            return len(self._queue)
+
+    def submit(self, priority, function, *args):
+        """Queue ``function(*args)`` and return a Future for its result; raises Busy if the queue is full."""
+        future = Future()
+        with self._ready:
+            if self._stopped or len(self._queue) >= self.queue_depth:
+                metrics.inc("dns_requests_shed_total", 'reason="queue_full"')
+                raise Busy("request queue is full")
+            heapq.heappush(self._queue, (priority, next(self._sequence), time.monotonic(), future, function, args))
+            self._ready.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue:
+                    if self._stopped:
+                        return
+                    self._ready.wait()
+                _, _, queued_at, future, function, args = heapq.heappop(self._queue)
+            waited = time.monotonic() - queued_at
+            metrics.observe("dns_request_queue_seconds", "", waited)
+            if not future.set_running_or_notify_cancel():
+                continue  # Cancelled by its caller while it waited; nobody wants the answer
+            if waited > self.deadline:
+                metrics.inc("dns_requests_shed_total", 'reason="deadline"')
+                future.set_exception(Busy(f"waited {waited:.3f}s for a worker"))
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        """Stop the workers once they finish their current request, answering everything still queued Busy."""
+        with self._ready:
+            self._stopped = True
+            for entry in self._queue:
+                if entry[3].set_running_or_notify_cancel():
+                    entry[3].set_exception(Busy("server is shutting down"))
+            self._queue.clear()
+            self._ready.notify_all()
+
+
+class _LineStream(abc.ABC):
+    """Byte stream handed to stream command handlers, readable line by line."""
+
+    def __init__(self, initial=b""):
+        self._buffer = bytearray(initial)
+        self._eof = False
+
+    @abc.abstractmethod
+    def _recv(self):
+        """Return the next chunk the client sent, or b"" once it has finished sending."""
+
+    def readline(self):
+        """Return the next line including its newline, or b"" once the client has finished sending."""
+        while True:
+            index = self._buffer.find(b"\n")
+            if index >= 0:
+                line = bytes(self._buffer[:index + 1])
+                del self._buffer[:index + 1]
+                return line
+            if self._eof:
+                line = bytes(self._buffer)
+                self._buffer.clear()
+                return line
+            chunk = self._recv()
+            if chunk:
+                self._buffer += chunk
+            else:
+                self._eof = True
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    @abc.abstractmethod
+    def write(self, data):
+        """Send ``data`` to the client."""
+
+
+class _SocketStream(_LineStream):
+    def __init__(self, sock, initial=b""):
+        super().__init__(initial)
+        self._sock = sock
+
+    def _recv(self):
+        return self._sock.recv(65536)
+
+    def write(self, data):
+        self._sock.sendall(data)
+
+
+class _LoopStream(_LineStream):
+    """Blocking view of an asyncio connection for handlers running on a thread."""
+
+    def __init__(self, reader, writer, loop, initial=b""):
+        super().__init__(initial)
+        self._reader = reader
+        self._writer = writer
+        self._loop = loop
+
+    def _recv(self):
+        return asyncio.run_coroutine_threadsafe(self._reader.read(65536), self._loop).result()
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+
+
+class _OpenConnections:
+    """Connections a server has accepted, so a drain can wait for them to finish or cut them short.
+
+    One-shot v1 connections finish on their own. Persistent v2 connections only
+    close when their client does, so draining first stops reading new requests
+    from them; requests already read are still answered.
+    """
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._open = {}  # connection -> callable that aborts it
+        self._persistent = {}  # connection -> callable that stops reading requests from it
+        self.draining = False
+
+    def __len__(self):
+        with self._changed:
+            return len(self._open)
+
+    def add(self, connection, abort):
+        with self._changed:
+            self._open[connection] = abort
+
+    def persistent(self, connection, stop_reading):
+        """Mark ``connection`` as a v2 connection; it stops reading at once if a drain has begun."""
+        with self._changed:
+            self._persistent[connection] = stop_reading
+            draining = self.draining
+        if draining:
+            stop_reading()
+
+    def remove(self, connection):
+        with self._changed:
+            self._open.pop(connection, None)
+            self._persistent.pop(connection, None)
+            self._changed.notify_all()
+
+    def stop_reading(self):
+        """Begin draining: stop reading new requests from every persistent connection."""
+        with self._changed:
+            self.draining = True
+            callbacks = list(self._persistent.values())
+        for stop_reading in callbacks:
+            stop_reading()
+
+    def wait_closed(self, timeout):
+        """Wait up to ``timeout`` seconds for every connection to close; return how many are still open."""
+        with self._changed:
+            self._changed.wait_for(lambda: not self._open, timeout)
+            return len(self._open)
+
+    def abort_all(self):
+        with self._changed:
+            callbacks = list(self._open.values())
+        for abort in callbacks:
+            abort()
+
+
+def _shutdown_socket(sock, how):
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass  # Already closed by the client or by the handler
+
+
+def _stop_reading_stream(reader, writer):
+    """Make an asyncio connection's reader see EOF, ignoring anything the client sends afterwards."""
+    if not writer.is_closing():
+        writer.transport.pause_reading()
+    reader.feed_eof()
+
+
+def create_listener(address, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    """Bind a listening TCP socket; ``reuse_port`` lets several worker processes share the port."""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        server_socket.bind(address)
+        server_socket.listen(backlog)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+
+def _on_sigterm(callback):
+    """Run ``callback`` on SIGTERM; signal handlers can only be set from the main thread."""
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: callback())
+
+
+def _find_stream_handler(stream_handlers, data):
+    """Return the handler whose command prefix starts ``data``, if any, timed under that prefix."""
+    for prefix, handler in (stream_handlers or {}).items():
+        if data.startswith(prefix.encode()):
+            labels = f'command="{prefix.rstrip(":")}"'
+
+            def timed(header, stream):
+                started = time.perf_counter()
+                try:
+                    return handler(header, stream)
+                finally:
+                    metrics.observe("dns_stream_duration_seconds", labels, time.perf_counter() - started)
+            return timed
+    return None
+
+
+def _dispatch(process_query, query):
+    """Answer one text protocol request, recording its latency; ``STATS`` is answered here."""
+    started = time.perf_counter()
+    try:
+        if query.strip() == metrics.STATS_COMMAND:
+            return metrics.registry.render_stats()
+        return process_query(query)
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        return f"[ERROR] Internal server error: {e}"
+    finally:
+        metrics.observe("dns_request_duration_seconds", metrics.command_label(query), time.perf_counter() - started)
+
+
+def _submit(pool, process_query, query):
+    """Queue one text protocol request on ``pool``, writes behind reads; raises Busy if it is full."""
+    priority = WRITE if query.startswith(WRITE_COMMANDS) else READ
+    return pool.submit(priority, _dispatch, process_query, query)
+
+
+def _answer(pool, process_query, query):
+    """Answer one request on a worker thread and wait for it, or return BUSY_RESPONSE."""
+    try:
+        return _submit(pool, process_query, query).result()
+    except Busy:
+        return BUSY_RESPONSE
+
+
+def _serve_v2_socket(client_socket, initial, process_query, pool):
+    """Serve framed v2 requests on a persistent connection until the client closes it.
+
+    Requests are queued on the worker pool as soon as they are read, and each
+    response is written back as soon as it is ready, so responses may arrive out
+    of order.
+    """
+    reader = protocol.FrameReader(client_socket, initial)
+    reader.expect_preamble()
+    client_socket.sendall(protocol.MAGIC)
+    write_lock = threading.Lock()
+    in_flight = 0
+    all_answered = threading.Condition()
+
+    def send(request_id, response):
+        frame = protocol.encode_frame(request_id, response)
+        with write_lock:
+            try:
+                client_socket.sendall(frame)
+            except OSError:
+                pass  # The client went away; nothing left to deliver to
+
+    def respond(request_id, future):
+        nonlocal in_flight
+        try:
+            response = future.result()
+        except Busy:
+            response = BUSY_RESPONSE
+        except Exception as e:
+            response = f"[ERROR] Internal server error: {e}"
+        send(request_id, response)
+        with all_answered:
+            in_flight -= 1
+            all_answered.notify_all()
+
+    try:
+        while True:
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            request_id, query = frame
+            try:
+                future = _submit(pool, process_query, query)
+            except Busy:
+                send(request_id, BUSY_RESPONSE)
+                continue
+            with all_answered:
+                in_flight += 1
+            future.add_done_callback(lambda future, request_id=request_id: respond(request_id, future))
+    finally:
+        with all_answered:
+            all_answered.wait_for(lambda: in_flight == 0)
+
+
+def handle_client(client_socket, client_address, process_query, pool, stream_handlers=None, connections=None):
+    """Handle incoming client requests.
+
+    ``stream_handlers`` maps command prefixes such as ``"BULK:"`` to callables
+    taking ``(header, stream)``. They own the rest of the connection, reading the
+    client's upload line by line and writing their response directly.
+    ``connections`` tracks the socket so a draining server can wait for it.
+    """
+    print(f"[INFO] Connection established with {client_address}")
+    metrics.inc("dns_connections_total")
+    metrics.inc("dns_connections_active")
+    try:
+        data = client_socket.recv(MAX_REQUEST_SIZE)
+        stream_handler = _find_stream_handler(stream_handlers, data)
+        if protocol.is_v2_preamble(data):
+            if connections is not None:
+                connections.persistent(client_socket, lambda: _shutdown_socket(client_socket, socket.SHUT_RD))
+            _serve_v2_socket(client_socket, data, process_query, pool)
+        elif stream_handler:
+            header, _, rest = data.partition(b"\n")
+            stream_handler(header.decode().strip(), _SocketStream(client_socket, rest))
+        else:
+            response = _answer(pool, process_query, data.decode())
+            client_socket.sendall(response.encode())
+    except protocol.ProtocolError as e:
+        print(f"[WARN] Dropping connection with {client_address}: {e}")
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        client_socket.sendall(f"[ERROR] Internal server error: {e}".encode())
+    finally:
+        client_socket.close()
+        if connections is not None:
+            connections.remove(client_socket)
+        metrics.inc("dns_connections_active", amount=-1)
+        print(f"[INFO] Connection closed with {client_address}")
+
+
+def _turn_away(client_socket):
+    """Answer a connection over the limit with BUSY_RESPONSE, without reading from it, and close it."""
+    metrics.inc("dns_requests_shed_total", 'reason="connections"')
+    try:
+        client_socket.setblocking(False)  # Never let a slow client stall the accept loop
+        client_socket.send(BUSY_RESPONSE.encode())
+    except OSError:
+        pass
+    client_socket.close()
+
+
+def serve_threaded(process_query, address, name, backlog=DEFAULT_BACKLOG, pool=None,
+                   stream_handlers=None, reuse_port=False, drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+                   max_connections=DEFAULT_MAX_CONNECTIONS):
+    """Accept connections until SIGTERM, then drain them.
+
+    Each connection gets a thread that reads its requests and writes the
+    answers, while the requests themselves run on ``pool``. Once
+    ``max_connections`` are open, new ones are answered BUSY and closed.
+    """
+    if pool is None:
+        pool = RequestPool()
+    connection_slots = threading.BoundedSemaphore(max_connections)
+
+    def serve_client(client_socket, client_address):
+        try:
+            handle_client(client_socket, client_address, process_query, pool, stream_handlers, connections)
+        finally:
+            connection_slots.release()
+
+    connections = _OpenConnections()
+    server_socket = create_listener(address, backlog, reuse_port)
+    draining = threading.Event()
+
+    def start_draining():
+        draining.set()
+        server_socket.close()  # Wakes accept() with EBADF
+
+    _on_sigterm(start_draining)
+    try:
+        print(f"[INFO] {name} is listening on {address[0]}:{address[1]}...")
+        while True:
+            try:
+                client_socket, client_address = server_socket.accept()
+            except OSError:
+                if draining.is_set():
+                    break
+                raise
+            if not connection_slots.acquire(blocking=False):
+                _turn_away(client_socket)
+                continue
+            connections.add(client_socket, lambda sock=client_socket: _shutdown_socket(sock, socket.SHUT_RDWR))
+            client_thread = threading.Thread(target=serve_client, args=(client_socket, client_address))
+            client_thread.start()
+        print(f"[INFO] {name} is draining {len(connections)} open connection(s)...")
+        connections.stop_reading()
+        still_open = connections.wait_closed(drain_timeout)
+        if still_open:
+            print(f"[WARN] Closing {still_open} connection(s) still open after {drain_timeout:g}s.")
+            connections.abort_all()
+    finally:
+        server_socket.close()
+        pool.shutdown()
+
+
+async def _answer_async(pool, process_query, query):
+    """Answer one request on a worker thread without blocking the event loop, or return BUSY_RESPONSE."""
+    try:
+        return await asyncio.wrap_future(_submit(pool, process_query, query))
+    except Busy:
+        return BUSY_RESPONSE
+
+
+async def _serve_v2_stream(reader, writer, process_query, pool):
+    """Serve framed v2 requests from the event loop until the client closes the connection."""
+    preamble = await reader.readexactly(len(protocol.MAGIC) - 1)
+    if preamble != protocol.MAGIC[1:]:
+        raise protocol.ProtocolError("Invalid protocol preamble")
+    writer.write(protocol.MAGIC)
+    in_flight = set()
+
+    async def respond(request_id, query):
+        response = await _answer_async(pool, process_query, query)
+        if not writer.is_closing():
+            writer.write(protocol.encode_frame(request_id, response))
+            await writer.drain()
+
+    while True:
+        frame = await protocol.read_frame_async(reader)
+        if frame is None:
+            break
+        task = asyncio.create_task(respond(*frame))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def _handle_async_client(reader, writer, process_query, pool, stream_handlers=None, connections=None):
+    """Serve one connection from the event loop, running the blocking lookups on the worker pool."""
+    client_address = writer.get_extra_info("peername")
+    print(f"[INFO] Connection established with {client_address}")
+    metrics.inc("dns_connections_total")
+    metrics.inc("dns_connections_active")
+    if connections is not None:
+        connections.add(writer, writer.transport.abort)
+    try:
+        # Peek at one byte so a v2 preamble is never consumed as part of a v1 request
+        first = await reader.read(1)
+        if protocol.is_v2_preamble(first):
+            if connections is not None:
+                connections.persistent(writer, lambda: _stop_reading_stream(reader, writer))
+            await _serve_v2_stream(reader, writer, process_query, pool)
+        elif first:
+            data = first + await reader.read(MAX_REQUEST_SIZE - 1)
+            loop = asyncio.get_running_loop()
+            stream_handler = _find_stream_handler(stream_handlers, data)
+            if stream_handler:
+                header, _, rest = data.partition(b"\n")
+                stream = _LoopStream(reader, writer, loop, rest)
+                # Long uploads and exports run beside the pool rather than holding its workers
+                await loop.run_in_executor(None, stream_handler, header.decode().strip(), stream)
+            else:
+                response = await _answer_async(pool, process_query, data.decode())
+                writer.write(response.encode())
+                await writer.drain()
+    except (protocol.ProtocolError, asyncio.IncompleteReadError) as e:
+        print(f"[WARN] Dropping connection with {client_address}: {e}")
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        writer.write(f"[ERROR] Internal server error: {e}".encode())
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        if connections is not None:
+            connections.remove(writer)
+        metrics.inc("dns_connections_active", amount=-1)
+        print(f"[INFO] Connection closed with {client_address}")
+
+
+async def _serve_async(process_query, address, name, backlog, pool, stream_handlers, reuse_port, drain_timeout):
+    connections = _OpenConnections()
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_async_client(reader, writer, process_query, pool, stream_handlers,
+                                                    connections),
+        host=address[0],
+        port=address[1],
+        backlog=backlog,
+        reuse_address=True,
+        reuse_port=reuse_port,
+    )
+    loop = asyncio.get_running_loop()
+    draining = asyncio.Event()
+    if threading.current_thread() is threading.main_thread():
+        loop.add_signal_handler(signal.SIGTERM, draining.set)
+    print(f"[INFO] {name} is listening on {address[0]}:{address[1]} (asyncio)...")
+    try:
+        async with server:
+            await draining.wait()
+            server.close()
+            print(f"[INFO] {name} is draining {len(connections)} open connection(s)...")
+            connections.stop_reading()
+            still_open = await loop.run_in_executor(None, connections.wait_closed, drain_timeout)
+            if still_open:
+                print(f"[WARN] Closing {still_open} connection(s) still open after {drain_timeout:g}s.")
+                connections.abort_all()
+    finally:
+        pool.shutdown()
+
+
+def serve_async(process_query, address, name, backlog=DEFAULT_BACKLOG, pool=None,
+                stream_handlers=None, reuse_port=False, drain_timeout=DEFAULT_DRAIN_TIMEOUT):
+    """Serve every connection from a single asyncio event loop until SIGTERM, then drain them."""
+    asyncio.run(_serve_async(process_query, address, name, backlog, pool if pool is not None else RequestPool(),
+                             stream_handlers, reuse_port, drain_timeout))
+
+
+def serve(process_query, address, name, mode="threaded", backlog=DEFAULT_BACKLOG, workers=DEFAULT_WORKERS,
+          queue_depth=DEFAULT_QUEUE_DEPTH, deadline=DEFAULT_REQUEST_DEADLINE, stream_handlers=None,
+          reuse_port=False, drain_timeout=DEFAULT_DRAIN_TIMEOUT, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """Run the accept loop selected by ``mode`` until interrupted or drained by SIGTERM.
+
+    Requests run on a RequestPool of ``workers`` threads with ``queue_depth``
+    waiting slots and a ``deadline`` in seconds for getting a worker. In
+    threaded mode at most ``max_connections`` connections are served at once.
+    """
+    pool = RequestPool(workers, queue_depth, deadline)
+    metrics.gauge("dns_request_queue_length", "Requests waiting for a worker thread", lambda: len(pool))
+    try:
+        if mode == "async":
+            serve_async(process_query, address, name, backlog, pool, stream_handlers, reuse_port, drain_timeout)
+        else:
+            serve_threaded(process_query, address, name, backlog, pool, stream_handlers, reuse_port,
+                           drain_timeout, max_connections)
+        print(f"[INFO] {name} drained and stopped.")
+    except KeyboardInterrupt:
+        print("\n[INFO] Server shutting down...")
+
+
+def supervise(name, processes, run_worker):
+    """Run ``run_worker(index)`` in ``processes`` forked worker processes, restarting any that exit.
+
+    The workers bind their ports with SO_REUSEPORT, so the kernel spreads new
+    connections across them and each gets its own GIL. SIGTERM or SIGINT is
+    passed on to every worker as SIGTERM, and each drains its connections
+    before exiting. A worker sent SIGTERM on its own drains and is replaced,
+    which allows rolling restarts.
+    """
+    workers = {}  # pid -> (index, started_at)
+    stopping = False
+
+    def spawn(index):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Ctrl-C reaches the whole process group; the supervisor turns it into a drain
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 1
+            try:
+                run_worker(index)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        workers[pid] = (index, time.monotonic())
+        print(f"[INFO] Started {name} worker {index} (pid {pid}).")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(processes):
+        spawn(index)
+    print(f"[INFO] {name} supervisor (pid {os.getpid()}) is running {processes} worker processes.")
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started_at = workers.pop(pid, (None, None))
+        if index is None:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if stopping:
+            print(f"[INFO] {name} worker {index} exited.")
+            continue
+        print(f"[WARN] {name} worker {index} (pid {pid}) exited with status {code}; restarting it.")
+        if time.monotonic() - started_at < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)  # Do not spin on a worker that fails during startup
+        if not stopping:
+            spawn(index)
+    print(f"[INFO] {name} stopped.")
@@ -0,0 +1,261 @@
+"""Inspect a shard map and move records between shards without downtime.
+
+Examples:
+    python shard_tool.py owner shards.json www.example.com example.org
+    python shard_tool.py rebalance shards.json --ring a,b,c
+
+To add a shard, start its primary and secondary (with their own Redis), add it
+to the ``shards`` section of the map, and rebalance to a ring that includes it.
+A rebalance runs in five steps:
+
+1. Stage: the map gets a ``next_ring``. Clients pick it up and start sending
+   writes for moving domains to their next owner as well as their current one.
+2. Copy: every current owner streams a SNAPSHOT, and the records that move are
+   fed into their next owner's BULK import.
+3. Replay: changes each source logged after its snapshot are replayed onto the
+   next owners, until a pass has nothing left to replay.
+4. Cut over: ``next_ring`` becomes ``ring``, so moved domains are read from
+   their new owner.
+5. Clean up: records each old owner no longer owns are deleted from it (skip
+   with ``--keep-source``).
+
+If a rebalance fails part way, the map stays staged, and writes keep reaching
+both owners. Running the same command again starts the copy over, or, once
+cut over, just repeats the clean-up.
+"""
+import argparse
+import socket
+import sys
+import time
+
+import dns_client
+import protocol
+import replication
+import sharding
+import zone_io
+
+DEFAULT_SETTLE = 2 * sharding.MAP_RELOAD_INTERVAL + 1  # Seconds for every client to load a changed map
+CLEANUP_CONCURRENCY = 64
+
+
+def show_owners(shard_map, domains):
+    """Print the registrable domain and owning shard of each domain."""
+    for domain in domains:
+        line = f"{domain}: {sharding.registrable_domain(domain)} -> {shard_map.owner(domain)}"
+        if shard_map.next_ring is not None:
+            line += f" (moving to {shard_map.next_ring.owner(domain)})"
+        print(line)
+
+
+class _BulkUpload:
+    """A streaming ``BULK:csv`` upload to one shard's primary."""
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.sendall(b"BULK:csv\n")
+
+    def send(self, records):
+        self.sock.sendall(zone_io.format_records(records, "csv").encode())
+
+    def finish(self):
+        """Mark the end of the upload and return the server's summary."""
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            with self.sock.makefile("rb") as response:
+                summary = response.read().decode()
+        finally:
+            self.sock.close()
+        if summary.startswith("[ERROR]") or not summary:
+            raise ValueError(f"Bulk import failed: {summary or 'no response'}")
+        return summary
+
+
+def _is_moving(staged, source, domain):
+    return staged.owner(domain) == source and staged.next_ring.owner(domain) != source
+
+
+def _read_snapshot(address):
+    """Open a SNAPSHOT stream from ``address``; returns ``(sock, serial, batches)``."""
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall(f"{replication.SNAPSHOT_COMMAND}\n".encode())
+        serial, batches = replication.read_snapshot(sock.makefile("rb"))
+    except Exception:
+        sock.close()
+        raise
+    return sock, serial, batches
+
+
+def copy_moving_records(staged, source):
+    """Copy ``source``'s records that change owner into their next owners; return the snapshot's serial."""
+    uploads = {}
+    copied = 0
+    sock, serial, batches = _read_snapshot(staged.shards[source]["primary"])
+    try:
+        for rows in batches:
+            by_target = {}
+            for row in rows:
+                if _is_moving(staged, source, row[0]):
+                    by_target.setdefault(staged.next_ring.owner(row[0]), []).append(row)
+            for target, records in by_target.items():
+                if target not in uploads:
+                    uploads[target] = _BulkUpload(staged.shards[target]["primary"])
+                uploads[target].send(records)
+                copied += len(records)
+        for target, upload in uploads.items():
+            print(f"[INFO] {source} -> {target}: {upload.finish()}")
+    finally:
+        sock.close()
+        for upload in uploads.values():
+            upload.sock.close()
+    print(f"[INFO] Copied {copied} records off {source} as of serial {serial}.")
+    return serial
+
+
+def _apply_to_target(address, changes):
+    """Apply ``(action, domain, record_type, value, ttl)`` changes to one primary."""
+    added = [change[1:] for change in changes if change[0] == "ADD"]
+    if added:
+        # BULK rather than ADD commands, so values containing ":" survive
+        upload = _BulkUpload(address)
+        upload.send(added)
+        upload.finish()
+    for action, domain, record_type, _, _ in changes:
+        if action == "DELETE":
+            response = protocol.request(address, f"DELETE:{domain}:{record_type}")
+            if response.startswith("[ERROR]"):
+                raise ValueError(response)
+
+
+def read_changes(address, serial):
+    """Return ``(serial, changes)``: every change ``address`` logged after ``serial``, and the last serial read."""
+    changes = []
+    while True:
+        response = protocol.request(address, f"CHANGES:{serial}:{replication.DEFAULT_CATCH_UP_BATCH}")
+        latest, batch = replication.parse_changes(response)
+        changes.extend(batch)
+        if batch:
+            serial = batch[-1][0]
+        if not batch or serial >= latest:
+            return serial, changes
+
+
+def replay_changes(staged, source, serial, keys=None):
+    """Replay the newest change ``source`` logged after ``serial`` for each moving key onto its next owner.
+
+    With ``keys``, only those ``(domain, record_type)`` keys are replayed.
+    Returns ``(serial, replayed)``: the last serial read and the keys replayed.
+    """
+    serial, changes = read_changes(staged.shards[source]["primary"], serial)
+    newest = {}
+    for _, action, domain, record_type, value, ttl in changes:
+        key = (domain, record_type)
+        if _is_moving(staged, source, domain) and (keys is None or key in keys):
+            newest[key] = (action, domain, record_type, value, ttl)
+    by_target = {}
+    for change in newest.values():
+        by_target.setdefault(staged.next_ring.owner(change[1]), []).append(change)
+    for target, target_changes in by_target.items():
+        _apply_to_target(staged.shards[target]["primary"], target_changes)
+    return serial, set(newest)
+
+
+def catch_up_next_owners(staged, positions):
+    """Replay changes made since the copy until no replayed key has been written again.
+
+    Clients write to the current owner before the next one, so any write the
+    next owner already holds is in the current owner's log. A replay can only
+    overwrite a newer write to a key it replays, so the pass after it
+    re-replays just those keys. The move has caught up once a pass replays
+    nothing.
+    """
+    pending = {source: None for source in staged.ring.names}  # None: replay every moving key
+    while True:
+        for source in staged.ring.names:
+            positions[source], pending[source] = replay_changes(staged, source, positions[source], pending[source])
+        replayed = sum(len(keys) for keys in pending.values())
+        if not replayed:
+            return
+        print(f"[INFO] Replayed the latest change to {replayed} records written during the move.")
+
+
+def delete_moved_records(shard_map, source):
+    """Delete every record ``source`` holds but no longer owns under ``shard_map``."""
+    client = dns_client.DnsClient([shard_map.shards[source]["primary"]])
+    deleted = errors = 0
+    sock, _, batches = _read_snapshot(shard_map.shards[source]["primary"])
+    try:
+        deletes = (f"DELETE:{domain}:{record_type}" for rows in batches
+                   for domain, record_type, *_ in rows if shard_map.owner(domain) != source)
+        for _, response in client.query_many(deletes, CLEANUP_CONCURRENCY):
+            if response.startswith("[ERROR]"):
+                errors += 1
+            else:
+                deleted += 1
+    finally:
+        sock.close()
+        client.close()
+    print(f"[INFO] Deleted {deleted} moved records from {source}"
+          + (f"; {errors} deletes failed, rerun the rebalance to retry them." if errors else "."))
+
+
+def rebalance(path, ring, settle, keep_source):
+    """Move records so that the shard map at ``path`` places domains on ``ring``, without downtime."""
+    current = sharding.load_shard_map(path)
+    if current.next_ring is not None and current.next_ring.names != ring:
+        raise ValueError(f"A move to ring {','.join(current.next_ring.names)} is already staged; finish it first")
+    staged = current.staged(ring)
+    if staged.next_ring is not None:
+        sharding.save_shard_map(staged, path)
+        print(f"[INFO] Staged ring {','.join(ring)}; waiting {settle:g}s for clients to write to both owners...")
+        time.sleep(settle)
+
+        positions = {source: copy_moving_records(staged, source) for source in staged.ring.names}
+        catch_up_next_owners(staged, positions)
+
+        sharding.save_shard_map(staged.cut_over(), path)
+        print(f"[INFO] Cut over to ring {','.join(ring)}; waiting {settle:g}s for clients to reload...")
+        time.sleep(settle)
+    else:
+        print(f"[INFO] The ring is already {','.join(ring)}; only cleaning up.")
+    if keep_source:
+        return
+    final = staged.cut_over()
+    for source in current.ring.names:
+        delete_moved_records(final, source)
+
+
+def _ring(text):
+    return [name.strip() for name in text.split(",") if name.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a shard map or move records onto a new shard ring.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    owner = commands.add_parser("owner", help="Show which shard owns each domain")
+    owner.add_argument("map", help="Shard map JSON file")
+    owner.add_argument("domains", nargs="+")
+    move = commands.add_parser("rebalance", help="Move records onto a new ring while clients keep running")
+    move.add_argument("map", help="Shard map JSON file; rewritten in place as the move progresses")
+    move.add_argument("--ring", type=_ring, required=True, help="Shard names of the new ring, e.g. a,b,c")
+    move.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                      help=f"Seconds to wait for clients after each map change (default: {DEFAULT_SETTLE:g})")
+    move.add_argument("--keep-source", action="store_true",
+                      help="Leave moved records on their old shard instead of deleting them")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "owner":
+            show_owners(sharding.load_shard_map(args.map), args.domains)
+        else:
+            rebalance(args.map, args.ring, args.settle, args.keep_source)
+    except replication.ResyncRequired as e:
+        print(f"[ERROR] A source trimmed changes the move still needed ({e}); run the rebalance again.")
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
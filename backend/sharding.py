@@ -0,0 +1,179 @@
+"""Consistent-hash assignment of domains to primary/secondary shard pairs.
+
+A shard map is a JSON file read by ``dns_client.py``, the web app and
+``shard_tool.py``:
+
+    {
+      "vnodes": 64,
+      "shards": {
+        "a": {"primary": "10.0.0.1:8053", "secondaries": ["10.0.0.2:8054"]},
+        "b": {"primary": "10.0.1.1:8053", "secondaries": ["10.0.1.2:8054"]}
+      },
+      "ring": ["a", "b"]
+    }
+
+Names are placed on the ring by their registrable domain (``www.example.co.uk``
+hashes as ``example.co.uk``), so a zone and everything below it live on one
+shard and wildcard and LIST answers never need another shard. Every shard pair
+runs its own Redis, since replication notices are not shard-aware.
+
+While ``shard_tool.py rebalance`` moves records, the map also has a
+``next_ring``. Reads still go to the owner on ``ring``, and writes go to the
+owners on both rings, so neither loses a write during the move.
+"""
+import bisect
+import hashlib
+import json
+import os
+
+import server_core
+
+DEFAULT_VNODES = 64  # Ring points per shard; more points spread domains more evenly
+MAP_RELOAD_INTERVAL = 2.0  # Seconds between checks of the shard map file for changes
+# Public suffixes with more than one label; any other name is registered directly below its TLD
+MULTI_LABEL_SUFFIXES = frozenset((
+    "co.uk", "org.uk", "ac.uk", "gov.uk", "me.uk", "com.au", "net.au", "org.au", "co.nz", "co.jp", "ne.jp",
+    "or.jp", "com.br", "com.cn", "co.in", "co.za", "com.mx", "com.tr", "in-addr.arpa", "ip6.arpa",
+))
+
+
+def registrable_domain(domain):
+    """Return the name ``domain`` is registered under, e.g. ``example.co.uk`` for ``www.example.co.uk``."""
+    labels = domain.strip(".").lower().split(".")
+    if len(labels) > 2 and ".".join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def spans_shards(zone):
+    """Return True if names below ``zone`` can be registered separately, and so live on different shards."""
+    return registrable_domain(f"_.{zone.strip('.')}") != registrable_domain(zone)
+
+
+def query_domain(query):
+    """Return the domain a text protocol request is about, or None for server-wide commands."""
+    fields = query.strip().split(":")
+    if fields[0] in ("ADD", "UPDATE", "DELETE", "LIST"):
+        return fields[1] if len(fields) > 1 and fields[1] else None
+    if len(fields) == 2 and fields[0] and fields[0] not in ("STATS", "SNAPSHOT", "CHANGES", "BULK", "EXPORT", "SCAN"):
+        return fields[0]
+    return None
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring with ``vnodes`` points per shard.
+
+    Adding a shard to a ring of N moves only about 1/(N+1) of the domains, all
+    of them onto the new shard.
+    """
+
+    def __init__(self, names, vnodes=DEFAULT_VNODES):
+        if not names:
+            raise ValueError("A shard ring needs at least one shard")
+        self.names = list(names)
+        points = sorted((_hash(f"{name}#{index}"), name) for name in self.names for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def owner(self, domain):
+        """Return the shard owning ``domain``: the first ring point after its registrable domain's hash."""
+        index = bisect.bisect(self._hashes, _hash(registrable_domain(domain)))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardMap:
+    """The shards, their servers, and the ring (plus ``next_ring`` while rebalancing) that places domains."""
+
+    def __init__(self, shards, ring, next_ring=None, vnodes=DEFAULT_VNODES, path=None):
+        unknown = set(ring) | set(next_ring or ())
+        unknown.difference_update(shards)
+        if unknown:
+            raise ValueError(f"Shard map rings name undefined shards: {', '.join(sorted(unknown))}")
+        self.shards = shards  # name -> {"primary": (host, port), "secondaries": [(host, port), ...]}
+        self.vnodes = vnodes
+        self.ring = HashRing(ring, vnodes)
+        self.next_ring = HashRing(next_ring, vnodes) if next_ring and list(next_ring) != list(ring) else None
+        self.path = path
+
+    def owner(self, domain):
+        """Return the shard that answers reads for ``domain``."""
+        return self.ring.owner(domain)
+
+    def write_owners(self, domain):
+        """Return the shards a write for ``domain`` must reach: its owner, then its next owner if it is moving."""
+        owner = self.ring.owner(domain)
+        if self.next_ring is None:
+            return [owner]
+        next_owner = self.next_ring.owner(domain)
+        return [owner] if next_owner == owner else [owner, next_owner]
+
+    def servers(self, name):
+        """Return a shard's primary followed by its secondaries."""
+        shard = self.shards[name]
+        return [shard["primary"]] + list(shard["secondaries"])
+
+    def staged(self, next_ring):
+        """Return a copy of this map that is moving to ``next_ring``."""
+        return ShardMap(self.shards, self.ring.names, next_ring, self.vnodes, self.path)
+
+    def cut_over(self):
+        """Return a copy of this map that reads from and writes to ``next_ring`` only."""
+        return ShardMap(self.shards, (self.next_ring or self.ring).names, None, self.vnodes, self.path)
+
+    def to_dict(self):
+        data = {
+            "vnodes": self.vnodes,
+            "shards": {
+                name: {"primary": _format_address(shard["primary"]),
+                       "secondaries": [_format_address(address) for address in shard["secondaries"]]}
+                for name, shard in self.shards.items()
+            },
+            "ring": self.ring.names,
+        }
+        if self.next_ring is not None:
+            data["next_ring"] = self.next_ring.names
+        return data
+
+
+def _format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+def single_shard_map(primary, secondaries):
+    """Return a map with one shard, for deployments without a shard map file."""
+    return ShardMap({"default": {"primary": primary, "secondaries": list(secondaries)}}, ["default"])
+
+
+def parse_shard_map(data, path=None):
+    """Build a ShardMap from the decoded JSON document. Raises ValueError if it is malformed."""
+    try:
+        shards = {
+            name: {"primary": server_core.parse_address(shard["primary"]),
+                   "secondaries": [server_core.parse_address(address) for address in shard.get("secondaries", [])]}
+            for name, shard in data["shards"].items()
+        }
+        return ShardMap(shards, data["ring"], data.get("next_ring"), data.get("vnodes", DEFAULT_VNODES), path)
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Malformed shard map: {e!r}") from e
+
+
+def load_shard_map(path):
+    """Read a shard map file. Raises OSError if it cannot be read and ValueError if it is malformed."""
+    with open(path) as source:
+        return parse_shard_map(json.load(source), path)
+
+
+def save_shard_map(shard_map, path):
+    """Write ``shard_map`` to ``path`` atomically, so readers never see a partial file."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as destination:
+        json.dump(shard_map.to_dict(), destination, indent=2)
+        destination.write("\n")
+        destination.flush()
+        os.fsync(destination.fileno())
+    os.replace(temporary, path)
+    shard_map.path = path
@@ -0,0 +1,396 @@
+"""SQLite access layer shared by the primary and secondary servers."""
+import sqlite3
+import threading
+import time
+import weakref
+
+import metrics
+
+# sqlite3 caches compiled statements per connection keyed by their SQL text, so
+# keeping every statement as a module constant means each thread prepares it once.
+CREATE_RECORDS_SQL = """
+    CREATE TABLE IF NOT EXISTS dns_records (
+        domain TEXT NOT NULL,
+        record_type TEXT NOT NULL,
+        value TEXT NOT NULL,
+        reversed_domain TEXT,
+        ttl INTEGER,
+        PRIMARY KEY (domain, record_type)
+    )
+"""
+CREATE_CHANGE_LOG_SQL = """
+    CREATE TABLE IF NOT EXISTS change_log (
+        serial INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        record_type TEXT NOT NULL,
+        value TEXT,
+        ttl INTEGER
+    )
+"""
+CREATE_REPLICATION_STATE_SQL = """
+    CREATE TABLE IF NOT EXISTS replication_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+"""
+# Names sorted by reversed labels ("com.example.www.") put every zone in one contiguous range
+CREATE_REVERSED_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS dns_records_reversed ON dns_records (reversed_domain, record_type)
+"""
+# Lets a scan filtered to one record type seek straight to that type's names, in name order
+CREATE_TYPE_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS dns_records_type ON dns_records (record_type, domain)
+"""
+SCHEMA = (CREATE_RECORDS_SQL, CREATE_CHANGE_LOG_SQL, CREATE_REPLICATION_STATE_SQL)
+
+RECORD_COLUMNS_SQL = "PRAGMA table_info(dns_records)"
+CHANGE_LOG_COLUMNS_SQL = "PRAGMA table_info(change_log)"
+ADD_REVERSED_COLUMN_SQL = "ALTER TABLE dns_records ADD COLUMN reversed_domain TEXT"
+ADD_TTL_COLUMN_SQL = "ALTER TABLE dns_records ADD COLUMN ttl INTEGER"
+ADD_CHANGE_TTL_COLUMN_SQL = "ALTER TABLE change_log ADD COLUMN ttl INTEGER"
+SELECT_UNINDEXED_SQL = "SELECT DISTINCT domain FROM dns_records WHERE reversed_domain IS NULL"
+BACKFILL_REVERSED_SQL = "UPDATE dns_records SET reversed_domain = ? WHERE domain = ?"
+
+UPSERT_SQL = """
+    INSERT OR REPLACE INTO dns_records (domain, record_type, value, ttl, reversed_domain) VALUES (?, ?, ?, ?, ?)
+"""
+DELETE_SQL = "DELETE FROM dns_records WHERE domain = ? AND record_type = ?"
+SELECT_VALUE_SQL = "SELECT value, ttl FROM dns_records WHERE domain = ? AND record_type = ?"
+SELECT_DOMAIN_SQL = "SELECT 1 FROM dns_records WHERE domain = ? LIMIT 1"
+SELECT_RANGE_EXISTS_SQL = "SELECT 1 FROM dns_records WHERE reversed_domain >= ? AND reversed_domain < ? LIMIT 1"
+SELECT_REVERSED_VALUE_SQL = "SELECT value FROM dns_records WHERE reversed_domain = ? AND record_type = ?"
+SELECT_ZONE_SQL = """
+    SELECT domain, record_type, value FROM dns_records
+    WHERE reversed_domain >= ? AND reversed_domain < ? ORDER BY reversed_domain, record_type LIMIT ?
+"""
+SELECT_ALL_SQL = "SELECT domain, record_type, value, ttl FROM dns_records ORDER BY domain, record_type"
+# Keyset pages: each seeks past the last key of the previous page instead of counting an OFFSET
+SCAN_SQL = """
+    SELECT domain, record_type, value, ttl FROM dns_records
+    WHERE domain >= ? AND domain < ? AND (domain, record_type) > (?, ?) ORDER BY domain, record_type LIMIT ?
+"""
+SCAN_TYPE_SQL = """
+    SELECT domain, record_type, value, ttl FROM dns_records
+    WHERE record_type = ? AND domain >= ? AND domain < ? AND (domain, record_type) > (?, ?) ORDER BY domain LIMIT ?
+"""
+NAME_END = "\U0010ffff"  # Sorts after every name, so it bounds a scan without a prefix
+
+INSERT_CHANGE_SQL = "INSERT INTO change_log (action, domain, record_type, value, ttl) VALUES (?, ?, ?, ?, ?)"
+SELECT_CHANGES_SQL = """
+    SELECT serial, action, domain, record_type, value, ttl FROM change_log
+    WHERE serial > ? ORDER BY serial LIMIT ?
+"""
+# AUTOINCREMENT keeps the high-water mark in sqlite_sequence even after the log is trimmed
+SELECT_LATEST_SERIAL_SQL = "SELECT seq FROM sqlite_sequence WHERE name = 'change_log'"
+SELECT_OLDEST_SERIAL_SQL = "SELECT min(serial) FROM change_log"
+TRIM_CHANGE_LOG_SQL = "DELETE FROM change_log WHERE serial <= ?"
+SELECT_STATE_SQL = "SELECT value FROM replication_state WHERE name = ?"
+UPSERT_STATE_SQL = "INSERT OR REPLACE INTO replication_state (name, value) VALUES (?, ?)"
+DELETE_ALL_RECORDS_SQL = "DELETE FROM dns_records"
+LAST_APPLIED_SERIAL = "last_applied_serial"
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",  # Readers no longer block on the writer
+    "PRAGMA synchronous = NORMAL",  # WAL stays durable across application crashes with fewer fsyncs
+    "PRAGMA cache_size = -65536",  # 64 MiB page cache per connection
+    "PRAGMA mmap_size = 268435456",  # Read pages straight from a 256 MiB memory map
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+STATEMENT_CACHE_SIZE = 256
+
+
+def reverse_domain(domain):
+    """Return the suffix index key for ``domain``: its lowercased labels reversed, with a trailing dot."""
+    labels = domain.strip(".").lower().split(".")
+    return ".".join(reversed(labels)) + "."
+
+
+def _zone_range(domain):
+    """Return the ``[low, high)`` index range covering ``domain`` and every name below it."""
+    low = reverse_domain(domain)
+    return low, low[:-1] + "/"  # "/" sorts right after "."
+
+
+def _prefix_range(prefix):
+    """Return the ``[low, high)`` range of names that start with ``prefix``."""
+    if not prefix:
+        return "", NAME_END
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _indexed(records):
+    return [(domain, record_type, value, ttl, reverse_domain(domain)) for domain, record_type, value, ttl in records]
+
+
+class _ConnectionHolder:
+    """Owns one thread's connection; its finalizer closes the connection once the thread is gone."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class RecordStore:
+    """Per-thread pooled connections to the ``dns_records`` database.
+
+    Each thread that touches the store gets one long-lived connection, opened on
+    first use, so request handlers never pay connection setup or PRAGMA costs.
+    The connection is closed when its thread exits, so short-lived threads do
+    not leave connections and file descriptors behind.
+
+    With ``change_log=True`` (the primary), every mutation is also appended to
+    the ``change_log`` table in the same transaction, which gives it a
+    monotonically increasing serial for secondaries to replicate from.
+    """
+
+    def __init__(self, db_file, change_log=False):
+        self.db_file = db_file
+        self.change_log = change_log
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def connection(self):
+        """Return this thread's connection, opening and tuning it on first use."""
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            conn = sqlite3.connect(self.db_file, cached_statements=STATEMENT_CACHE_SIZE,
+                                   check_same_thread=False)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            holder = self._local.holder = _ConnectionHolder(conn)
+            # The thread's locals are dropped when it exits, and the connection with them
+            weakref.finalize(holder, self._release, conn)
+            with self._connections_lock:
+                self._connections.append(conn)
+        return holder.conn
+
+    def _release(self, conn):
+        with self._connections_lock:
+            try:
+                self._connections.remove(conn)
+            except ValueError:
+                pass  # Already closed by close()
+        conn.close()
+
+    def init_db(self):
+        """Create the schema if needed, adding newer columns and backfilling the suffix index on older databases."""
+        conn = self.connection()
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            columns = {row[1] for row in conn.execute(RECORD_COLUMNS_SQL)}
+            if "reversed_domain" not in columns:
+                conn.execute(ADD_REVERSED_COLUMN_SQL)
+            if "ttl" not in columns:
+                conn.execute(ADD_TTL_COLUMN_SQL)
+            if "ttl" not in {row[1] for row in conn.execute(CHANGE_LOG_COLUMNS_SQL)}:
+                conn.execute(ADD_CHANGE_TTL_COLUMN_SQL)
+            domains = [row[0] for row in conn.execute(SELECT_UNINDEXED_SQL)]
+            conn.executemany(BACKFILL_REVERSED_SQL, [(reverse_domain(domain), domain) for domain in domains])
+            conn.execute(CREATE_REVERSED_INDEX_SQL)
+            conn.execute(CREATE_TYPE_INDEX_SQL)
+
+    def upsert(self, domain, record_type, value, ttl=None, before_commit=None):
+        return self.apply_mutations([("ADD", domain, record_type, value, ttl)], before_commit)[0]
+
+    def delete(self, domain, record_type, before_commit=None):
+        return self.apply_mutations([("DELETE", domain, record_type, None, None)], before_commit)[0]
+
+    def _apply(self, conn, mutations):
+        serials = []
+        for action, domain, record_type, value, ttl in mutations:
+            if action == "DELETE":
+                conn.execute(DELETE_SQL, (domain, record_type))
+            else:
+                conn.execute(UPSERT_SQL, (domain, record_type, value, ttl, reverse_domain(domain)))
+            if self.change_log:
+                serials.append(conn.execute(INSERT_CHANGE_SQL, (action, domain, record_type, value, ttl)).lastrowid)
+            else:
+                serials.append(None)
+        return serials
+
+    def apply_mutations(self, mutations, before_commit=None):
+        """Apply ``(action, domain, record_type, value, ttl)`` tuples, in order, in one transaction.
+
+        Returns the change-log serial assigned to each mutation, or a None for each
+        one when this store does not keep a change log. ``before_commit()`` runs
+        while the transaction still holds the write lock; if it raises, nothing
+        is committed, and writes reach it in the order they commit.
+        """
+        conn = self.connection()
+        started = time.perf_counter()
+        with conn:
+            serials = self._apply(conn, mutations)
+            if before_commit is not None:
+                before_commit()
+        metrics.observe("dns_sqlite_commit_seconds", 'op="mutations"', time.perf_counter() - started)
+        return serials
+
+    def bulk_upsert(self, records):
+        """Insert or replace many ``(domain, record_type, value, ttl)`` rows in one transaction.
+
+        Returns the change-log serials assigned to the rows, as ``apply_mutations()`` does.
+        """
+        conn = self.connection()
+        started = time.perf_counter()
+        with conn:
+            conn.executemany(UPSERT_SQL, _indexed(records))
+            if self.change_log:
+                conn.executemany(INSERT_CHANGE_SQL, [("ADD", domain, record_type, value, ttl)
+                                                     for domain, record_type, value, ttl in records])
+                # The transaction holds the write lock, so the batch got consecutive serials
+                last = conn.execute(SELECT_LATEST_SERIAL_SQL).fetchone()[0]
+        metrics.observe("dns_sqlite_commit_seconds", 'op="bulk"', time.perf_counter() - started)
+        if not self.change_log:
+            return [None] * len(records)
+        return list(range(last - len(records) + 1, last + 1))
+
+    def iter_records(self, batch_size=1000):
+        """Yield lists of ``(domain, record_type, value, ttl)`` rows without loading the whole table.
+
+        The rows come from a single read transaction, so in WAL mode the export is
+        a consistent snapshot even while writes continue.
+        """
+        cursor = self.connection().execute(SELECT_ALL_SQL)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+    def snapshot(self, batch_size=1000):
+        """Yield the serial the records are at, then batches of every record, from one read transaction.
+
+        The serial is the latest change-log serial, or on a replica the last one it applied.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            yield self.latest_serial() if self.change_log else self.last_applied_serial()
+            cursor = conn.execute(SELECT_ALL_SQL)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.rollback()
+
+    def replace_all(self, batches, serial):
+        """Replace every record with ``batches`` of rows and mark ``serial`` as applied, atomically.
+
+        Readers keep seeing the old records until the load commits. Returns the
+        number of rows loaded.
+        """
+        conn = self.connection()
+        count = 0
+        with conn:
+            conn.execute(DELETE_ALL_RECORDS_SQL)
+            for rows in batches:
+                conn.executemany(UPSERT_SQL, _indexed(rows))
+                count += len(rows)
+            conn.execute(UPSERT_STATE_SQL, (LAST_APPLIED_SERIAL, serial))
+        return count
+
+    def fetch_value(self, domain, record_type):
+        """Return the stored value for a record, or None if it does not exist."""
+        row = self.fetch_record(domain, record_type)
+        return row[0] if row else None
+
+    def fetch_record(self, domain, record_type):
+        """Return ``(value, ttl)`` for a record, or None if it does not exist. ``ttl`` is None unless one was set."""
+        return self.connection().execute(SELECT_VALUE_SQL, (domain, record_type)).fetchone()
+
+    def domain_exists(self, domain):
+        """Return True if ``domain`` has a record of any type."""
+        return self.connection().execute(SELECT_DOMAIN_SQL, (domain,)).fetchone() is not None
+
+    def list_zone(self, zone, limit):
+        """Return up to ``limit`` ``(domain, record_type, value)`` rows for ``zone`` and every name below it.
+
+        Rows come from one range scan over the suffix index, ordered by reversed name.
+        """
+        low, high = _zone_range(zone)
+        return self.connection().execute(SELECT_ZONE_SQL, (low, high, limit)).fetchall()
+
+    def scan(self, after, limit, record_type=None, prefix=""):
+        """Return up to ``limit`` ``(domain, record_type, value, ttl)`` rows that sort after the ``after`` key.
+
+        Rows are ordered by ``(domain, record_type)``; ``after`` is the last such
+        key of the previous page, or None to start from the beginning. Only
+        rows of ``record_type`` and names starting with ``prefix`` are returned
+        when those are given. Every page is one index seek, so the last page of
+        a large table costs as much as the first.
+        """
+        after_domain, after_type = after or ("", "")
+        low, high = _prefix_range(prefix)
+        low = max(low, after_domain)
+        if record_type:
+            return self.connection().execute(
+                SCAN_TYPE_SQL, (record_type, low, high, after_domain, after_type, limit)).fetchall()
+        return self.connection().execute(SCAN_SQL, (low, high, after_domain, after_type, limit)).fetchall()
+
+    def find_wildcard(self, domain, record_type):
+        """Return the value a ``*.`` wildcard record supplies for ``domain``, or None (RFC 4592).
+
+        Only the wildcard directly below the closest existing ancestor applies, and
+        never to a name that exists itself or has names below it.
+        """
+        conn = self.connection()
+        labels = reverse_domain(domain)[:-1].split(".")
+        for depth in range(len(labels), 0, -1):
+            ancestor = ".".join(reversed(labels[:depth]))
+            if conn.execute(SELECT_RANGE_EXISTS_SQL, _zone_range(ancestor)).fetchone() is None:
+                continue
+            if depth == len(labels):
+                return None  # The name itself exists, so it is never synthesised
+            row = conn.execute(SELECT_REVERSED_VALUE_SQL, (reverse_domain(f"*.{ancestor}"), record_type)).fetchone()
+            return row[0] if row else None
+        return None
+
+    def latest_serial(self):
+        """Return the highest serial ever assigned, or 0 if nothing has been logged."""
+        row = self.connection().execute(SELECT_LATEST_SERIAL_SQL).fetchone()
+        return row[0] if row else 0
+
+    def oldest_serial(self):
+        """Return the oldest serial still in the change log, or ``latest + 1`` if it is empty."""
+        row = self.connection().execute(SELECT_OLDEST_SERIAL_SQL).fetchone()
+        return row[0] if row[0] is not None else self.latest_serial() + 1
+
+    def fetch_changes(self, after_serial, limit):
+        """Return up to ``limit`` ``(serial, action, domain, record_type, value, ttl)`` rows after ``after_serial``."""
+        return self.connection().execute(SELECT_CHANGES_SQL, (after_serial, limit)).fetchall()
+
+    def trim_change_log(self, retain):
+        """Drop all but the newest ``retain`` change-log entries and return how many were removed."""
+        conn = self.connection()
+        with conn:
+            return conn.execute(TRIM_CHANGE_LOG_SQL, (self.latest_serial() - retain,)).rowcount
+
+    def last_applied_serial(self):
+        """Return the last change-log serial this replica applied, or 0."""
+        row = self.connection().execute(SELECT_STATE_SQL, (LAST_APPLIED_SERIAL,)).fetchone()
+        return row[0] if row else 0
+
+    def apply_replicated(self, changes):
+        """Apply ``(serial, action, domain, record_type, value, ttl)`` changes and record the last serial atomically."""
+        conn = self.connection()
+        started = time.perf_counter()
+        with conn:
+            self._apply(conn, [change[1:] for change in changes])
+            conn.execute(UPSERT_STATE_SQL, (LAST_APPLIED_SERIAL, changes[-1][0]))
+        metrics.observe("dns_sqlite_commit_seconds", 'op="replicated"', time.perf_counter() - started)
+
+    def close(self):
+        """Close every pooled connection."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
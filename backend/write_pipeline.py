@@ -0,0 +1,122 @@
+"""Group-commit pipeline for record mutations."""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import redis_cache
+
+DEFAULT_MAX_BATCH = 512
+DEFAULT_MAX_DELAY = 0.002  # Seconds to wait for more writes once a batch has started
+
+
+class GroupCommitWriter:
+    """Batch concurrent mutations into a single SQLite transaction.
+
+    Request handlers call ``submit()`` and wait on the returned Future. A single
+    writer thread collects whatever mutations are queued (waiting at most
+    ``max_delay`` for stragglers, up to ``max_batch`` of them), commits them in
+    one fully synchronous transaction, and then hands the batch and its
+    change-log serials to ``after_commit(pipe, mutations, serials)`` to queue the
+    matching cache updates and publishes on one pipeline of ``cache``, a
+    RedisCache. Futures resolve with their serials once the transaction
+    commits. A batch Redis does not take is kept, and it and every later batch
+    are sent again, in order, once Redis answers, so the cache and the other
+    servers catch up rather than keep the old values.
+    """
+
+    def __init__(self, store, cache, after_commit,
+                 max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.store = store
+        self.cache = cache
+        self.after_commit = after_commit
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._unpublished = []  # (mutations, serials) committed but not yet in Redis, oldest first
+        self._publish_failed = False
+        self.batches = 0
+        self.mutations = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, action, domain, record_type, value=None, ttl=None):
+        """Queue an ``ADD`` or ``DELETE`` and return a Future for its completion."""
+        future = Future()
+        self._queue.put(((action, domain, record_type, value, ttl), future))
+        return future
+
+    def unpublished(self):
+        """Return how many committed mutations are waiting to reach Redis."""
+        return sum(len(mutations) for mutations, _ in self._unpublished)
+
+    def _collect(self):
+        try:
+            # With batches left to publish, wake up now and then to retry even if no writes arrive
+            batch = [self._queue.get(timeout=redis_cache.RETRY_INTERVAL if self._unpublished else None)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _publish(self):
+        """Send every unpublished batch to Redis, oldest first, unless Redis is known to be down."""
+        if not self._unpublished or not self.cache.available():
+            return
+        try:
+            pipe = self.cache.pipeline()
+            for mutations, serials in self._unpublished:
+                self.after_commit(pipe, mutations, serials)
+            pipe.execute()
+        except redis_cache.UNAVAILABLE as e:
+            self.cache.failed(e)
+            self._publish_failed = True
+            print(f"[WARN] Keeping {self.unpublished()} committed mutation(s) to publish once Redis is back: {e}")
+            return
+        except Exception as e:
+            print(f"[ERROR] Could not publish {self.unpublished()} committed mutation(s): {e}")
+        else:
+            if self._publish_failed:
+                print(f"[INFO] Published {self.unpublished()} mutation(s) committed while Redis was unavailable.")
+        self._publish_failed = False
+        self._unpublished.clear()
+
+    def _run(self):
+        # The writer owns its connection, so only group commits pay for a full fsync
+        self.store.connection().execute("PRAGMA synchronous = FULL")
+        while True:
+            batch = self._collect()
+            if not batch:
+                self._publish()
+                continue
+            mutations = [mutation for mutation, _ in batch]
+            try:
+                serials = self.store.apply_mutations(mutations)
+            except Exception as e:
+                print(f"[ERROR] Group commit of {len(batch)} mutation(s) failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self._unpublished.append((mutations, serials))
+            self._publish()
+            self.batches += 1
+            self.mutations += len(batch)
+            for (_, future), serial in zip(batch, serials):
+                future.set_result(serial)
@@ -0,0 +1,138 @@
+"""Compact, read-only zone images that are memory-mapped and searched in place.
+
+An image holds every record of a ``dns_records`` table as of one replication
+serial. Records are sorted by ``domain\\0record_type`` key, so a lookup is a
+binary search over the mapped file, and no Python objects are created for a
+record until it is answered. The layout is:
+
+    header       magic, byte order, serial, record count and the array offsets
+    data         each record's key immediately followed by its UTF-8 value
+    offsets      count + 1 uint64 positions of each record in the data section
+    key_lengths  count uint16 key lengths
+    ttls         count uint32 record TTLs, 0 for records without their own
+
+The arrays are written in the builder's native byte order. Images are written
+to a temporary file and renamed into place, so a reader maps either the old
+image or the new one, never a partial file.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"DNSZIMG1"
+HEADER = struct.Struct("<8s8sQQQQQ")  # magic, byte order, serial, count, offsets/key_lengths/ttls positions
+MAX_KEY_LENGTH = 0xFFFF  # Key lengths are stored as uint16
+
+
+def _key(domain, record_type):
+    return f"{domain}\0{record_type}".encode()
+
+
+def _pad(out, position):
+    """Pad ``out`` so the next array starts on an 8-byte boundary, and return that position."""
+    padding = -position % 8
+    out.write(bytes(padding))
+    return position + padding
+
+
+def write_image(path, serial, batches):
+    """Write ``batches`` of ``(domain, record_type, value, ttl)`` rows to an image and publish it at ``path``.
+
+    Rows must arrive sorted by domain and then record type, as ``ORDER BY
+    domain, record_type`` returns them. Returns the number of records written.
+    """
+    temp_path = f"{path}.tmp"
+    offsets, key_lengths, ttls = array("Q"), array("H"), array("I")
+    previous = b""
+    try:
+        with open(temp_path, "wb") as out:
+            out.write(bytes(HEADER.size))
+            position = HEADER.size
+            for rows in batches:
+                chunk = []
+                for domain, record_type, value, ttl in rows:
+                    key = _key(domain, record_type)
+                    if key <= previous:
+                        raise ValueError(f"Records are not sorted by domain and type at {domain}:{record_type}")
+                    if len(key) > MAX_KEY_LENGTH:
+                        raise ValueError(f"Record name too long for a zone image: {domain}")
+                    previous = key
+                    encoded = value.encode()
+                    offsets.append(position)
+                    key_lengths.append(len(key))
+                    ttls.append(ttl or 0)
+                    chunk += (key, encoded)
+                    position += len(key) + len(encoded)
+                out.write(b"".join(chunk))
+            offsets.append(position)
+
+            offsets_at = _pad(out, position)
+            offsets.tofile(out)
+            key_lengths_at = offsets_at + offsets.itemsize * len(offsets)
+            key_lengths.tofile(out)
+            ttls_at = _pad(out, key_lengths_at + key_lengths.itemsize * len(key_lengths))
+            ttls.tofile(out)
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, sys.byteorder.encode(), serial, len(ttls),
+                                  offsets_at, key_lengths_at, ttls_at))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(ttls)
+
+
+class ZoneImage:
+    """One mapped zone image.
+
+    The mapping is never closed explicitly: a lookup that is still using an
+    image after a newer one was swapped in keeps it alive, and it is unmapped
+    once the last reference goes away. Raises ValueError for a file that is not
+    a usable image.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as source:
+            self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(source.fileno())
+        self.identity = (stat.st_ino, stat.st_mtime_ns)  # Changes whenever a new image is renamed into place
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is not a zone image")
+        magic, byteorder, self.serial, self.count, offsets_at, key_lengths_at, ttls_at = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a zone image")
+        built_on = byteorder.rstrip(b"\0").decode()
+        if built_on != sys.byteorder:
+            raise ValueError(f"{path} was built on a {built_on}-endian host")
+        view = memoryview(self._map)
+        self._offsets = view[offsets_at:offsets_at + 8 * (self.count + 1)].cast("Q")
+        self._key_lengths = view[key_lengths_at:key_lengths_at + 2 * self.count].cast("H")
+        self._ttls = view[ttls_at:ttls_at + 4 * self.count].cast("I")
+
+    def __len__(self):
+        return self.count
+
+    def get(self, domain, record_type):
+        """Return ``(value, ttl)`` for a record, or None if the image does not have it."""
+        key = _key(domain, record_type)
+        data, offsets, key_lengths = self._map, self._offsets, self._key_lengths
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = offsets[middle]
+            if data[start:start + key_lengths[middle]] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        start = offsets[low]
+        key_end = start + key_lengths[low]
+        if data[start:key_end] != key:
+            return None
+        return data[key_end:offsets[low + 1]].decode(), self._ttls[low] or None
@@ -0,0 +1,256 @@
+"""Streaming readers and writers for zone files and CSV record dumps."""
+import csv
+import io
+import ipaddress
+from itertools import islice
+
+FORMATS = ("zone", "csv")
+CSV_HEADER = ["domain", "record_type", "value", "ttl"]
+RECORD_CLASSES = {"IN", "CH", "HS"}
+MAX_TTL = 2147483647  # RFC 2181, section 8
+DEFAULT_LIST_LIMIT = 1000
+MAX_LIST_LIMIT = 10000
+
+
+def _absolute(name, origin):
+    """Resolve an owner or target name relative to ``origin`` and strip the trailing dot."""
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name[:-1]
+    return f"{name}.{origin}" if origin else name
+
+
+def normalize_name(name):
+    """Return ``name`` as records are stored and looked up: lowercase, without a trailing dot."""
+    return name.strip().rstrip(".").lower()
+
+
+def parse_ttl(text):
+    """Return a record TTL in seconds from ``text``, or None if it is empty.
+
+    Raises ValueError unless it is a whole number from 1 to MAX_TTL.
+    """
+    text = text.strip()
+    if not text:
+        return None
+    if not text.isdigit() or not 1 <= int(text) <= MAX_TTL:
+        raise ValueError(f"TTL must be a whole number of seconds from 1 to {MAX_TTL}, not '{text}'")
+    return int(text)
+
+
+def _is_ipv6(text):
+    try:
+        return isinstance(ipaddress.ip_address(text), ipaddress.IPv6Address)
+    except ValueError:
+        return False
+
+
+def parse_write_query(query):
+    """Parse ``ADD|UPDATE:<domain>:<record_type>:<value>[:<ttl>]`` into ``(domain, record_type, value, ttl)``.
+
+    Values may contain colons, so the last field is a TTL only if it is all
+    digits, or empty for no TTL, and for AAAA only if what precedes it is still
+    an IPv6 address. End the value with ``:`` to keep a numeric last part in it
+    (``ADD:host:TXT:port:8080:``). Raises ValueError for a malformed request.
+    """
+    _, domain, record_type, rest = (query.split(":", 3) + ["", "", ""])[:4]
+    domain = normalize_name(domain)
+    if not domain or not record_type or not rest:
+        raise ValueError(query)
+    value, separator, ttl = rest.rpartition(":")
+    if not separator or not value or not (ttl == "" or ttl.isdigit()) or (
+            record_type.upper() == "AAAA" and not _is_ipv6(value)):
+        value, ttl = rest, ""
+    return domain, record_type.upper(), value, parse_ttl(ttl)
+
+
+def _strip_comment(line):
+    """Drop a ``;`` comment, ignoring semicolons inside quoted strings."""
+    in_quotes = False
+    for index, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ";" and not in_quotes:
+            return line[:index]
+    return line
+
+
+def parse_zone_lines(lines, origin=""):
+    """Yield ``(domain, record_type, value, ttl)`` from RFC 1035 master file lines.
+
+    Supports ``$ORIGIN``, ``$TTL``, ``@``, relative owner names, blank owners that
+    repeat the previous one, and optional TTL/class fields. A record without a
+    TTL field takes the last ``$TTL``, or None before any. Multi-line
+    parenthesised records (such as SOA) are not supported and are skipped.
+    """
+    origin = origin.rstrip(".")
+    default_ttl = None
+    previous_owner = None
+    for raw in lines:
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        line = _strip_comment(raw.rstrip("\r\n"))
+        if not line.strip():
+            continue
+        if line.startswith("$ORIGIN"):
+            origin = line.split()[1].rstrip(".")
+            continue
+        if line.startswith("$TTL"):
+            default_ttl = parse_ttl(line.split()[1])
+            continue
+        if line.startswith("$"):
+            continue  # $INCLUDE is not supported
+        if "(" in line or ")" in line:
+            continue
+
+        fields = line.split()
+        if line[0].isspace():
+            if previous_owner is None:
+                continue
+            owner = previous_owner
+        else:
+            owner = normalize_name(_absolute(fields.pop(0), origin))
+        previous_owner = owner
+
+        # Optional TTL and class, in either order, precede the type
+        ttl = default_ttl
+        while fields and (fields[0].isdigit() or fields[0].upper() in RECORD_CLASSES):
+            field = fields.pop(0)
+            if field.isdigit():
+                ttl = parse_ttl(field)
+        if len(fields) < 2:
+            continue
+        record_type = fields[0].upper()
+        rdata = fields[1:]
+        if record_type in ("CNAME", "NS", "PTR"):
+            value = _absolute(rdata[0], origin)
+        elif record_type == "MX" and len(rdata) >= 2:
+            value = f"{rdata[0]} {_absolute(rdata[1], origin)}"
+        elif record_type == "TXT":
+            value = " ".join(rdata).replace('"', "")
+        else:
+            value = " ".join(rdata)
+        yield owner, record_type, value, ttl
+
+
+def parse_csv_lines(lines):
+    """Yield ``(domain, record_type, value, ttl)`` from ``domain,record_type,value[,ttl]`` CSV lines."""
+    text_lines = (line.decode() if isinstance(line, bytes) else line for line in lines)
+    for row in csv.reader(text_lines):
+        if len(row) < 3 or row == CSV_HEADER or row == CSV_HEADER[:3]:
+            continue
+        domain, record_type, value = (field.strip() for field in row[:3])
+        if domain and record_type:
+            yield normalize_name(domain), record_type.upper(), value, parse_ttl(row[3]) if len(row) > 3 else None
+
+
+def parse_records(lines, fmt="zone"):
+    """Return a lazy record iterator for ``lines`` in the given format."""
+    if fmt == "csv":
+        return parse_csv_lines(lines)
+    return parse_zone_lines(lines)
+
+
+def batched(iterable, size):
+    """Yield lists of at most ``size`` items without materialising the whole input."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_records(records, fmt="zone"):
+    """Render ``(domain, record_type, value[, ttl])`` rows as zone file or CSV text."""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(records)
+        return buffer.getvalue()
+    lines = []
+    for domain, record_type, value, *ttl in records:
+        if record_type == "TXT":
+            value = f'"{value}"'
+        elif record_type in ("CNAME", "NS", "PTR", "MX") and not value.endswith("."):
+            value = f"{value}."
+        ttl_field = f"{ttl[0]}\t" if ttl and ttl[0] is not None else ""
+        lines.append(f"{domain}.\t{ttl_field}IN\t{record_type}\t{value}\n")
+    return "".join(lines)
+
+
+def format_listing(zone, records):
+    """Render a LIST response: a ``LIST:<zone>:<count>`` header line, then one CSV row per record."""
+    return f"LIST:{zone}:{len(records)}\n" + format_records(records, "csv")
+
+
+def parse_listing(response):
+    """Parse a LIST response into a list of ``(domain, record_type, value)`` tuples.
+
+    Raises ValueError for an error or otherwise unexpected response.
+    """
+    header, _, body = response.partition("\n")
+    tag, _, count = header.rpartition(":")
+    if not tag.startswith("LIST:") or not count.isdigit():
+        raise ValueError(response)
+    records = [tuple(row) for row in csv.reader(io.StringIO(body))]
+    if len(records) != int(count):
+        raise ValueError(f"Expected {count} records, got {len(records)}")
+    return records
+
+
+def format_scan_cursor(domain, record_type):
+    """Return the SCAN cursor that resumes after the record ``domain``/``record_type``."""
+    return f"{domain}/{record_type}"
+
+
+def parse_scan_cursor(cursor):
+    """Return the ``(domain, record_type)`` key a SCAN cursor resumes after, or None for an empty cursor.
+
+    Raises ValueError for a malformed cursor.
+    """
+    if not cursor:
+        return None
+    domain, _, record_type = cursor.rpartition("/")  # Record types never contain "/"
+    if not domain or not record_type:
+        raise ValueError(f"Malformed SCAN cursor '{cursor}'")
+    return domain, record_type
+
+
+def parse_scan_query(query):
+    """Parse ``SCAN:[<cursor>][:<limit>[:<type>[:<prefix>]]]`` into ``(after, limit, record_type, prefix)``.
+
+    Empty fields take their defaults. Raises ValueError for a malformed request.
+    """
+    fields = query.split(":")
+    if fields[0] != "SCAN" or not 2 <= len(fields) <= 5:
+        raise ValueError(query)
+    cursor, limit, record_type, prefix = fields[1:] + [""] * (5 - len(fields))
+    limit = int(limit) if limit else DEFAULT_LIST_LIMIT
+    if limit < 1:
+        raise ValueError(query)
+    return parse_scan_cursor(cursor), min(limit, MAX_LIST_LIMIT), record_type.upper() or None, prefix.lower()
+
+
+def format_scan(records, next_cursor):
+    """Render a SCAN response: a ``SCAN:<next_cursor>:<count>`` header line, then one CSV row per record.
+
+    The cursor is empty on the last page.
+    """
+    return f"SCAN:{next_cursor}:{len(records)}\n" + format_records(records, "csv")
+
+
+def parse_scan(response):
+    """Parse a SCAN response into ``(records, next_cursor)``, with records as ``(domain, record_type, value, ttl)``.
+
+    Raises ValueError for an error or otherwise unexpected response.
+    """
+    header, _, body = response.partition("\n")
+    tag, _, count = header.rpartition(":")
+    if not tag.startswith("SCAN:") or not count.isdigit():
+        raise ValueError(response)
+    records = [(domain, record_type, value, int(ttl) if ttl else None)
+               for domain, record_type, value, ttl in csv.reader(io.StringIO(body))]
+    if len(records) != int(count):
+        raise ValueError(f"Expected {count} records, got {len(records)}")
+    return records, tag[len("SCAN:"):]
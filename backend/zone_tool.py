@@ -0,0 +1,70 @@
+"""Bulk zone import/export against the primary DNS server.
+
+Examples:
+    python zone_tool.py import example.com.zone
+    python zone_tool.py import records.csv --format csv
+    python zone_tool.py export backup.zone
+"""
+import argparse
+import shutil
+import socket
+import sys
+
+import server_core
+import zone_io
+
+PRIMARY_SERVER = ("127.0.0.1", 8053)
+CHUNK_SIZE = 256 * 1024
+
+
+def import_zone(server_address, path, fmt):
+    """Stream a zone file or CSV to the server's BULK command and return its summary."""
+    with socket.create_connection(server_address) as sock:
+        sock.sendall(f"BULK:{fmt}\n".encode())
+        with (sys.stdin.buffer if path == "-" else open(path, "rb")) as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)  # Marks the end of the upload
+        with sock.makefile("rb") as response:
+            return response.read().decode()
+
+
+def export_zone(server_address, path, fmt):
+    """Stream every record from the server's EXPORT command into ``path``."""
+    with socket.create_connection(server_address) as sock:
+        sock.sendall(f"EXPORT:{fmt}\n".encode())
+        with sock.makefile("rb") as response:
+            if path == "-":
+                shutil.copyfileobj(response, sys.stdout.buffer, CHUNK_SIZE)
+            else:
+                with open(path, "wb") as destination:
+                    shutil.copyfileobj(response, destination, CHUNK_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import or export DNS records through the primary server.")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("path", help="Zone file or CSV to read or write, or - for stdin/stdout")
+    parser.add_argument("--format", choices=zone_io.FORMATS, default="zone",
+                        help="Zone file (RFC 1035 master format) or domain,record_type,value CSV")
+    parser.add_argument("--server", type=server_core.parse_address, default=PRIMARY_SERVER,
+                        help="Primary server as host:port (default: 127.0.0.1:8053)")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "import":
+            print(import_zone(args.server, args.path, args.format))
+        else:
+            export_zone(args.server, args.path, args.format)
+            if args.path != "-":
+                print(f"[INFO] Exported records to {args.path}")
+    except OSError as e:
+        print(f"[ERROR] Could not reach {args.server[0]}:{args.server[1]} - {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()